@@ -1,12 +1,45 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
-from asgiref.wsgi import WsgiToAsgi
-from models import db, Language, Feedback
+from models import db, Question, Answer, LLMError
+import database
+from counters import counter_buffer, record_language, record_votes
+from leaderboard import leaderboard_cli, leaderboard_snapshots, parse_slice
+from search import ensure_search_index, search_questions
+from dedup import dedup_cli, question_index, similar_questions_with_answers
+from export import CONTENT_TYPES, ExportFilters, check_token, export, export_cli, parse_time
+from evaluate import evaluate_cli
+from replay import backlog, error_replayer, replay_cli
+from jobs import enqueue_jobs, get_jobs, job_events, job_worker, jobs_cli, queue_stats
+from benchmark import benchmark_cli
+from metrics import registry as metrics_registry
+import tracing
+import logs
 import os
+import json
+import asyncio
 from config import config
+from cache import answer_cache
+from singleflight import llm_calls
+from health import model_health
+from limits import llm_limits
+from resilience import circuit_breakers
 import logging
+import threading
 from sqlalchemy.exc import SQLAlchemyError
-from function import update_answer, insert_question, get_answer_from_model
+from function import (
+    AnswerNotFound,
+    parse_votes,
+    upsert_feedback,
+    parse_answer_id,
+    insert_question,
+    get_answer_from_model,
+    get_answers_from_models,
+    stream_answer_from_model,
+    parse_answer_request,
+)
+
+
+CORS_ORIGIN_REGEX = r"^https?://(localhost|10\.1\.\d+\.\d+|35\.199\.152\.39|lmcode\.ai)/?(:\d+)?$"
 
 
 def create_app():
@@ -14,14 +47,17 @@ def create_app():
     CORS(
         app,
         supports_credentials=True,
-        origins=[r"^https?://(localhost|10\.1\.\d+\.\d+|35\.199\.152\.39|lmcode\.ai)/?(:\d+)?$"],
+        origins=[CORS_ORIGIN_REGEX],
     )
 
     # Configuration for SQLite database
     app.config["SQLALCHEMY_DATABASE_URI"] = config.SQLALCHEMY_DATABASE_URI
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = config.SQLALCHEMY_TRACK_MODIFICATIONS
 
-    db.init_app(app)
+    # engine tuning and the optional single database writer
+    database.init_db(app)
+    # request ids and traces
+    tracing.init_app(app)
 
     with app.app_context():
         db_path = os.path.join(app.instance_path, config.SQLALCHEMY_FILENAME)
@@ -31,11 +67,60 @@ def create_app():
             logging.info("Database and tables created.")
         else:
             logging.info("Database already exists.")
+            # tables and columns added since the database was created
+            db.create_all()
+            database.ensure_columns(db.engine, Answer)
+            database.ensure_columns(db.engine, LLMError)
+        ensure_search_index(db.engine)
+
+    app.cli.add_command(leaderboard_cli)
+    app.cli.add_command(dedup_cli)
+    app.cli.add_command(export_cli)
+    app.cli.add_command(evaluate_cli)
+    app.cli.add_command(replay_cli)
+    app.cli.add_command(jobs_cli)
+    app.cli.add_command(benchmark_cli)
+
+    # the ASGI lifespan starts them before the first request; this covers `flask run` and WSGI servers
+    @app.before_request
+    def start_background_on_first_request():
+        start_background_services(app)
 
     return app
 
+
+_background_lock = threading.Lock()
+_background_started = False
+
+
+def start_background_services(app: Flask) -> None:
+    """
+    Start the background threads of a process serving the app: counter
+    flushes, error replay, the job worker, the metrics file and the model
+    warm-up. create_app does not start them, so flask CLI commands run
+    without claiming jobs or calling the models. Does nothing once started.
+    """
+    global _background_started
+    if _background_started:
+        return
+    with _background_lock:
+        if _background_started:
+            return
+        _background_started = True
+
+    if config.COUNTERS_ENABLED:
+        counter_buffer.start(app)
+    if config.REPLAY_ENABLED:
+        error_replayer.start(app)
+    if config.JOBS_ENABLED and config.JOBS_WORKER_IN_APP:
+        job_worker.start(app)
+    if config.METRICS_ENABLED:
+        metrics_registry.start()
+
+    # sanity check the models in the background so startup does not wait on providers
+    model_health.start_warmup()
+
 app = create_app()
-asgi_app = WsgiToAsgi(app)
 
 @app.route("/api/health", methods=["GET"])
 def heath_check():
@@ -54,24 +139,15 @@ def add_language():
         return jsonify({"error": err_msg}), 400
 
     try:
-        language = Language.query.filter_by(name=language_name).first()
-
-        if language:
-            language.count += 1
-            logging.info(f"<add_language> {language_name} exists. Incremented count to {language.count}.")
-        else:
-            language = Language(name=language_name)
-            db.session.add(language)
-            logging.info(f"<add_language> added new language: {language_name}")
-
-        db.session.commit()
-        logging.info(f"<add_language> database commit successful for language: {language_name}")
+        # counted through the write-behind buffer when it is enabled
+        record_language(language_name)
+        logging.info(f"<add_language> recorded suggestion for language: {language_name}")
 
         return jsonify({"message": "Language added/updated successfully"}), 200
 
     except Exception as e:
         db.session.rollback()
-        logging.error(f"<add_language> Error in add language: {err_msg}")
+        logging.error(f"<add_language> Error in add language: {e}")
         return jsonify({"error": str(e)}), 500
 
     finally:
@@ -87,24 +163,19 @@ def accept_answer():
     accept is tranlated to number of upvotes.
     reject is tranlated to number of downvotes.
     """
-    data = request.get_json()
-    answer_id = data.get("answer_id")
-
-    if answer_id is None:
-        return jsonify({"error": "answer_id is missing"}), 400
     try:
-        answer_id = int(answer_id)
-    except ValueError:
-        return jsonify({"error": "answer_id must be an integer"}), 400
+        answer_id = parse_answer_id(request.get_json())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     try:
-        update_answer(answer_id, 1, 0)
         # Mark all feedback as inactive when the answer is accepted
-        Feedback.query.filter_by(answer_id=answer_id).update({"active": False})
-        # Commit the changes to the database
-        db.session.commit()
+        record_votes([(answer_id, "accept")])
         return jsonify({"message": "Accept successfully"}), 200
 
+    except AnswerNotFound as e:
+        return jsonify({"error": str(e)}), 404
+
     except Exception as e:
         db.session.rollback()
         logging.error(f"<accept_answer> Error in accept for {answer_id}: {e}")
@@ -122,20 +193,18 @@ def unaccept_answer():
     accept is tranlated to number of upvotes.
     reject is tranlated to number of downvotes.
     """
-    data = request.get_json()
-    answer_id = data.get("answer_id")
-
-    if answer_id is None:
-        return jsonify({"error": "answer_id is missing"}), 400
     try:
-        answer_id = int(answer_id)
-    except ValueError:
-        return jsonify({"error": "answer_id must be an integer"}), 400
+        answer_id = parse_answer_id(request.get_json())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     try:
-        update_answer(answer_id, -1, 0)
+        record_votes([(answer_id, "unaccept")])
         return jsonify({"message": "Unaccept successfully"}), 200
 
+    except AnswerNotFound as e:
+        return jsonify({"error": str(e)}), 404
+
     except Exception as e:
         db.session.rollback()
         logging.error(f"<unaccept_answer> Error in unaccept for {answer_id}: {e}")
@@ -153,26 +222,19 @@ def reject_answer():
     accept is tranlated to number of upvotes.
     reject is tranlated to number of downvotes.
     """
-    data = request.get_json()
-    answer_id = data.get("answer_id")
-
-    if answer_id is None:
-        return jsonify({"error": "answer_id is missing"}), 400
     try:
-        answer_id = int(answer_id)
-    except ValueError:
-        return jsonify({"error": "answer_id must be an integer"}), 400
+        answer_id = parse_answer_id(request.get_json())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     try:
-        update_answer(answer_id, 0, 1)
-
         # Mark all feedback as active when the answer is rejected
-        Feedback.query.filter_by(answer_id=answer_id).update({"active": True})
-        # Commit the changes to the database
-        db.session.commit()
-
+        record_votes([(answer_id, "reject")])
         return jsonify({"message": "Reject successfully"}), 200
 
+    except AnswerNotFound as e:
+        return jsonify({"error": str(e)}), 404
+
     except Exception as e:
         db.session.rollback()
         logging.error(f"<reject_answer> Error in reject for {answer_id}: {e}")
@@ -189,20 +251,18 @@ def unreject_answer():
     accept is tranlated to number of upvotes.
     reject is tranlated to number of downvotes.
     """
-    data = request.get_json()
-    answer_id = data.get("answer_id")
-
-    if answer_id is None:
-        return jsonify({"error": "answer_id is missing"}), 400
     try:
-        answer_id = int(answer_id)
-    except ValueError:
-        return jsonify({"error": "answer_id must be an integer"}), 400
+        answer_id = parse_answer_id(request.get_json())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     try:
-        update_answer(answer_id, 0, -1)
+        record_votes([(answer_id, "unreject")])
         return jsonify({"message": "Unreject successfully"}), 200
 
+    except AnswerNotFound as e:
+        return jsonify({"error": str(e)}), 404
+
     except Exception as e:
         db.session.rollback()
         logging.error(f"<unreject_answer> Error in unreject for {answer_id}: {e}")
@@ -212,44 +272,51 @@ def unreject_answer():
         db.session.close()
 
 
+@app.route("/api/answers/votes", methods=["POST"])
+def vote_answers_in_bulk():
+    """
+    apply a batch of votes in one transaction.
+    body: {"votes": [{"answer_id": 1, "action": "accept"}, ...]}
+    where action is one of accept, unaccept, reject and unreject.
+    """
+    try:
+        votes = parse_votes(request.get_json())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        record_votes(votes)
+        return jsonify({"message": f"Applied {len(votes)} votes"}), 200
+
+    except AnswerNotFound as e:
+        return jsonify({"error": str(e)}), 404
+
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"<vote_answers> Error in applying {len(votes)} votes: {e}")
+        return jsonify({"error": str(e)}), 500
+
+    finally:
+        db.session.close()
+
+
 @app.route("/api/answers/feedback", methods=["POST"])
-def upsert_feedback():
+def add_feedback():
     """
     add feedback for the answer in the database or update it if exists
     """
     data = request.get_json()
-    answer_id = data.get("answer_id")
-
-    if answer_id is None:
-        return jsonify({"error": "answer_id is missing"}), 400
     try:
-        answer_id = int(answer_id)
-    except ValueError:
-        return jsonify({"error": "answer_id must be an integer"}), 400
+        answer_id = parse_answer_id(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     predefined_feedbacks = data.get("predefined_feedbacks", [])
 
     text_feedback = data.get("text_feedback")
 
     try:
-        feedback = Feedback.query.filter_by(answer_id=answer_id).first()
-
-        if feedback:
-            # If feedback exists, update the existing record
-            feedback.predefined_feedbacks = predefined_feedbacks
-            feedback.text_feedback = text_feedback
-        else:
-            # If no feedback exists, create a new feedback record
-            feedback = Feedback(
-                predefined_feedbacks=predefined_feedbacks,
-                text_feedback=text_feedback,
-                answer_id=answer_id,
-                active=True,
-            )
-            db.session.add(feedback)
-
-        db.session.commit()
-
+        database.write(upsert_feedback, answer_id, predefined_feedbacks, text_feedback)
         return jsonify({"message": "Feedback upserted successfully"}), 200
 
     except SQLAlchemyError as e:
@@ -264,63 +331,159 @@ def upsert_feedback():
 async def get_answer():
     # TODO: add error handler to flask
     try:
-        data = request.get_json()
-        model_id = data.get("modelId")
-        if model_id is None:
-            return jsonify({"error": "model_id is missing"}), 400
+        try:
+            with tracing.span("parse_request"):
+                fields = parse_answer_request(request.get_json())
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
-        question_content = data.get("content")
-        if question_content is None:
-            return jsonify({"error": "question_content is missing"}), 400
+        response = await get_answer_from_model(**fields)
 
-        task = data.get("task")
-        if task is None:
-            return jsonify({"error": "task is missing"}), 400
+        logging.info(f"<get_answer> answered question {fields['question_id']} with {fields['model_id']}")
+        return jsonify(response), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-        language = data.get("language")
-        source_language = data.get("sourceLanguage")
-        target_language = data.get("targetLanguage")
 
-        if task == "Code Translation":
-            if source_language is None or target_language is None:
-                return jsonify({"error": "both sourceLanguage and targetLanguage must be provided for translation."}), 400
+def format_sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
-            # ignore language if passed in for tranlation
-            language = ""
-        else:
-            if language is None:
-                return jsonify({"error": "language be set for non-translation."}), 400
-
-            # ignore source and target language if not for tranlation
-            source_language = ""
-            target_language = ""
-
-        question_id = data.get("questionId")
-        if question_id is None:
-            return jsonify({"error": "question_id is missing"}), 400
-
-        frontend_order = data.get("frontendOrder")
-
-        response = await get_answer_from_model(
-            model_id=model_id,
-            content=question_content,
-            language=language,
-            source_language=source_language,
-            target_language=target_language,
-            task=task,
-            question_id=question_id,
-            frontend_order=frontend_order
-        )
 
-        logging.info(f"<handle_questions> llm response: {response}")
-        return jsonify(response), 200
+def iterate_async(async_iterator):
+    """
+    drive an async iterator from a plain generator so it can back a streaming
+    flask response; each step runs on a private event loop.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(async_iterator.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(async_iterator.aclose())
+        loop.close()
+
+
+@app.route("/api/answer/stream", methods=["POST"])
+def stream_answer():
+    """
+    same as /api/answer, but sends the answer back as server-sent events:
+    "token" events while the model generates, then "answer" with the stored
+    answer (including answer_id) or "error" if the generation failed.
+    """
+    data = request.get_json()
+    try:
+        fields = parse_answer_request(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if fields["model_id"] not in config.LLM_CHAINS:
+        return jsonify({"error": f"unknown model id: {fields['model_id']}"}), 400
+
+    def generate():
+        try:
+            for event, event_data in iterate_async(stream_answer_from_model(**fields)):
+                yield format_sse(event, event_data)
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"<stream_answer> Error in streaming answer for {fields['model_id']}: {e}")
+            yield format_sse("error", {"error": str(e)})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/api/answers", methods=["POST"])
+async def get_answers():
+    """
+    query every configured model for a question at the same time.
+    takes the same body as /api/answer, with an optional "modelIds" list
+    instead of "modelId"; frontend order follows the order of the models.
+    """
+    try:
+        data = request.get_json()
+        try:
+            fields = parse_answer_request(data, require_model_id=False)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        model_ids = data.get("modelIds") or model_health.available_model_ids()
+        unknown_ids = [model_id for model_id in model_ids if model_id not in config.LLM_CHAINS]
+        if unknown_ids:
+            return jsonify({"error": f"unknown model ids: {unknown_ids}"}), 400
+
+        responses = await get_answers_from_models(model_ids=model_ids, **fields)
+
+        logging.info(f"<get_answers> answered question {fields['question_id']} with {len(responses)} models")
+        return jsonify(responses), 200
     except Exception as e:
+        db.session.rollback()
+        logging.error(f"<get_answers> Error in answering question: {e}")
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/api/leaderboard", methods=["GET"])
+def get_leaderboard():
+    """
+    the models ranked by their rating from user votes,
+    optionally for one task (?task=) or language (?language=)
+    """
+    try:
+        slice_name = parse_slice(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify({"slice": slice_name, "models": leaderboard_snapshots.get(slice_name)}), 200
+
+
 @app.route("/api/models/ids", methods=["GET"])
 def get_model_ids():
-    return jsonify(list(config.LLM_CHAINS.keys())), 200
+    # models are only offered once they passed their sanity check, and not
+    # while their circuit breaker is open
+    return jsonify(model_health.available_model_ids()), 200
+
+@app.route("/api/models/status", methods=["GET"])
+def get_model_status():
+    status = model_health.snapshot()
+    for model_id, breaker in circuit_breakers.stats().items():
+        if model_id in status:
+            status[model_id]["circuit"] = breaker
+    return jsonify(status), 200
+
+@app.route("/api/models/limits", methods=["GET"])
+def get_model_limits():
+    return jsonify(llm_limits.stats()), 200
+
+@app.route("/api/db/stats", methods=["GET"])
+def get_db_stats():
+    stats = database.stats()
+    stats["counters"] = counter_buffer.stats()
+    return jsonify(stats), 200
+
+@app.route("/api/llm_errors/stats", methods=["GET"])
+def get_llm_error_stats():
+    return jsonify({"replay": error_replayer.stats(), "unresolved": backlog()}), 200
+
+@app.route("/api/logs/stats", methods=["GET"])
+def get_log_stats():
+    return jsonify(logs.stats()), 200
+
+@app.route("/api/cache/stats", methods=["GET"])
+def get_cache_stats():
+    stats = answer_cache.stats()
+    stats["singleflight"] = llm_calls.stats()
+    return jsonify(stats), 200
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    if not config.METRICS_ENABLED:
+        return jsonify({"error": "metrics are disabled"}), 404
+    return Response(metrics_registry.render(), mimetype="text/plain; version=0.0.4"), 200
 
 @app.route("/api/question", methods=["POST"])
 def add_question():
@@ -338,55 +501,184 @@ def add_question():
     if not task:
         return jsonify({"error": "task is required"}), 400
 
-    question_id = insert_question(
+    # "async": true also queues the answers of the models (see jobs.py)
+    run_async = bool(data.get("async"))
+    if run_async:
+        if not config.JOBS_ENABLED:
+            return jsonify({"error": "async questions are disabled"}), 400
+        try:
+            fields = parse_answer_request(data, require_model_id=False, require_question_id=False)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        model_ids = data.get("modelIds") or model_health.available_model_ids()
+        unknown_ids = [model_id for model_id in model_ids if model_id not in config.LLM_CHAINS]
+        if unknown_ids:
+            return jsonify({"error": f"unknown model ids: {unknown_ids}"}), 400
+
+    question_id = database.write(
+        insert_question,
         title=title,
         content=content,
         language=language,
         source_language=source_language,
         target_language=target_language,
         task=task,
-        ip_address=ip_address
+        ip_address=ip_address,
+        index=question_index(content) if config.DEDUP_ENABLED else None,
     )
 
-    return jsonify(question_id), 200
+    if not run_async:
+        return jsonify(question_id), 200
+
+    del fields["question_id"], fields["content"]
+    job_ids = database.write(enqueue_jobs, question_id=question_id, model_ids=model_ids, params=fields)
+    job_worker.notify()
+    logging.info(f"<add_question> queued {len(job_ids)} jobs for question {question_id}")
+    return jsonify({
+        "question_id": question_id,
+        "jobs": [{"job_id": job_id, "model_id": model_id} for job_id, model_id in zip(job_ids, model_ids)],
+    }), 202
+
+
+@app.route("/api/jobs/<int:job_id>", methods=["GET"])
+def get_job(job_id):
+    """status of an answer job, with the answer once it is done"""
+    jobs = get_jobs(job_id=job_id)
+    if not jobs:
+        return jsonify({"error": "job not found"}), 404
+    return jsonify(jobs[0]), 200
+
+
+@app.route("/api/questions/<int:question_id>/jobs", methods=["GET"])
+def get_question_jobs(question_id):
+    return jsonify(get_jobs(question_id=question_id)), 200
+
+
+@app.route("/api/questions/<int:question_id>/jobs/stream", methods=["GET"])
+def stream_question_jobs(question_id):
+    """
+    server-sent events of the jobs of a question: "job" as each one
+    finishes, with its answer or error, then "done" (or "timeout")
+    """
+    def generate():
+        for event, event_data in iterate_async(job_events(question_id, timeout=config.JOBS_STREAM_TIMEOUT)):
+            yield format_sse(event, event_data)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/api/jobs/stats", methods=["GET"])
+def get_job_stats():
+    return jsonify({"queue": queue_stats(), "worker": job_worker.stats()}), 200
+
+
+@app.route("/api/questions/search", methods=["GET"])
+def search():
+    """
+    full-text search over questions and their answers, best match first.
+    query parameters: q, task, language, prefix (default 1, type-ahead on
+    the last word), limit and cursor (next_cursor of the previous page)
+    """
+    try:
+        results = search_questions(
+            db.session,
+            query=request.args.get("q", ""),
+            task=request.args.get("task") or None,
+            language=request.args.get("language") or None,
+            prefix=request.args.get("prefix", "1") != "0",
+            limit=request.args.get("limit", 20, type=int),
+            cursor=request.args.get("cursor") or None,
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify(results), 200
+
+
+@app.route("/api/questions/similar", methods=["POST"])
+def similar_questions():
+    """
+    prior questions most similar to the posted content, with their answers
+    and votes. body: {"content": ..., "limit": 5}
+    """
+    data = request.get_json()
+    content = data.get("content")
+    if not content:
+        return jsonify({"error": "content is required"}), 400
+    limit = data.get("limit", 5)
+    if not isinstance(limit, int) or not 1 <= limit <= 50:
+        return jsonify({"error": "limit must be an integer between 1 and 50"}), 400
+
+    return jsonify(similar_questions_with_answers(content, limit=limit)), 200
+
+
+@app.route("/api/questions/<int:question_id>/similar", methods=["GET"])
+def get_similar_questions(question_id):
+    question = db.session.get(Question, question_id)
+    if question is None:
+        return jsonify({"error": "question not found"}), 404
+
+    limit = request.args.get("limit", 5, type=int)
+    similar = similar_questions_with_answers(question.content, limit=max(1, min(limit, 50)), exclude_question_id=question_id)
+    return jsonify(similar), 200
+
+
+@app.route("/api/export", methods=["GET"])
+def export_dataset():
+    """
+    stream a dataset for evaluation, authenticated with the export token
+    (Authorization: Bearer <EXPORT_TOKEN>). query parameters: dataset
+    (answers or errors), format (jsonl or parquet), since, until, task,
+    model (repeatable) and after (the X-Export-Watermark of a previous export)
+    """
+    if not config.EXPORT_TOKEN:
+        return jsonify({"error": "export is disabled"}), 404
+    if not check_token(request.headers.get("Authorization")):
+        return jsonify({"error": "invalid export token"}), 401
+
+    dataset = request.args.get("dataset", "answers")
+    file_format = request.args.get("format", "jsonl")
+    try:
+        filters = ExportFilters(
+            since=parse_time(request.args.get("since")),
+            until=parse_time(request.args.get("until")),
+            task=request.args.get("task") or None,
+            model_ids=request.args.getlist("model"),
+            after_id=request.args.get("after", 0, type=int),
+        )
+        watermark, content = export(db.engine, dataset=dataset, file_format=file_format, filters=filters)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 501
+
+    logging.info(f"<export_dataset> {dataset} as {file_format} after id {filters.after_id} up to id {watermark}")
+    return Response(
+        content,
+        mimetype=CONTENT_TYPES[file_format],
+        headers={
+            "Content-Disposition": f"attachment; filename={dataset}-{watermark}.{file_format}",
+            "X-Export-Watermark": str(watermark),
+        },
+    )
 
 
 @app.route("/health", methods=["GET"])
 def health():
     return jsonify({"status": "ok"}), 200
 
-# @app.route("/api/questions/search", methods=["GET"])
-# def search_questions():
-#     pass
-
-
 # @app.route("/api/get_answers", methods=["GET"])
 # def get_answer():
 #     pass
 
 
-# from flask import request, jsonify
-# from sqlalchemy import or_
 # from models import Question  # assuming your Question model is in models.py
 # from sqlalchemy.sql import func
 
-# @app.route("/api/search_questions", methods=["GET"])
-# def search_questions():
-#     query = request.args.get("query", "")
-#     if not query:
-#         return jsonify({"questions": []})
-
-#     # Fuzzy search on title and content
-#     search = "%{}%".format(query)
-#     results = Question.query.filter(or_(
-#         Question.title.ilike(search),
-#         Question.content.ilike(search)
-#     )).all()
-
-#     # Convert results to a list of dictionaries
-#     questions = [{"id": q.id, "title": q.title, "task": q.task} for q in results]
-#     return jsonify({"questions": questions})
-
 # @app.route("/api/random_questions", methods=["GET"])
 # def random_questions():
 #     # Get random 5 questions
@@ -409,4 +701,5 @@ def health():
 
 
 if __name__ == "__main__":
+    start_background_services(app)
     app.run(debug=True, port=5050)
@@ -0,0 +1,246 @@
+"""
+ASGI entry point. The hot endpoints (answer generation, votes and feedback)
+are served natively on the event loop, so in-flight LLM calls do not each
+hold a thread; every other route falls through to the flask app.
+
+Run with: gunicorn -k uvicorn.workers.UvicornWorker asgi:asgi_app
+"""
+import asyncio
+import contextlib
+import functools
+import logging
+
+from asgiref.wsgi import WsgiToAsgi
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+from app import app as flask_app, CORS_ORIGIN_REGEX, format_sse, start_background_services
+from config import config
+from function import (
+    AnswerNotFound,
+    get_answer_from_model,
+    get_answers_from_models,
+    stream_answer_from_model,
+    parse_answer_request,
+    parse_answer_id,
+    parse_votes,
+    upsert_feedback,
+    run_db,
+)
+from counters import counter_buffer, record_votes_async
+from health import model_health
+from jobs import job_events, job_worker
+import tracing
+
+
+async def read_json(request: Request) -> dict:
+    try:
+        data = await request.json()
+    except ValueError:
+        raise ValueError("request body must be valid JSON")
+    if not isinstance(data, dict):
+        raise ValueError("request body must be a JSON object")
+    return data
+
+
+def with_app_context(endpoint):
+    """run an endpoint inside a flask app context so models and function can use db.session"""
+    @functools.wraps(endpoint)
+    async def wrapper(request: Request):
+        with flask_app.app_context():
+            return await endpoint(request)
+    return wrapper
+
+
+@with_app_context
+async def get_answer(request: Request):
+    try:
+        with tracing.span("parse_request"):
+            fields = parse_answer_request(await read_json(request))
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    try:
+        response = await get_answer_from_model(**fields)
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+    logging.info(f"<get_answer> answered question {fields['question_id']} with {fields['model_id']}")
+    return JSONResponse(response)
+
+
+@with_app_context
+async def get_answers(request: Request):
+    try:
+        data = await read_json(request)
+        fields = parse_answer_request(data, require_model_id=False)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    model_ids = data.get("modelIds") or model_health.available_model_ids()
+    unknown_ids = [model_id for model_id in model_ids if model_id not in config.LLM_CHAINS]
+    if unknown_ids:
+        return JSONResponse({"error": f"unknown model ids: {unknown_ids}"}, status_code=400)
+
+    try:
+        responses = await get_answers_from_models(model_ids=model_ids, **fields)
+    except Exception as e:
+        logging.error(f"<get_answers> Error in answering question: {e}")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+    logging.info(f"<get_answers> answered question {fields['question_id']} with {len(responses)} models")
+    return JSONResponse(responses)
+
+
+async def stream_answer(request: Request):
+    try:
+        fields = parse_answer_request(await read_json(request))
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    if fields["model_id"] not in config.LLM_CHAINS:
+        return JSONResponse({"error": f"unknown model id: {fields['model_id']}"}, status_code=400)
+
+    async def events():
+        # the app context must live as long as the stream, not the endpoint call
+        with flask_app.app_context():
+            try:
+                async for event, event_data in stream_answer_from_model(**fields):
+                    yield format_sse(event, event_data)
+            except Exception as e:
+                logging.error(f"<stream_answer> Error in streaming answer for {fields['model_id']}: {e}")
+                yield format_sse("error", {"error": str(e)})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def stream_question_jobs(request: Request):
+    question_id = request.path_params["question_id"]
+
+    async def events():
+        # polls the job table without holding a thread between polls
+        with flask_app.app_context():
+            async for event, event_data in job_events(question_id, timeout=config.JOBS_STREAM_TIMEOUT):
+                yield format_sse(event, event_data)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def vote_endpoint(action: str, message: str):
+    """
+    build the endpoint of a vote route; see VOTE_ACTIONS.
+    accept is tranlated to number of upvotes, reject to number of downvotes.
+    """
+    @with_app_context
+    async def endpoint(request: Request):
+        try:
+            answer_id = parse_answer_id(await read_json(request))
+        except ValueError as e:
+            return JSONResponse({"error": str(e)}, status_code=400)
+
+        try:
+            await record_votes_async([(answer_id, action)])
+        except AnswerNotFound as e:
+            return JSONResponse({"error": str(e)}, status_code=404)
+        except Exception as e:
+            logging.error(f"<{action}_answer> Error in {action} for {answer_id}: {e}")
+            return JSONResponse({"error": str(e)}, status_code=500)
+
+        return JSONResponse({"message": message})
+
+    endpoint.__name__ = f"{action}_answer"
+    return endpoint
+
+
+@with_app_context
+async def vote_answers_in_bulk(request: Request):
+    try:
+        votes = parse_votes(await read_json(request))
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    try:
+        await record_votes_async(votes)
+    except AnswerNotFound as e:
+        return JSONResponse({"error": str(e)}, status_code=404)
+    except Exception as e:
+        logging.error(f"<vote_answers> Error in applying {len(votes)} votes: {e}")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+    return JSONResponse({"message": f"Applied {len(votes)} votes"})
+
+
+@with_app_context
+async def add_feedback(request: Request):
+    try:
+        data = await read_json(request)
+        answer_id = parse_answer_id(data)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    try:
+        await run_db(
+            upsert_feedback,
+            answer_id,
+            data.get("predefined_feedbacks", []),
+            data.get("text_feedback"),
+        )
+    except Exception as e:
+        logging.error(f"<add_feedback> Error in upseting feedback for {answer_id}: {e}")
+        return JSONResponse({"error": "Database operation failed"}, status_code=500)
+
+    return JSONResponse({"message": "Feedback upserted successfully"})
+
+
+routes = [
+    Route("/api/answer", get_answer, methods=["POST"]),
+    Route("/api/answer/stream", stream_answer, methods=["POST"]),
+    Route("/api/answers", get_answers, methods=["POST"]),
+    Route("/api/answers/accept", vote_endpoint("accept", "Accept successfully"), methods=["POST"]),
+    Route("/api/answers/unaccept", vote_endpoint("unaccept", "Unaccept successfully"), methods=["POST"]),
+    Route("/api/answers/reject", vote_endpoint("reject", "Reject successfully"), methods=["POST"]),
+    Route("/api/answers/unreject", vote_endpoint("unreject", "Unreject successfully"), methods=["POST"]),
+    Route("/api/answers/votes", vote_answers_in_bulk, methods=["POST"]),
+    Route("/api/answers/feedback", add_feedback, methods=["POST"]),
+    Route("/api/questions/{question_id:int}/jobs/stream", stream_question_jobs, methods=["GET"]),
+    # everything else is served by the flask app
+    Mount("/", app=WsgiToAsgi(flask_app)),
+]
+
+@contextlib.asynccontextmanager
+async def lifespan(app: Starlette):
+    start_background_services(flask_app)
+    yield
+    # write the buffered counters before the worker exits
+    await asyncio.to_thread(counter_buffer.stop)
+    # finish the jobs in flight; jobs not yet claimed stay queued
+    await asyncio.to_thread(job_worker.stop)
+
+
+asgi_app = Starlette(
+    routes=routes,
+    lifespan=lifespan,
+    middleware=[
+        # outermost, so the request id is set for the flask routes too
+        Middleware(tracing.TracingMiddleware),
+        Middleware(
+            CORSMiddleware,
+            allow_origin_regex=CORS_ORIGIN_REGEX,
+            allow_credentials=True,
+            allow_methods=["*"],
+            allow_headers=["*"],
+        )
+    ],
+)
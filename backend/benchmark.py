@@ -0,0 +1,299 @@
+"""
+End-to-end load test of the API.
+
+`flask benchmark run` starts user sessions at a fixed rate: each one posts
+a question, asks a random model for an answer, and then votes on the answer
+and sends feedback on it with the configured probabilities. Sessions are
+started on schedule whether or not earlier ones have finished (open loop),
+so a slow server shows up as higher latency instead of a lower request rate.
+
+Meant for a server running app_config.benchmark.yaml, whose mock models cost
+no API credit (--url), or for the app in this process (the default), which
+is quicker to start but shares the CPU with the load generator. The report
+has the throughput, latency percentiles and errors of each endpoint and the
+database lock counters, and is saved as JSON so that --compare can flag
+regressions against the report of a previous release.
+"""
+import asyncio
+import json
+import os
+import random
+import subprocess
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Optional
+
+import click
+import httpx
+from flask.cli import AppGroup
+
+from config import config
+
+TASKS = ("Code Completion", "Code Repair", "Code Summarization")
+LANGUAGES = ("Python", "Java", "JavaScript", "C++")
+FEEDBACKS = ("Incorrect", "Incomplete", "Hard to read")
+
+
+def percentile(values: list[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class LoadTest:
+    """Drives user sessions against the API and records every request."""
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        *,
+        rps: float,
+        duration: float,
+        vote_probability: float,
+        feedback_probability: float,
+        max_sessions: int,
+        seed: Optional[int]
+    ):
+        """
+        :param client: the client of the API under test
+        :param rps: the target requests per second, over all endpoints
+        :param duration: seconds to start new sessions for
+        :param vote_probability: share of sessions voting on their answer
+        :param feedback_probability: share of sessions sending feedback
+        :param max_sessions: sessions in flight past which new ones are dropped
+        :param seed: of the session contents and choices
+        """
+        self.client = client
+        self.rps = rps
+        self.duration = duration
+        self.vote_probability = vote_probability
+        self.feedback_probability = feedback_probability
+        self.max_sessions = max_sessions
+        self.rng = random.Random(seed)
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.statuses: dict[str, dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.dropped_sessions = 0
+        self.model_ids: list[str] = []
+
+    async def _request(self, endpoint: str, method: str, path: str, **kwargs) -> Optional[httpx.Response]:
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, path, **kwargs)
+        except httpx.HTTPError as e:
+            self.statuses[endpoint][type(e).__name__] += 1
+            return None
+        self.latencies[endpoint].append(time.perf_counter() - start)
+        self.statuses[endpoint][str(response.status_code)] += 1
+        return response
+
+    async def _session(self, number: int) -> None:
+        task = self.rng.choice(TASKS)
+        language = self.rng.choice(LANGUAGES)
+        # unique content, so the answer cache and deduplication do not short-cut the models
+        content = f"def benchmark_{number}_{self.rng.getrandbits(32)}(values):\n    return sorted(values)[{number % 7}]"
+        question = {"content": content, "task": task, "language": language}
+
+        response = await self._request("question", "POST", "/api/question", json=question)
+        if response is None or response.status_code != 200:
+            return
+        response = await self._request("answer", "POST", "/api/answer", json={
+            **question,
+            "modelId": self.rng.choice(self.model_ids),
+            "questionId": response.json(),
+            "frontendOrder": 0,
+        })
+        if response is None or response.status_code != 200:
+            return
+        answer_id = response.json()["answer_id"]
+
+        if self.rng.random() < self.vote_probability:
+            action = self.rng.choice(("accept", "reject"))
+            await self._request("vote", "POST", f"/api/answers/{action}", json={"answer_id": answer_id})
+        if self.rng.random() < self.feedback_probability:
+            await self._request("feedback", "POST", "/api/answers/feedback", json={
+                "answer_id": answer_id,
+                "predefined_feedbacks": [self.rng.choice(FEEDBACKS)],
+                "text_feedback": "benchmark",
+            })
+
+    async def _wait_for_models(self, timeout: float) -> list[str]:
+        # models are offered once they pass the warm-up of the server
+        deadline = time.monotonic() + timeout
+        while True:
+            response = await self.client.get("/api/models/ids")
+            response.raise_for_status()
+            if response.json() or time.monotonic() >= deadline:
+                return response.json()
+            await asyncio.sleep(0.5)
+
+    async def run(self) -> dict:
+        self.model_ids = await self._wait_for_models(config.LLM_WARMUP_DEADLINE)
+        if not self.model_ids:
+            raise click.ClickException("the server has no available models")
+        db_before = (await self.client.get("/api/db/stats")).json()
+
+        # sessions send 2 requests, plus the vote and the feedback some of the time
+        requests_per_session = 2 + self.vote_probability + self.feedback_probability
+        interval = requests_per_session / self.rps
+        sessions: set[asyncio.Task] = set()
+        start = time.perf_counter()
+        number = 0
+        while time.perf_counter() - start < self.duration:
+            if len(sessions) >= self.max_sessions:
+                self.dropped_sessions += 1
+            else:
+                session = asyncio.create_task(self._session(number))
+                sessions.add(session)
+                session.add_done_callback(sessions.discard)
+            number += 1
+            await asyncio.sleep(max(0.0, start + number * interval - time.perf_counter()))
+        if sessions:
+            await asyncio.gather(*sessions)
+        elapsed = time.perf_counter() - start
+
+        db_after = (await self.client.get("/api/db/stats")).json()
+        return self.report(elapsed, db_before, db_after)
+
+    def report(self, elapsed: float, db_before: dict, db_after: dict) -> dict:
+        endpoints = {}
+        for endpoint in sorted(self.statuses):
+            latencies = self.latencies[endpoint]
+            statuses = dict(self.statuses[endpoint])
+            requests = sum(statuses.values())
+            errors = sum(count for status, count in statuses.items() if not status.startswith("2"))
+            endpoints[endpoint] = {
+                "requests": requests,
+                "throughput": requests / elapsed,
+                "error_rate": errors / requests if requests else 0.0,
+                "statuses": statuses,
+                "p50": percentile(latencies, 0.50),
+                "p90": percentile(latencies, 0.90),
+                "p99": percentile(latencies, 0.99),
+                "max": max(latencies) if latencies else None,
+            }
+        requests = sum(endpoint["requests"] for endpoint in endpoints.values())
+        return {
+            "target_rps": self.rps,
+            "seconds": elapsed,
+            "requests": requests,
+            "throughput": requests / elapsed,
+            "dropped_sessions": self.dropped_sessions,
+            "endpoints": endpoints,
+            "database": {
+                "locked_errors": db_after.get("locked_errors", 0) - db_before.get("locked_errors", 0),
+                "writer_batches": db_after.get("batches", 0) - db_before.get("batches", 0),
+                "avg_batch": db_after.get("avg_batch"),
+                "avg_commit_ms": db_after.get("avg_commit_ms"),
+                "counter_flushes": (
+                    db_after.get("counters", {}).get("flushes", 0) - db_before.get("counters", {}).get("flushes", 0)
+                ),
+            },
+        }
+
+
+def compare(report: dict, baseline: dict, *, threshold: float) -> list[str]:
+    """
+    :param threshold: the relative change counted as a regression, e.g. 0.1
+    :return: the regressions of a report against a baseline report
+    """
+    regressions = []
+    if report["throughput"] < baseline["throughput"] * (1 - threshold):
+        regressions.append(f"throughput {baseline['throughput']:.1f} -> {report['throughput']:.1f} requests/s")
+    for endpoint, result in report["endpoints"].items():
+        before = baseline["endpoints"].get(endpoint)
+        if before is None:
+            continue
+        for key in ("p50", "p99"):
+            if result[key] is not None and before[key] and result[key] > before[key] * (1 + threshold):
+                regressions.append(f"{endpoint} {key} {before[key] * 1000:.0f} -> {result[key] * 1000:.0f} ms")
+        if result["error_rate"] > before["error_rate"] + threshold * max(before["error_rate"], 0.01):
+            regressions.append(f"{endpoint} error rate {before['error_rate']:.2%} -> {result['error_rate']:.2%}")
+    return regressions
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def _run_load_test(url: Optional[str], timeout: float, **options) -> dict:
+    if url:
+        transport = None
+    else:
+        from asgi import asgi_app
+        transport = httpx.ASGITransport(app=asgi_app)
+        url = "http://benchmark"
+    limits = httpx.Limits(max_connections=options["max_sessions"], max_keepalive_connections=options["max_sessions"])
+    async with httpx.AsyncClient(base_url=url, transport=transport, timeout=timeout, limits=limits) as client:
+        return await LoadTest(client, **options).run()
+
+
+benchmark_cli = AppGroup("benchmark", help="Load test the API.")
+
+
+@benchmark_cli.command("run")
+@click.option("--url", default=None, help="Base URL of the server under test. Default: this app, in process.")
+@click.option("--rps", type=float, default=10, show_default=True, help="Target requests per second.")
+@click.option("--duration", type=float, default=60, show_default=True, help="Seconds to send requests for.")
+@click.option("--vote-probability", type=float, default=0.5, show_default=True)
+@click.option("--feedback-probability", type=float, default=0.2, show_default=True)
+@click.option("--max-sessions", type=int, default=500, show_default=True, help="Sessions in flight before new ones are dropped.")
+@click.option("--timeout", type=float, default=120, show_default=True, help="Seconds per request.")
+@click.option("--seed", type=int, default=None)
+@click.option("--output", type=click.Path(dir_okay=False), default=None,
+              help="Report file. Default: benchmarks/<time>.json in the instance directory.")
+@click.option("--compare", "baseline_path", type=click.Path(exists=True, dir_okay=False), default=None,
+              help="Report of a previous run to check for regressions.")
+@click.option("--threshold", type=float, default=0.1, show_default=True, help="Relative change counted as a regression.")
+def run_command(url, rps, duration, vote_probability, feedback_probability, max_sessions, timeout, seed, output,
+                baseline_path, threshold):
+    """Load test the question, answer, vote and feedback endpoints."""
+    started_at = datetime.now(timezone.utc)
+    report = asyncio.run(_run_load_test(
+        url,
+        timeout,
+        rps=rps,
+        duration=duration,
+        vote_probability=vote_probability,
+        feedback_probability=feedback_probability,
+        max_sessions=max_sessions,
+        seed=seed,
+    ))
+    report["started_at"] = started_at.isoformat()
+    report["commit"] = _git_commit()
+    report["url"] = url or "in-process"
+
+    if output is None:
+        directory = os.path.join(config.INSTANCE_PATH, "benchmarks")
+        os.makedirs(directory, exist_ok=True)
+        output = os.path.join(directory, f"{started_at:%Y%m%dT%H%M%SZ}.json")
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+
+    click.echo(f"{report['requests']} requests in {report['seconds']:.1f}s: {report['throughput']:.1f} requests/s "
+               f"(target {rps}), {report['dropped_sessions']} sessions dropped")
+    for endpoint, result in report["endpoints"].items():
+        click.echo(
+            f"  {endpoint:<9} {result['requests']:>6} requests  errors {result['error_rate']:6.2%}  "
+            + "  ".join(
+                f"{key} {result[key] * 1000:7.0f} ms" if result[key] is not None else f"{key}       - ms"
+                for key in ("p50", "p90", "p99")
+            )
+        )
+    click.echo(f"  database: {report['database']}")
+    click.echo(f"report saved to {output}")
+
+    if baseline_path:
+        with open(baseline_path) as file:
+            regressions = compare(report, json.load(file), threshold=threshold)
+        for regression in regressions:
+            click.echo(f"REGRESSION {regression}")
+        if regressions:
+            raise SystemExit(1)
+        click.echo(f"no regressions against {baseline_path}")
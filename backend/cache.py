@@ -0,0 +1,249 @@
+import asyncio
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Optional
+
+from config import config
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    Normalize the whitespace of a prompt for cache lookups.
+    Line endings, trailing spaces and runs of blank lines are collapsed;
+    indentation is kept because it is meaningful in code.
+    :param prompt: the formatted prompt
+    :return: the normalized prompt
+    """
+    lines = [line.rstrip() for line in prompt.replace("\r\n", "\n").split("\n")]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+
+def make_cache_key(model_id: str, prompt: str, prompt_version: str) -> str:
+    """
+    Build the cache key of a generation
+    :param model_id: the id of the model
+    :param prompt: the text of the prompt
+    :param prompt_version: the version of the task prompt, see prompts.py
+    :return: a hex digest identifying the (model, prompt) pair
+    """
+    digest = hashlib.sha256()
+    digest.update(model_id.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(prompt_version.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(normalize_prompt(prompt).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class CacheTier(ABC):
+    """A single storage layer of the answer cache."""
+
+    name = "tier"
+    # tiers doing I/O are run on a thread, off the event loop
+    blocking = False
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value: str) -> None:
+        ...
+
+
+class LRUCacheTier(CacheTier):
+    """In-process tier keeping the most recently used answers."""
+
+    name = "memory"
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class SQLiteCacheTier(CacheTier):
+    """
+    Persistent tier shared by all workers on the host.
+    Entries expire after ttl seconds; once the table grows past max_entries
+    the least recently used entries are evicted.
+    """
+
+    name = "sqlite"
+    blocking = True
+
+    def __init__(self, path: str, ttl: int, max_entries: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS answer_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_answer_cache_accessed_at ON answer_cache (accessed_at)"
+            )
+            self._size = connection.execute("SELECT COUNT(*) FROM answer_cache").fetchone()[0]
+
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite connections cannot be shared between threads
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT value, created_at FROM answer_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if now - created_at > self.ttl:
+                connection.execute("DELETE FROM answer_cache WHERE key = ?", (key,))
+                return None
+            connection.execute("UPDATE answer_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        now = time.time()
+        with self._connect() as connection:
+            updated = connection.execute(
+                "UPDATE answer_cache SET value = ?, created_at = ?, accessed_at = ? WHERE key = ?",
+                (value, now, now, key),
+            ).rowcount
+            if updated:
+                return
+            # only a new key grows the table; another worker may have added it in between
+            connection.execute(
+                "INSERT OR REPLACE INTO answer_cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            with self._lock:
+                self._size += 1
+                if self._size <= self.max_entries:
+                    return
+                self._evict(connection, now)
+
+    def _evict(self, connection: sqlite3.Connection, now: float) -> None:
+        connection.execute("DELETE FROM answer_cache WHERE created_at < ?", (now - self.ttl,))
+        # evict down to 90% of the limit so eviction does not run on every write
+        size = connection.execute("SELECT COUNT(*) FROM answer_cache").fetchone()[0]
+        excess = size - int(self.max_entries * 0.9)
+        if excess > 0:
+            connection.execute(
+                "DELETE FROM answer_cache WHERE key IN "
+                "(SELECT key FROM answer_cache ORDER BY accessed_at LIMIT ?)",
+                (excess,),
+            )
+            size -= excess
+        self._size = size
+
+
+class AnswerCache:
+    """
+    Answer cache in front of the LLM providers.
+    Tiers are looked up in order; a hit in a slower tier is copied into the
+    faster ones. Blocking tiers run on a thread, so a locked cache database
+    does not stall the event loop.
+    """
+
+    def __init__(self, tiers: list[CacheTier]):
+        self.tiers = tiers
+        self._lock = threading.Lock()
+        self._hits = {tier.name: 0 for tier in tiers}
+        self._misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.tiers)
+
+    @staticmethod
+    async def _call(tier: CacheTier, method, *args):
+        if tier.blocking:
+            return await asyncio.to_thread(method, *args)
+        return method(*args)
+
+    async def get(self, key: str) -> Optional[str]:
+        for index, tier in enumerate(self.tiers):
+            try:
+                value = await self._call(tier, tier.get, key)
+            except Exception as e:
+                logging.error(f"<answer_cache> Error reading {tier.name} tier: {e}")
+                continue
+            if value is not None:
+                for faster_tier in self.tiers[:index]:
+                    await self._set_tier(faster_tier, key, value)
+                with self._lock:
+                    self._hits[tier.name] += 1
+                return value
+        with self._lock:
+            self._misses += 1
+        return None
+
+    async def set(self, key: str, value: str) -> None:
+        for tier in self.tiers:
+            await self._set_tier(tier, key, value)
+
+    async def _set_tier(self, tier: CacheTier, key: str, value: str) -> None:
+        try:
+            await self._call(tier, tier.set, key, value)
+        except Exception as e:
+            logging.error(f"<answer_cache> Error writing {tier.name} tier: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = sum(self._hits.values())
+            lookups = hits + self._misses
+            return {
+                "enabled": self.enabled,
+                "hits": dict(self._hits),
+                "misses": self._misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+            }
+
+
+def create_answer_cache() -> AnswerCache:
+    tiers: list[CacheTier] = []
+    if config.CACHE_ENABLED:
+        tiers.append(LRUCacheTier(config.CACHE_MEMORY_MAX_ENTRIES))
+        if config.CACHE_SQLITE_ENABLED:
+            tiers.append(
+                SQLiteCacheTier(
+                    config.CACHE_SQLITE_PATH,
+                    ttl=config.CACHE_TTL,
+                    max_entries=config.CACHE_SQLITE_MAX_ENTRIES,
+                )
+            )
+    return AnswerCache(tiers)
+
+
+answer_cache = create_answer_cache()
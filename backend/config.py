@@ -1,20 +1,20 @@
 import os
+import functools
+import threading
+from collections.abc import Mapping
 import yaml
 from dotenv import load_dotenv
-from langchain_huggingface import ChatHuggingFace, HuggingFaceEndpoint
-from langchain_openai import ChatOpenAI
-from langchain_anthropic import ChatAnthropic
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain.prompts import ChatPromptTemplate
-from langchain_google_vertexai import ChatVertexAI
-import vertexai
+from providers import PROVIDERS, create_llm_client
 import logging
-from logging.handlers import RotatingFileHandler
+from logs import setup_logging
 
 
 class Config:
     def __init__(self):
-        if os.getenv('FLASK_ENV') == 'production':
+        if os.getenv('APP_CONFIG'):
+            # e.g. APP_CONFIG=app_config.benchmark.yaml for load tests
+            config_file = os.getenv('APP_CONFIG')
+        elif os.getenv('FLASK_ENV') == 'production':
             config_file = "app_config.production.yaml"
         else:
             config_file = "app_config.development.yaml"
@@ -39,24 +39,120 @@ class Config:
         self.SQLALCHEMY_FILENAME = config_data.get("database", {}).get(
             "file_name", "app.db"
         )
+        sqlite_config = config_data.get("database", {}).get("sqlite", {})
+        self.DB_JOURNAL_MODE = sqlite_config.get("journal_mode", "WAL")
+        self.DB_SYNCHRONOUS = sqlite_config.get("synchronous", "NORMAL")
+        self.DB_BUSY_TIMEOUT = sqlite_config.get("busy_timeout", 5000)  # milliseconds
+        pool_config = config_data.get("database", {}).get("pool", {})
+        self.DB_POOL_SIZE = pool_config.get("size", 5)
+        self.DB_POOL_MAX_OVERFLOW = pool_config.get("max_overflow", 10)
+        self.DB_POOL_TIMEOUT = pool_config.get("timeout", 30)
+        self.DB_POOL_RECYCLE = pool_config.get("recycle", 3600)
+        writer_config = config_data.get("database", {}).get("writer", {})
+        self.DB_WRITER_ENABLED = writer_config.get("enabled", False)
+        self.DB_WRITER_MAX_BATCH = writer_config.get("max_batch", 64)
+        self.DB_WRITER_MAX_DELAY = writer_config.get("max_delay", 5)  # milliseconds
 
-        # Log settings
-        self.LOGFILE = os.path.join(self.INSTANCE_PATH, config_data.get("logging", {}).get("file_name", "logfile.log"))
+        # Write-behind buffer of vote and language counters
+        counters_config = config_data.get("counters", {})
+        self.COUNTERS_ENABLED = counters_config.get("enabled", False)
+        self.COUNTERS_FLUSH_INTERVAL = counters_config.get("flush_interval", 500)  # milliseconds
+        self.COUNTERS_MAX_EVENTS = counters_config.get("max_events", 500)
+        self.COUNTERS_MAX_PENDING = counters_config.get("max_pending", 5000)
 
-        if not config_data.get("logging", {}).get("log_to_file", False):
-            # Log to console
-            log_handler = logging.StreamHandler()
-        else:
-            log_handler = RotatingFileHandler(self.LOGFILE, maxBytes=10000, backupCount=3)
+        # Leaderboard settings
+        leaderboard_config = config_data.get("leaderboard", {})
+        self.LEADERBOARD_CACHE_TTL = leaderboard_config.get("cache_ttl", 30)
+        self.LEADERBOARD_BOOTSTRAP_SAMPLES = leaderboard_config.get("bootstrap_samples", 1000)
+
+        # Near-duplicate question detection
+        dedup_config = config_data.get("dedup", {})
+        self.DEDUP_ENABLED = dedup_config.get("enabled", True)
+        self.DEDUP_NUM_PERM = dedup_config.get("num_perm", 128)
+        self.DEDUP_BANDS = dedup_config.get("bands", 32)
+        self.DEDUP_SHINGLE_SIZE = dedup_config.get("shingle_size", 3)
+        self.DEDUP_MIN_SIMILARITY = dedup_config.get("min_similarity", 0.5)
+        self.DEDUP_REUSE_ENABLED = dedup_config.get("reuse", {}).get("enabled", False)
+        self.DEDUP_REUSE_MIN_SIMILARITY = dedup_config.get("reuse", {}).get("min_similarity", 0.9)
+        self.DEDUP_REUSE_MIN_SCORE = dedup_config.get("reuse", {}).get("min_score", 2)
+
+        # Replay of failed model calls
+        replay_config = config_data.get("replay", {})
+        self.REPLAY_ENABLED = replay_config.get("enabled", False)
+        self.REPLAY_INTERVAL = replay_config.get("interval", 300)  # seconds
+        self.REPLAY_BATCH_SIZE = replay_config.get("batch_size", 100)
+        self.REPLAY_MAX_ATTEMPTS = replay_config.get("max_attempts", 5)
+        self.REPLAY_CONCURRENCY = replay_config.get("concurrency", 2)
+        self.REPLAY_MIN_AGE = replay_config.get("min_age", 600)  # seconds
+        self.REPLAY_LEASE = replay_config.get("lease", 600)  # seconds
 
-        log_handler.setLevel(logging.INFO)
+        # Asynchronous answer jobs
+        jobs_config = config_data.get("jobs", {})
+        self.JOBS_ENABLED = jobs_config.get("enabled", True)
+        self.JOBS_WORKER_IN_APP = jobs_config.get("worker_in_app", True)
+        self.JOBS_CONCURRENCY = jobs_config.get("concurrency", 8)
+        self.JOBS_POLL_INTERVAL = jobs_config.get("poll_interval", 1.0)  # seconds
+        self.JOBS_LEASE = jobs_config.get("lease", 600)  # seconds
+        self.JOBS_MAX_ATTEMPTS = jobs_config.get("max_attempts", 3)
+        self.JOBS_STREAM_TIMEOUT = jobs_config.get("stream_timeout", 600)  # seconds
 
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        log_handler.setFormatter(formatter)
+        # Dataset export
+        export_config = config_data.get("export", {})
+        self.EXPORT_CHUNK_SIZE = export_config.get("chunk_size", 5000)
+        # bearer token of GET /api/export; the endpoint is disabled without it
+        self.EXPORT_TOKEN = os.getenv("EXPORT_TOKEN")
 
-        root_logger = logging.getLogger()
-        root_logger.addHandler(log_handler)
-        root_logger.setLevel(logging.INFO)
+        # Metrics of the model calls, served by GET /metrics
+        metrics_config = config_data.get("metrics", {})
+        self.METRICS_ENABLED = metrics_config.get("enabled", True)
+        self.METRICS_STORE_USAGE = metrics_config.get("store_usage", False)
+        self.METRICS_DIRECTORY = (
+            os.path.join(self.INSTANCE_PATH, metrics_config["directory"]) if metrics_config.get("directory") else None
+        )
+        self.METRICS_FLUSH_INTERVAL = metrics_config.get("flush_interval", 5)
+
+        # Request tracing, see tracing.py
+        tracing_config = config_data.get("tracing", {})
+        self.TRACING_ENABLED = tracing_config.get("enabled", False)
+        self.TRACING_SAMPLE_RATE = tracing_config.get("sample_rate", 0.01)
+        self.TRACING_SLOW_THRESHOLD = tracing_config.get("slow_threshold", 30)
+        self.TRACING_FILE = os.path.join(self.INSTANCE_PATH, tracing_config.get("file_name", "traces.jsonl"))
+        self.TRACING_MAX_BYTES = tracing_config.get("max_bytes", 100 * 1024 * 1024)
+        self.TRACING_SERVICE_NAME = tracing_config.get("service_name", "lmcode-backend")
+
+        # Answer cache settings
+        cache_config = config_data.get("cache", {})
+        self.CACHE_ENABLED = cache_config.get("enabled", False)
+        self.CACHE_MEMORY_MAX_ENTRIES = cache_config.get("memory", {}).get("max_entries", 1024)
+        self.CACHE_SQLITE_ENABLED = cache_config.get("sqlite", {}).get("enabled", False)
+        self.CACHE_SQLITE_PATH = os.path.join(
+            self.INSTANCE_PATH, cache_config.get("sqlite", {}).get("file_name", "answer_cache.db")
+        )
+        self.CACHE_TTL = cache_config.get("sqlite", {}).get("ttl", 7 * 24 * 3600)
+        self.CACHE_SQLITE_MAX_ENTRIES = cache_config.get("sqlite", {}).get("max_entries", 100000)
+
+        # Log settings
+        logging_config = config_data.get("logging", {})
+        self.LOGFILE = os.path.join(self.INSTANCE_PATH, logging_config.get("file_name", "logfile.log"))
+        self.LOG_TO_FILE = logging_config.get("log_to_file", False)
+        self.LOG_LEVEL = logging_config.get("level", "INFO")
+        self.LOG_FORMAT = logging_config.get("format", "text")
+        self.LOG_MAX_BYTES = logging_config.get("max_bytes", 50 * 1024 * 1024)
+        self.LOG_BACKUP_COUNT = logging_config.get("backup_count", 5)
+        self.LOG_QUEUE_SIZE = logging_config.get("queue_size", 10000)
+        self.LOG_MAX_FIELD_LENGTH = logging_config.get("max_field_length", 2000)
+        self.LOG_LEVELS = logging_config.get("levels", {})
+
+        setup_logging(
+            log_file=self.LOGFILE if self.LOG_TO_FILE else None,
+            level=self.LOG_LEVEL,
+            log_format=self.LOG_FORMAT,
+            max_bytes=self.LOG_MAX_BYTES,
+            backup_count=self.LOG_BACKUP_COUNT,
+            queue_size=self.LOG_QUEUE_SIZE,
+            max_field_length=self.LOG_MAX_FIELD_LENGTH,
+            levels=self.LOG_LEVELS,
+        )
 
         # API Keys
         self.OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -78,45 +174,27 @@ class Config:
 
         # LLM settings
 
-        self.LLM_DICT = {
-            "OPENAI": [
-                {
-                    "id": model.get("id"),
-                    "name": model.get("name"),
-                    "max_tokens": model.get("max_tokens", 1000),
-                }
-                for model in config_data.get("llm", {}).get("openai", [])
-            ],
-            "ANTHROPIC": [
-                {
-                    "id": model.get("id"),
-                    "name": model.get("name"),
-                    "max_tokens": model.get("max_tokens", 1000),
-                }
-                for model in config_data.get("llm", {}).get("anthropic", [])
-            ],
-            "HF": [
-                {
-                    "id": model.get("id"),
-                    "name": model.get("name"),
-                    "max_tokens": model.get("max_tokens", 1000),
-                }
-                for model in config_data.get("llm", {}).get("hf", [])
-            ],
-            "GEMINI": [
-                {
-                    "id": model.get("id"),
-                    "name": model.get("name"),
-                    "max_tokens": model.get("max_tokens", 1000),
-                }
-                for model in config_data.get("llm", {}).get("gemini", [])
-            ],
-        }
+        # provider name -> models of the provider; only registered providers are used
+        self.LLM_DICT = {}
+        for source, models in config_data.get("llm", {}).items():
+            if not isinstance(models, list):
+                continue
+            if source not in PROVIDERS:
+                logging.error(f"Unknown LLM provider {source}, skipping its models")
+                continue
+            self.LLM_DICT[source] = [
+                {**model, "max_tokens": model.get("max_tokens", 1000)}
+                for model in models
+            ]
 
         self.LLM_ID_NAME = {}
-        for _, models in self.LLM_DICT.items():
+        self.LLM_ID_SOURCE = {}  # model id -> provider name
+        self.LLM_ID_CONFIG = {}  # model id -> model entry of the config
+        for source, models in self.LLM_DICT.items():
             for model in models:
                 self.LLM_ID_NAME[model.get("id")] = model.get("name")
+                self.LLM_ID_SOURCE[model.get("id")] = source
+                self.LLM_ID_CONFIG[model.get("id")] = model
 
         google_ai_platform_config = config_data.get("google-ai-platform", {})
         self.IS_GOOGLE_AI_PLATFORM = google_ai_platform_config.get("active", False)
@@ -125,122 +203,88 @@ class Config:
         )
         self.GOOGLE_AI_PLATFORM_LOCATION = google_ai_platform_config.get("location", "")
         if self.IS_GOOGLE_AI_PLATFORM:
-            vertexai.init(
-                project=self.GOOGLE_AI_PLATFORM_PROJECT_NAME,
-                location=self.GOOGLE_AI_PLATFORM_LOCATION,
-            )
+            # vertexai is initialized when the first Gemini client is created
             logging.info("Using Google AI Platform")
         else:
             logging.info("Using Gemini through developer platform")
 
         self.LLM_TIMEOUT = config_data.get("llm", {}).get("timeout", 60)
         self.LLM_RETRIES = config_data.get("llm", {}).get("retries", 3)
+        self.LLM_RETRY_BACKOFF = config_data.get("llm", {}).get("retry_backoff", 1)
+        self.LLM_RETRY_BACKOFF_MAX = config_data.get("llm", {}).get("retry_backoff_max", 20)
 
-        # These should be consistent with frontend passing in
-        system_prompt = (
-            "system",
-            "You are a programming assistant skilled in different tasks like code completion, translation, and explanation.",
-        )
-        self.TASK_PROMPTS = {
-            "Code Completion": ChatPromptTemplate(
-                [
-                    system_prompt,
-                    (
-                        "human",
-                        "Complete the code snippet written in {language}:\n{content}",
-                    ),
-                ]
-            ),
-            "Code Translation": ChatPromptTemplate(
-                [
-                    system_prompt,
-                    (
-                        "human",
-                        "Translate the code snippet from {source_language} to {target_language}:\n{content}",
-                    ),
-                ]
-            ),
-            "Code Repair": ChatPromptTemplate(
-                [
-                    system_prompt,
-                    ("human", "Fix the code snippet written in {language}:\n{content}"),
-                ]
-            ),
-            "Text-to-Code Generation": ChatPromptTemplate(
-                [
-                    system_prompt,
-                    (
-                        "human",
-                        "Follow the instructions below to write a code snippet:\n{content}",
-                    ),
-                ]
-            ),
-            "Code Summarization": ChatPromptTemplate(
-                [
-                    system_prompt,
-                    (
-                        "human",
-                        "Explain the code snippet written in {language}:\n{content}",
-                    ),
-                ]
-            ),
-            "Input/Output Examples": ChatPromptTemplate(
-                [
-                    system_prompt,
-                    (
-                        "human",
-                        "Provide code snippet that satisfies the input and output examples written in {language}:\n{content}",
-                    ),
-                ]
-            ),
+        # Circuit breaker: stop calling a model while most of its calls fail
+        circuit_config = config_data.get("llm", {}).get("circuit_breaker", {})
+        self.LLM_CIRCUIT_ENABLED = circuit_config.get("enabled", True)
+        self.LLM_CIRCUIT_WINDOW = circuit_config.get("window", 60)
+        self.LLM_CIRCUIT_MIN_CALLS = circuit_config.get("min_calls", 5)
+        self.LLM_CIRCUIT_ERROR_RATE = circuit_config.get("error_rate", 0.5)
+        self.LLM_CIRCUIT_OPEN_SECONDS = circuit_config.get("open_seconds", 30)
+        self.LLM_CIRCUIT_HALF_OPEN_PROBES = circuit_config.get("half_open_probes", 1)
+
+        # Hedging: duplicate calls that run longer than the model usually takes
+        hedging_config = config_data.get("llm", {}).get("hedging", {})
+        self.LLM_HEDGING_ENABLED = hedging_config.get("enabled", False)
+        self.LLM_HEDGING_PERCENTILE = hedging_config.get("percentile", 95)
+        self.LLM_HEDGING_MIN_SAMPLES = hedging_config.get("min_samples", 20)
+
+        # Concurrency and rate limits, per provider here and per model in the model entries
+        limits_config = config_data.get("llm", {}).get("limits", {})
+        self.LLM_LIMITS_MAX_WAIT = limits_config.get("max_wait", 30)
+        self.LLM_PROVIDER_LIMITS = {
+            source: limits for source, limits in limits_config.items() if isinstance(limits, dict)
         }
 
-        # setup all client chains
-        self.LLM_CHAINS = {}  # dict of model id to llm
+        # Health check settings; clients are probed by a background warm-up
+        warmup_config = config_data.get("llm", {}).get("warmup", {})
+        self.LLM_WARMUP_ENABLED = warmup_config.get("enabled", True)
+        self.LLM_WARMUP_DEADLINE = warmup_config.get("deadline", 30)
+        self.LLM_WARMUP_RETRY_INTERVAL = warmup_config.get("retry_interval", 300)
 
-        for source, models in self.LLM_DICT.items():
-            for model in models:
-                try:
-                    # Initialize the LLM client
-                    if source == "OPENAI":
-                        llm_client = ChatOpenAI(
-                            openai_api_key=self.OPENAI_API_KEY,
-                            model=model.get("id"),
-                            max_tokens=model.get("max_tokens"),
-                        )
-                    elif source == "ANTHROPIC":
-                        llm_client = ChatAnthropic(
-                            anthropic_api_key=self.ANTHROPIC_API_KEY,
-                            model=model.get("id"),
-                            max_tokens_to_sample=model.get("max_tokens"),
-                        )
-                    elif source == "HF":
-                        llm = HuggingFaceEndpoint(
-                            repo_id=model.get("id"),
-                            task="text-generation",
-                            huggingfacehub_api_token=self.HF_API_KEY,
-                            max_new_tokens=model.get("max_tokens"),
-                        )
-                        llm_client = ChatHuggingFace(llm=llm).bind(
-                            max_tokens=model.get("max_tokens")
-                        )
-                    elif source == "GEMINI":
-                        if self.IS_GOOGLE_AI_PLATFORM:
-                            llm_client = ChatVertexAI(
-                                model=model.get("id"),
-                                max_tokens=model.get("max_tokens"),
-                            )
-                        else:
-                            llm_client = ChatGoogleGenerativeAI(
-                                google_api_key=self.GEMINI_API_KEY,
-                                model=model.get("id"),
-                                max_output_tokens=model.get("max_tokens"),
-                            )
-                    llm_client.invoke("Sanity test")
-                    self.LLM_CHAINS[model.get("id")] = llm_client
-                    logging.info(f"Successfully added {source} model {model.get('id')}")
-                except Exception as e:
-                    logging.error(f"Error with {source} model {model.get('id')}: {e}")
+        # setup all client chains; each client is created on first use
+        self.LLM_CHAINS = LLMClients(
+            {
+                model.get("id"): functools.partial(self._create_llm_client, source, model)
+                for source, models in self.LLM_DICT.items()
+                for model in models
+            }
+        )
+
+    def _create_llm_client(self, source: str, model: dict):
+        llm_client = create_llm_client(source, model, self)
+        logging.info(f"Successfully added {source} model {model.get('id')}")
+        return llm_client
+
+
+class LLMClients(Mapping):
+    """
+    Mapping of model id to LLM client. Clients are only created when first
+    looked up, so configuring a model does not touch its provider.
+    """
+
+    def __init__(self, factories: dict):
+        self._factories = factories
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, model_id):
+        client = self._clients.get(model_id)
+        if client is not None:
+            return client
+        factory = self._factories[model_id]
+        with self._lock:
+            if model_id not in self._clients:
+                self._clients[model_id] = factory()
+            return self._clients[model_id]
+
+    def __contains__(self, model_id):
+        return model_id in self._factories
+
+    def __iter__(self):
+        return iter(self._factories)
+
+    def __len__(self):
+        return len(self._factories)
 
 
 config = Config()
@@ -0,0 +1,278 @@
+"""
+Write-behind buffer for vote and language suggestion counters.
+
+Votes and language suggestions are aggregated in memory and written in one
+transaction every counters.flush_interval milliseconds, or as soon as
+counters.max_events events are buffered. At most counters.max_pending
+events are ever held unwritten: past that, the request flushes the buffer
+itself before adding to it. Votes on answers that do not exist are refused
+with AnswerNotFound before they are buffered.
+"""
+import asyncio
+import atexit
+import logging
+import threading
+from typing import Optional
+
+from flask import Flask
+from sqlalchemy import bindparam, update
+from sqlalchemy.dialects.sqlite import insert
+
+from config import config
+import database
+from database import commit
+from function import VOTE_ACTIONS, AnswerNotFound, missing_answer_ids, run_db, run_read, vote_answers
+from leaderboard import record_vote_deltas
+from models import db, Answer, Feedback, Language
+
+
+def apply_counter_deltas(
+    *,
+    votes: Optional[dict[int, list[int]]] = None,
+    feedback_active: Optional[dict[int, bool]] = None,
+    languages: Optional[dict[str, int]] = None
+) -> None:
+    """
+    Write aggregated counter changes in one transaction, one statement per kind
+    :param votes: answer id -> [upvote change, downvote change]
+    :param feedback_active: answer id -> whether its feedback is active
+    :param languages: language name -> number of suggestions
+    :return: None
+    """
+    if votes:
+        answers = Answer.__table__
+        db.session.execute(
+            update(answers)
+            .where(answers.c.id == bindparam("b_id"))
+            .values(
+                upvotes=db.func.coalesce(answers.c.upvotes, 0) + bindparam("b_up"),
+                downvotes=db.func.coalesce(answers.c.downvotes, 0) + bindparam("b_down"),
+            ),
+            [{"b_id": answer_id, "b_up": up, "b_down": down} for answer_id, (up, down) in votes.items()],
+        )
+        record_vote_deltas(votes)
+    if feedback_active:
+        feedbacks = Feedback.__table__
+        db.session.execute(
+            update(feedbacks)
+            .where(feedbacks.c.answer_id == bindparam("b_id"))
+            .values(active=bindparam("b_active")),
+            [{"b_id": answer_id, "b_active": active} for answer_id, active in feedback_active.items()],
+        )
+    if languages:
+        statement = insert(Language.__table__)
+        db.session.execute(
+            statement.on_conflict_do_update(
+                index_elements=["name"],
+                set_={"count": Language.__table__.c.count + statement.excluded.count, "updated_at": db.func.now()},
+            ),
+            [{"name": name, "count": count} for name, count in languages.items()],
+        )
+    commit()
+
+
+class CounterBuffer:
+    """Aggregates counter changes in memory and flushes them on a background thread."""
+
+    def __init__(self, *, flush_interval: float, max_events: int, max_pending: int):
+        self.flush_interval = flush_interval
+        self.max_events = max_events
+        self.max_pending = max(1, max_pending)
+        self._lock = threading.Lock()
+        # only one flush writes at a time, so deltas are applied in order
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+        self._app: Optional[Flask] = None
+        self._reset()
+        self.flushes = 0
+        self.flushed_events = 0
+        self.failed_flushes = 0
+
+    def _reset(self) -> None:
+        # must be called with the lock held
+        self._votes: dict[int, list[int]] = {}
+        self._feedback_active: dict[int, bool] = {}
+        self._languages: dict[str, int] = {}
+        self._events = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, app: Flask) -> None:
+        if self._thread is not None:
+            return
+        self._app = app
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="counter-flush", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        """stop the flush thread and write what is still buffered"""
+        if self._thread is None:
+            return
+        self._stopping = True
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+
+    def add_votes(self, votes: list[tuple[int, str]], *, force: bool = False) -> bool:
+        """
+        Buffer votes
+        :param votes: (answer id, action) pairs in the order they were cast
+        :param force: buffer even if the buffer is full
+        :return: False if the buffer is full and nothing was buffered
+        """
+        with self._lock:
+            if not force and self._events >= self.max_pending:
+                return False
+            for answer_id, action in votes:
+                upvote_change, downvote_change, active = VOTE_ACTIONS[action]
+                delta = self._votes.setdefault(answer_id, [0, 0])
+                delta[0] += upvote_change
+                delta[1] += downvote_change
+                if active is not None:
+                    self._feedback_active[answer_id] = active
+            self._added(len(votes))
+        return True
+
+    def add_language(self, name: str, *, force: bool = False) -> bool:
+        """
+        Buffer a language suggestion
+        :return: False if the buffer is full and nothing was buffered
+        """
+        with self._lock:
+            if not force and self._events >= self.max_pending:
+                return False
+            self._languages[name] = self._languages.get(name, 0) + 1
+            self._added(1)
+        return True
+
+    def _added(self, events: int) -> None:
+        # must be called with the lock held
+        self._events += events
+        if self._events >= self.max_events:
+            self._wake.set()
+
+    def flush(self) -> None:
+        """
+        Write the buffered changes in one transaction. On failure they are
+        put back to be retried by the next flush.
+        :raises Exception: if the write fails
+        """
+        with self._flush_lock:
+            with self._lock:
+                votes, feedback_active, languages, events = (
+                    self._votes, self._feedback_active, self._languages, self._events
+                )
+                self._reset()
+            if not events:
+                return
+
+            try:
+                database.write(apply_counter_deltas, votes=votes, feedback_active=feedback_active, languages=languages)
+            except Exception:
+                with self._lock:
+                    self.failed_flushes += 1
+                    self._merge_back(votes, feedback_active, languages, events)
+                raise
+
+            with self._lock:
+                self.flushes += 1
+                self.flushed_events += events
+
+    def _merge_back(self, votes: dict, feedback_active: dict, languages: dict, events: int) -> None:
+        # must be called with the lock held; changes buffered since the
+        # failed flush are newer and win for feedback activity
+        for answer_id, (up, down) in votes.items():
+            delta = self._votes.setdefault(answer_id, [0, 0])
+            delta[0] += up
+            delta[1] += down
+        self._feedback_active = {**feedback_active, **self._feedback_active}
+        for name, count in languages.items():
+            self._languages[name] = self._languages.get(name, 0) + count
+        self._events += events
+
+    def _run(self) -> None:
+        with self._app.app_context():
+            while not self._stopping:
+                self._wake.wait(self.flush_interval)
+                self._wake.clear()
+                try:
+                    self.flush()
+                except Exception as e:
+                    logging.error(f"<counters> Error in flushing counters: {e}")
+            # last flush on shutdown
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"<counters> Error in flushing counters on shutdown, {self.pending()} events lost: {e}")
+
+    def pending(self) -> int:
+        with self._lock:
+            return self._events
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "running": self.running,
+                "pending": self._events,
+                "flushes": self.flushes,
+                "flushed_events": self.flushed_events,
+                "failed_flushes": self.failed_flushes,
+            }
+
+
+counter_buffer = CounterBuffer(
+    flush_interval=config.COUNTERS_FLUSH_INTERVAL / 1000,
+    max_events=config.COUNTERS_MAX_EVENTS,
+    max_pending=config.COUNTERS_MAX_PENDING,
+)
+
+
+def record_votes(votes: list[tuple[int, str]]) -> None:
+    """
+    Record votes through the buffer when it is running, otherwise write them
+    right away
+    :param votes: (answer id, action) pairs in the order they were cast
+    :raises AnswerNotFound: if an answer does not exist; no vote is recorded then
+    """
+    if not counter_buffer.running:
+        # the UPDATE of each answer finds the missing ones
+        database.write(vote_answers, votes)
+        return
+    # a buffered vote is only written later, so the answers are checked now
+    missing = missing_answer_ids([answer_id for answer_id, _ in votes])
+    if missing:
+        raise AnswerNotFound(f"answer not found: {missing}")
+    if not counter_buffer.add_votes(votes):
+        counter_buffer.flush()
+        counter_buffer.add_votes(votes, force=True)
+
+
+async def record_votes_async(votes: list[tuple[int, str]]) -> None:
+    """record_votes for async endpoints"""
+    if not counter_buffer.running:
+        await run_db(vote_answers, votes)
+        return
+    missing = await run_read(missing_answer_ids, [answer_id for answer_id, _ in votes])
+    if missing:
+        raise AnswerNotFound(f"answer not found: {missing}")
+    if not counter_buffer.add_votes(votes):
+        await asyncio.to_thread(counter_buffer.flush)
+        counter_buffer.add_votes(votes, force=True)
+
+
+def record_language(name: str) -> None:
+    """
+    Record a language suggestion through the buffer when it is running,
+    otherwise write it right away
+    """
+    if not counter_buffer.running:
+        database.write(apply_counter_deltas, languages={name: 1})
+    elif not counter_buffer.add_language(name):
+        counter_buffer.flush()
+        counter_buffer.add_language(name, force=True)
@@ -0,0 +1,331 @@
+"""
+SQLite tuning and write serialization for the flask-sqlalchemy engine.
+
+The engine is configured from the database: section of the config: WAL
+journal, synchronous level, busy timeout and pool sizing. With
+database.writer.enabled all writes of the process go through a single
+writer thread that group-commits them, so concurrent requests queue up in
+memory instead of fighting over the SQLite write lock.
+"""
+import asyncio
+import atexit
+import concurrent.futures
+import contextlib
+import logging
+import queue
+import threading
+import time
+from typing import AsyncIterator, Awaitable, Callable, Optional, TypeVar
+
+from flask import Flask
+from sqlalchemy import event, inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateColumn
+
+from config import config
+from models import db
+
+T = TypeVar("T")
+
+_local = threading.local()
+
+
+def engine_options() -> dict:
+    """
+    :return: the SQLALCHEMY_ENGINE_OPTIONS of the configured database
+    """
+    options: dict = {}
+    if not config.SQLALCHEMY_DATABASE_URI.startswith("sqlite"):
+        return options
+
+    # connections are shared with worker threads (run_db, the writer)
+    options["connect_args"] = {"check_same_thread": False, "timeout": config.DB_BUSY_TIMEOUT / 1000}
+    if ":memory:" not in config.SQLALCHEMY_DATABASE_URI:
+        options["pool_size"] = config.DB_POOL_SIZE
+        options["max_overflow"] = config.DB_POOL_MAX_OVERFLOW
+        options["pool_timeout"] = config.DB_POOL_TIMEOUT
+        options["pool_recycle"] = config.DB_POOL_RECYCLE
+    return options
+
+
+class LockStats:
+    """Counts of SQLite lock contention seen by this process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.locked_errors = 0
+        self.batches = 0
+        self.jobs = 0
+        self.failed_jobs = 0
+        self.commit_seconds = 0.0
+        self.max_batch = 0
+
+    def on_locked(self) -> None:
+        with self._lock:
+            self.locked_errors += 1
+
+    def on_batch(self, jobs: int, failed: int, commit_seconds: float) -> None:
+        with self._lock:
+            self.batches += 1
+            self.jobs += jobs
+            self.failed_jobs += failed
+            self.commit_seconds += commit_seconds
+            self.max_batch = max(self.max_batch, jobs)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "locked_errors": self.locked_errors,
+                "batches": self.batches,
+                "jobs": self.jobs,
+                "failed_jobs": self.failed_jobs,
+                "avg_batch": self.jobs / self.batches if self.batches else 0.0,
+                "max_batch": self.max_batch,
+                "avg_commit_ms": self.commit_seconds * 1000 / self.batches if self.batches else 0.0,
+            }
+
+
+lock_stats = LockStats()
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={config.DB_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={config.DB_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={int(config.DB_BUSY_TIMEOUT)}")
+    cursor.close()
+
+
+def _count_locked_errors(context) -> None:
+    if "database is locked" in str(context.original_exception):
+        lock_stats.on_locked()
+
+
+def configure_engine(engine: Engine) -> None:
+    """apply the configured PRAGMAs to every new connection of a SQLite engine"""
+    if engine.dialect.name != "sqlite":
+        return
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+    event.listen(engine, "handle_error", _count_locked_errors)
+
+
+def ensure_columns(engine: Engine, model) -> list[str]:
+    """
+    Add the columns of a model that its existing table lacks. create_all
+    only creates missing tables, so columns added to a model later are
+    added here. New columns must be nullable or have a server default, and
+    are added without their foreign key constraint.
+    :param engine: the engine of the database
+    :param model: the model class
+    :return: the names of the added columns
+    """
+    table = model.__table__
+    inspector = inspect(engine)
+    if not inspector.has_table(table.name):
+        return []
+    existing = {column["name"] for column in inspector.get_columns(table.name)}
+
+    added = []
+    with engine.begin() as connection:
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            # the dialect renders the type, the server default and NOT NULL
+            definition = CreateColumn(column).compile(dialect=engine.dialect)
+            connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {definition}"))
+            added.append(column.name)
+    if added:
+        logging.info(f"<ensure_columns> added {', '.join(added)} to {table.name}")
+    return added
+
+
+def commit() -> None:
+    """
+    Commit the session of the current write. Inside a writer batch the work
+    is only flushed; the writer commits the whole batch at once.
+    """
+    if getattr(_local, "in_batch", False):
+        db.session.flush()
+    else:
+        db.session.commit()
+
+
+class _Job:
+    __slots__ = ("func", "args", "kwargs", "future")
+
+    def __init__(self, func: Callable, args: tuple, kwargs: dict):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future: concurrent.futures.Future = concurrent.futures.Future()
+
+
+class DatabaseWriter:
+    """
+    Single thread that runs every write of the process. Queued writes are
+    taken in batches; each runs in its own savepoint so a failing write is
+    rolled back alone, and the batch is committed once.
+    """
+
+    def __init__(self, *, max_batch: int, max_delay: float):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._app: Optional[Flask] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, app: Flask) -> None:
+        if self._thread is not None:
+            return
+        self._app = app
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        """finish the queued writes and stop the thread"""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def submit(self, func: Callable[..., T], *args, **kwargs) -> "concurrent.futures.Future[T]":
+        """
+        Queue a write
+        :param func: the write; it must call database.commit() instead of db.session.commit()
+        :return: a future of the result of func
+        """
+        job = _Job(func, args, kwargs)
+        self._queue.put(job)
+        return job.future
+
+    def _next_batch(self) -> tuple[list[_Job], bool]:
+        jobs: list[_Job] = []
+        job = self._queue.get()
+        if job is None:
+            return jobs, True
+        jobs.append(job)
+        deadline = time.monotonic() + self.max_delay
+        while len(jobs) < self.max_batch:
+            try:
+                job = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if job is None:
+                return jobs, True
+            jobs.append(job)
+        return jobs, False
+
+    def _run(self) -> None:
+        with self._app.app_context():
+            while True:
+                jobs, stopping = self._next_batch()
+                if jobs:
+                    self._run_batch(jobs)
+                if stopping:
+                    # writes queued behind the stop request still get run
+                    while not self._queue.empty():
+                        job = self._queue.get()
+                        if job is not None:
+                            self._run_batch([job])
+                    return
+
+    def _run_batch(self, jobs: list[_Job]) -> None:
+        results: list[tuple[_Job, object, Optional[BaseException]]] = []
+        _local.in_batch = True
+        try:
+            # take the write lock up front so the busy timeout applies to the
+            # whole batch instead of failing on a read-to-write lock upgrade
+            if db.engine.dialect.name == "sqlite":
+                db.session.execute(text("BEGIN IMMEDIATE"))
+            for job in jobs:
+                try:
+                    with db.session.begin_nested():
+                        result = job.func(*job.args, **job.kwargs)
+                    results.append((job, result, None))
+                except Exception as e:
+                    results.append((job, None, e))
+
+            start = time.perf_counter()
+            db.session.commit()
+            commit_seconds = time.perf_counter() - start
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"<db_writer> Error in committing a batch of {len(jobs)} writes: {e}")
+            for job in jobs:
+                job.future.set_exception(e)
+            return
+        finally:
+            _local.in_batch = False
+            db.session.remove()
+
+        failed = 0
+        for job, result, error in results:
+            if error is None:
+                job.future.set_result(result)
+            else:
+                failed += 1
+                job.future.set_exception(error)
+        lock_stats.on_batch(len(jobs), failed, commit_seconds)
+
+
+db_writer = DatabaseWriter(max_batch=config.DB_WRITER_MAX_BATCH, max_delay=config.DB_WRITER_MAX_DELAY / 1000)
+
+
+def init_db(app: Flask) -> None:
+    """
+    Configure the database of the app and start the writer if enabled.
+    Must be called instead of db.init_app.
+    """
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options()
+    db.init_app(app)
+    with app.app_context():
+        configure_engine(db.engine)
+    if config.DB_WRITER_ENABLED:
+        db_writer.start(app)
+
+
+def write(func: Callable[..., T], *args, **kwargs) -> T:
+    """
+    Run a write and wait for its result, through the writer when it is running
+    :param func: the write; it must call database.commit() instead of db.session.commit()
+    """
+    if db_writer.running:
+        return db_writer.submit(func, *args, **kwargs).result()
+    return func(*args, **kwargs)
+
+
+@contextlib.asynccontextmanager
+async def renewing(renew: Callable[[], Awaitable], *, interval: float) -> AsyncIterator[None]:
+    """
+    Await renew every interval seconds while the body runs, e.g. to extend
+    the lease of claimed rows; a failed renewal is logged and tried again
+    """
+    async def run() -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await renew()
+            except Exception as e:
+                logging.error(f"<renewing> Error in renewing: {e}")
+
+    task = asyncio.create_task(run())
+    try:
+        yield
+    finally:
+        task.cancel()
+
+
+def stats() -> dict:
+    stats = lock_stats.stats()
+    stats["writer"] = db_writer.running
+    stats["queued"] = db_writer.pending()
+    return stats
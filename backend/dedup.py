@@ -0,0 +1,290 @@
+"""
+Near-duplicate detection of questions with MinHash and LSH.
+
+Question content is cut into token shingles twice: once with identifiers as
+written and once with identifiers replaced by a placeholder, so renamed
+variables, reformatting and edited comments keep most shingles in common.
+Comments and string literals are dropped before tokenizing.
+Each question gets a MinHash signature (QuestionSignature) whose bands are
+hashed into LSHBucket; questions sharing a bucket are candidates, ranked by
+the Jaccard similarity their signatures estimate.
+"""
+import hashlib
+import logging
+import re
+from typing import NamedTuple, Optional
+
+import click
+import numpy as np
+from flask.cli import AppGroup
+from sqlalchemy import delete, select, tuple_
+
+from config import config
+from models import db, Answer, Question, QuestionSignature, LSHBucket
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+_COMMENT = re.compile(r"/\*.*?\*/|//[^\n]*|#[^\n]*|--[^\n]*", re.DOTALL)
+_STRING = re.compile(r"\"(?:\\.|[^\"\\])*\"|'(?:\\.|[^'\\])*'")
+_TOKEN = re.compile(r"[A-Za-z_]\w*|\d+(?:\.\d+)?|[^\s\w]")
+
+# words that keep their meaning when identifiers are abstracted away
+_KEYWORDS = frozenset("""
+    and as assert async await break case catch class const continue def default del do elif else enum
+    except export extends false final finally fn for from func function if impl import in interface is
+    lambda let match mut new nil none not null or package pass private protected public raise return
+    self static struct super switch this throw throws true try type typeof use var void while with yield
+    int float double long char bool boolean string str list dict map set vec print println printf
+""".split())
+
+
+def shingles(content: str, size: int) -> set[str]:
+    """
+    :return: the shingles of some question content
+    """
+    text = _STRING.sub(" s ", _COMMENT.sub(" ", content)).lower()
+    tokens = _TOKEN.findall(text)
+    abstracted = [
+        token if token in _KEYWORDS or not (token[0].isalpha() or token[0] == "_") else "_"
+        for token in tokens
+    ]
+    result = {"t" + " ".join(tokens[i:i + size]) for i in range(max(1, len(tokens) - size + 1))}
+    # the structure of the code counts twice as much as its naming; runs of
+    # plain identifiers are left out so prose does not look alike
+    for i in range(max(1, len(abstracted) - size + 1)):
+        shingle = abstracted[i:i + size]
+        if any(token != "_" for token in shingle):
+            result.add("a" + " ".join(shingle))
+            result.add("b" + " ".join(shingle))
+    return result
+
+
+class MinHasher:
+    """MinHash signatures and LSH bands with fixed permutations."""
+
+    def __init__(self, *, num_perm: int, bands: int, shingle_size: int, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("dedup.num_perm must be a multiple of dedup.bands")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        generator = np.random.RandomState(seed)
+        # a * x + b stays below 2 ** 64 for 32 bit a, b and x
+        self._a = generator.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self._b = generator.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+
+    def signature(self, content: str) -> np.ndarray:
+        hashes = np.array(
+            [int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=4).digest(), "little")
+             for shingle in shingles(content, self.shingle_size)],
+            dtype=np.uint64,
+        )
+        permuted = (np.outer(self._a, hashes) + self._b[:, None]) % _MERSENNE_PRIME & _MAX_HASH
+        return permuted.min(axis=1).astype(np.uint32)
+
+    def buckets(self, signature: np.ndarray) -> list[tuple[int, int]]:
+        """
+        :return: (band, bucket) of each band of a signature
+        """
+        return [
+            (band, int.from_bytes(
+                hashlib.blake2b(signature[band * self.rows:(band + 1) * self.rows].tobytes(), digest_size=8).digest(),
+                "little",
+                signed=True,
+            ))
+            for band in range(self.bands)
+        ]
+
+    @staticmethod
+    def similarity(signature_a: np.ndarray, signature_b: np.ndarray) -> float:
+        """estimated Jaccard similarity of the shingles behind two signatures"""
+        return float(np.mean(signature_a == signature_b))
+
+
+minhasher = MinHasher(
+    num_perm=config.DEDUP_NUM_PERM,
+    bands=config.DEDUP_BANDS,
+    shingle_size=config.DEDUP_SHINGLE_SIZE,
+)
+
+
+class QuestionIndex(NamedTuple):
+    """The signature and LSH buckets of a question's content."""
+
+    signature: bytes
+    buckets: list[tuple[int, int]]
+
+
+def question_index(content: str) -> QuestionIndex:
+    """
+    Compute the index rows of a question; done before the write, so the
+    hashing does not hold the database writer
+    """
+    signature = minhasher.signature(content)
+    return QuestionIndex(signature=signature.tobytes(), buckets=minhasher.buckets(signature))
+
+
+def index_question(question_id: int, index: QuestionIndex) -> None:
+    """
+    Add the signature and buckets of a question in the current transaction
+    """
+    db.session.add(QuestionSignature(question_id=question_id, signature=index.signature))
+    db.session.add_all([
+        LSHBucket(band=band, bucket=bucket, question_id=question_id)
+        for band, bucket in index.buckets
+    ])
+
+
+def find_similar_questions(
+    content: str,
+    *,
+    limit: int,
+    min_similarity: float,
+    exclude_question_id: Optional[int] = None,
+    same_as: Optional[dict] = None
+) -> list[tuple[int, float]]:
+    """
+    Find the stored questions most similar to some content
+    :param content: the question content
+    :param limit: the most questions to return
+    :param min_similarity: the lowest estimated Jaccard similarity to return
+    :param exclude_question_id: a question to leave out, usually the one asked
+    :param same_as: only questions with these task/language column values
+    :return: (question id, similarity) by descending similarity
+    """
+    signature = minhasher.signature(content)
+    statement = (
+        select(LSHBucket.question_id, db.func.count().label("hits"))
+        .where(tuple_(LSHBucket.band, LSHBucket.bucket).in_(minhasher.buckets(signature)))
+        .group_by(LSHBucket.question_id)
+        .order_by(db.text("hits DESC"))
+        # signatures agreeing on more bands are likelier to be similar
+        .limit(max(limit * 10, 100))
+    )
+    if exclude_question_id is not None:
+        statement = statement.where(LSHBucket.question_id != exclude_question_id)
+    if same_as:
+        statement = statement.join(Question, Question.id == LSHBucket.question_id).where(
+            *(getattr(Question, column) == value for column, value in same_as.items())
+        )
+    candidates = [row.question_id for row in db.session.execute(statement)]
+    if not candidates:
+        return []
+
+    similar = []
+    for question_id, stored in db.session.execute(
+        select(QuestionSignature.question_id, QuestionSignature.signature)
+        .where(QuestionSignature.question_id.in_(candidates))
+    ):
+        similarity = minhasher.similarity(signature, np.frombuffer(stored, dtype=np.uint32))
+        if similarity >= min_similarity:
+            similar.append((question_id, similarity))
+    similar.sort(key=lambda item: (-item[1], item[0]))
+    return similar[:limit]
+
+
+def similar_questions_with_answers(content: str, *, limit: int, exclude_question_id: Optional[int] = None) -> list[dict]:
+    """
+    :return: the most similar prior questions with their answers and votes
+    """
+    similar = find_similar_questions(
+        content,
+        limit=limit,
+        min_similarity=config.DEDUP_MIN_SIMILARITY,
+        exclude_question_id=exclude_question_id,
+    )
+    questions = {question.id: question for question in Question.query.filter(Question.id.in_([q for q, _ in similar]))}
+    answers: dict[int, list[dict]] = {}
+    for answer in Answer.query.filter(Answer.question_id.in_(list(questions))).order_by(Answer.frontend_order):
+        answers.setdefault(answer.question_id, []).append({
+            "answer_id": answer.id,
+            "model_id": answer.model_id,
+            "content": answer.content,
+            "upvotes": answer.upvotes or 0,
+            "downvotes": answer.downvotes or 0,
+        })
+
+    return [
+        {
+            "question_id": question_id,
+            "title": questions[question_id].title,
+            "task": questions[question_id].task,
+            "similarity": round(similarity, 3),
+            "upvotes": sum(answer["upvotes"] for answer in answers.get(question_id, [])),
+            "downvotes": sum(answer["downvotes"] for answer in answers.get(question_id, [])),
+            "answers": answers.get(question_id, []),
+        }
+        for question_id, similarity in similar
+        if question_id in questions
+    ]
+
+
+def find_reusable_answers(
+    model_ids: list[str],
+    *,
+    content: str,
+    task: str,
+    language: str,
+    source_language: str,
+    target_language: str,
+    question_id: int
+) -> dict[str, str]:
+    """
+    Find well-voted stored answers of near-duplicate questions that can be
+    served instead of calling the models (dedup.reuse)
+    :return: model id -> the stored answer content, for the models that have one
+    """
+    # parse_answer_request stores "" for unused language fields, insert_question None
+    same_as = {"task": task}
+    for column, value in (("language", language), ("source_language", source_language), ("target_language", target_language)):
+        if value:
+            same_as[column] = value
+    similar = dict(find_similar_questions(
+        content,
+        limit=20,
+        min_similarity=config.DEDUP_REUSE_MIN_SIMILARITY,
+        exclude_question_id=question_id,
+        same_as=same_as,
+    ))
+    if not similar:
+        return {}
+
+    best: dict[str, tuple[float, int, str]] = {}
+    for answer in Answer.query.filter(
+        Answer.question_id.in_(list(similar)),
+        Answer.model_id.in_(model_ids),
+        db.func.coalesce(Answer.upvotes, 0) - db.func.coalesce(Answer.downvotes, 0) >= config.DEDUP_REUSE_MIN_SCORE,
+    ):
+        rank = (similar[answer.question_id], (answer.upvotes or 0) - (answer.downvotes or 0), answer.content)
+        if answer.model_id not in best or rank[:2] > best[answer.model_id][:2]:
+            best[answer.model_id] = rank
+    for model_id, (similarity, score, _) in best.items():
+        logging.info(f"<dedup> reusing an answer of {model_id} with similarity {similarity:.2f} and score {score}")
+    return {model_id: content for model_id, (_, _, content) in best.items()}
+
+
+dedup_cli = AppGroup("dedup", help="Maintain the near-duplicate question index.")
+
+
+@dedup_cli.command("reindex")
+@click.option("--batch-size", type=int, default=1000, show_default=True)
+def reindex_command(batch_size: int):
+    """Rebuild the signatures and buckets of all questions."""
+    db.session.execute(delete(LSHBucket))
+    db.session.execute(delete(QuestionSignature))
+    indexed = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(Question.id, Question.content).where(Question.id > last_id).order_by(Question.id).limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        for question_id, content in rows:
+            index_question(question_id, question_index(content))
+        db.session.commit()
+        indexed += len(rows)
+        last_id = rows[-1].id
+    click.echo(f"indexed {indexed} questions")
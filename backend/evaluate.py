@@ -0,0 +1,358 @@
+"""
+Offline batch evaluation of the configured models.
+
+`flask evaluate run TASKS OUTPUT` reads a JSONL file of tasks with the body
+of /api/answer (task, language or sourceLanguage/targetLanguage, content,
+and an optional id) and sends each one to every model through the same
+prompts, limits, circuit breakers and retries as the live app, without
+going through HTTP. Each result is appended to OUTPUT as one JSON line as
+soon as it is known, so OUTPUT is also the checkpoint: a rerun skips the
+task/model pairs already in it.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from typing import Optional
+
+import click
+from flask.cli import AppGroup
+
+from config import config
+from dedup import question_index
+from function import (
+    generate_answer,
+    insert_answer,
+    insert_llm_error,
+    insert_question,
+    parse_answer_request,
+    run_db,
+)
+from prompts import Prompt, TASK_PROMPTS, build_prompt
+
+
+def read_tasks(path: str) -> tuple[list[tuple[str, dict]], list[tuple[str, str]]]:
+    """
+    :param path: the JSONL file of tasks
+    :return: the (task id, answer request fields) of the valid tasks and the
+        (task id, error) of the invalid ones; the task id is the "id" of the
+        line, or its line number
+    """
+    tasks = []
+    invalid = []
+    with open(path) as file:
+        for line_number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            task_id = str(line_number)
+            try:
+                data = json.loads(line)
+                task_id = str(data.get("id", line_number))
+                fields = parse_answer_request(data, require_model_id=False, require_question_id=False)
+                if fields["task"] not in TASK_PROMPTS:
+                    raise ValueError(f"unknown task {fields['task']}")
+            except (ValueError, AttributeError) as e:
+                invalid.append((task_id, str(e)))
+                continue
+            tasks.append((task_id, fields))
+    return tasks, invalid
+
+
+def read_checkpoint(path: str, *, retry_errors: bool) -> tuple[set[tuple[str, str]], dict[str, int]]:
+    """
+    :param path: the output of a previous run
+    :param retry_errors: whether failed calls are run again
+    :return: the (task id, model id) pairs already done and the stored
+        question of each task
+    """
+    done: set[tuple[str, str]] = set()
+    question_ids: dict[str, int] = {}
+    if not os.path.exists(path):
+        return done, question_ids
+    with open(path) as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line of a run that crashed while writing it
+                continue
+            if record.get("question_id") is not None:
+                question_ids[record["task_id"]] = record["question_id"]
+            if record["status"] == "ok" or not retry_errors:
+                done.add((record["task_id"], record["model_id"]))
+    return done, question_ids
+
+
+class EvaluationStats:
+    """Progress and throughput of a run."""
+
+    def __init__(self, *, total: int, skipped: int):
+        self.total = total
+        self.skipped = skipped
+        self.completed = 0
+        self.errors = 0
+        # tasks that failed outside of the model calls
+        self.failed_tasks = 0
+        self.start = time.monotonic()
+        self._latencies: dict[str, list[float]] = defaultdict(list)
+        self._errors: dict[str, int] = defaultdict(int)
+
+    def add(self, model_id: str, latency: float, ok: bool) -> None:
+        self.completed += 1
+        if ok:
+            self._latencies[model_id].append(latency)
+        else:
+            self.errors += 1
+            self._errors[model_id] += 1
+
+    def progress(self) -> str:
+        elapsed = time.monotonic() - self.start
+        rate = self.completed / elapsed if elapsed else 0.0
+        remaining = (self.total - self.completed) / rate if rate else float("inf")
+        return (
+            f"{self.completed}/{self.total} calls ({self.completed / max(self.total, 1):.1%}), "
+            f"{rate:.1f} calls/s, {self.errors} errors, {remaining:.0f}s left"
+        )
+
+    def summary(self) -> dict:
+        elapsed = time.monotonic() - self.start
+        models = {}
+        for model_id in sorted(set(self._latencies) | set(self._errors)):
+            latencies = sorted(self._latencies[model_id])
+            models[model_id] = {
+                "answers": len(latencies),
+                "errors": self._errors[model_id],
+                "mean_latency": sum(latencies) / len(latencies) if latencies else None,
+                "p50_latency": latencies[len(latencies) // 2] if latencies else None,
+                "p95_latency": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else None,
+            }
+        return {
+            "calls": self.completed,
+            "errors": self.errors,
+            "failed_tasks": self.failed_tasks,
+            "skipped": self.skipped,
+            "seconds": elapsed,
+            "calls_per_second": self.completed / elapsed if elapsed else 0.0,
+            "models": models,
+        }
+
+
+class EvaluationRun:
+    """Runs the tasks of a file against a set of models, appending results to a file."""
+
+    def __init__(
+        self,
+        *,
+        model_ids: list[str],
+        output: str,
+        concurrency: int,
+        provider_concurrency: int,
+        save_db: bool,
+        use_cache: bool,
+        retry_errors: bool,
+        checkpoint_every: int,
+        progress_interval: float
+    ):
+        """
+        :param model_ids: the models to run every task against
+        :param output: the JSONL file results are appended to
+        :param concurrency: the most tasks in flight
+        :param provider_concurrency: the most calls in flight per provider
+        :param save_db: whether to store questions, answers and errors in the database
+        :param use_cache: whether cached answers may be used
+        :param retry_errors: whether calls that failed in a previous run are run again
+        :param checkpoint_every: results between fsyncs of the output
+        :param progress_interval: seconds between progress reports
+        """
+        self.model_ids = model_ids
+        self.output = output
+        self.concurrency = concurrency
+        self.provider_concurrency = provider_concurrency
+        self.save_db = save_db
+        self.use_cache = use_cache
+        self.retry_errors = retry_errors
+        self.checkpoint_every = checkpoint_every
+        self.progress_interval = progress_interval
+        self._providers: dict[str, asyncio.Semaphore] = {}
+        self._file = None
+        self._unsynced = 0
+        self.stats: Optional[EvaluationStats] = None
+
+    async def run(self, tasks_path: str) -> dict:
+        """
+        :param tasks_path: the JSONL file of tasks
+        :return: the summary of the run
+        """
+        tasks, invalid = read_tasks(tasks_path)
+        for task_id, error in invalid:
+            logging.warning(f"<evaluate> skipping task {task_id}: {error}")
+        done, question_ids = read_checkpoint(self.output, retry_errors=self.retry_errors)
+
+        pending = []
+        for task_id, fields in tasks:
+            model_ids = [model_id for model_id in self.model_ids if (task_id, model_id) not in done]
+            if model_ids:
+                pending.append((task_id, fields, model_ids))
+        total = sum(len(model_ids) for _, _, model_ids in pending)
+        self.stats = EvaluationStats(total=total, skipped=len(tasks) * len(self.model_ids) - total)
+        logging.info(
+            f"<evaluate> {len(tasks)} tasks x {len(self.model_ids)} models: "
+            f"{total} calls to run, {self.stats.skipped} already done"
+        )
+
+        self._open_output()
+        reporter = asyncio.create_task(self._report_progress())
+        slots = asyncio.Semaphore(self.concurrency)
+        # every task is kept, so the failure of a finished one is still seen
+        started: list[tuple[str, asyncio.Task]] = []
+        try:
+            for task_id, fields, model_ids in pending:
+                await slots.acquire()
+                task = asyncio.create_task(self._run_task(task_id, fields, model_ids, question_ids.get(task_id)))
+                task.add_done_callback(lambda _: slots.release())
+                started.append((task_id, task))
+            results = await asyncio.gather(*(task for _, task in started), return_exceptions=True)
+        finally:
+            reporter.cancel()
+            self._close_output()
+
+        for (task_id, _), result in zip(started, results):
+            if isinstance(result, BaseException):
+                self.stats.failed_tasks += 1
+                logging.error(f"<evaluate> Error in running task {task_id}: {type(result).__name__}: {result}")
+        logging.info(f"<evaluate> finished: {self.stats.progress()}")
+        return self.stats.summary()
+
+    def _open_output(self) -> None:
+        self._file = open(self.output, "a+")
+        # a crash can leave the last line unfinished
+        if self._file.tell() > 0:
+            self._file.seek(self._file.tell() - 1)
+            if self._file.read(1) != "\n":
+                self._file.write("\n")
+
+    def _close_output(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+    def _write(self, record: dict) -> None:
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+        self._unsynced += 1
+        if self._unsynced >= self.checkpoint_every:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    async def _report_progress(self) -> None:
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            logging.info(f"<evaluate> {self.stats.progress()}")
+
+    def _provider_slot(self, model_id: str) -> asyncio.Semaphore:
+        source = config.LLM_ID_SOURCE.get(model_id, model_id)
+        if source not in self._providers:
+            self._providers[source] = asyncio.Semaphore(self.provider_concurrency)
+        return self._providers[source]
+
+    async def _run_task(self, task_id: str, fields: dict, model_ids: list[str], question_id: Optional[int]) -> None:
+        try:
+            if self.save_db and question_id is None:
+                question_id = await run_db(
+                    insert_question,
+                    title="evaluation",
+                    content=fields["content"],
+                    language=fields["language"] or None,
+                    source_language=fields["source_language"] or None,
+                    target_language=fields["target_language"] or None,
+                    task=fields["task"],
+                    ip_address=None,
+                    index=question_index(fields["content"]) if config.DEDUP_ENABLED else None,
+                )
+        except Exception as e:
+            # recorded as failed calls, so --retry-errors runs them again
+            for model_id in model_ids:
+                self._write({
+                    "task_id": task_id, "model_id": model_id, "question_id": None,
+                    "status": "error", "error": f"{type(e).__name__}: {e}", "latency": 0.0,
+                })
+                self.stats.add(model_id, 0.0, False)
+            return
+        prompt = build_prompt(
+            task=fields["task"],
+            content=fields["content"],
+            language=fields["language"],
+            source_language=fields["source_language"],
+            target_language=fields["target_language"],
+        )
+        await asyncio.gather(*(
+            self._run_model(task_id, model_id, prompt, question_id, self.model_ids.index(model_id))
+            for model_id in model_ids
+        ))
+
+    async def _run_model(self, task_id: str, model_id: str, prompt: Prompt, question_id: Optional[int], order: int) -> None:
+        record = {"task_id": task_id, "model_id": model_id, "question_id": question_id, "prompt_version": prompt.version}
+        async with self._provider_slot(model_id):
+            start = time.monotonic()
+            try:
+                content = await generate_answer(model_id, prompt, use_cache=self.use_cache)
+                record.update(status="ok", content=content)
+            except Exception as e:
+                record.update(status="error", error=f"{type(e).__name__}: {e}")
+            record["latency"] = time.monotonic() - start
+
+        try:
+            if self.save_db and record["status"] == "ok":
+                record["answer_id"] = await run_db(
+                    insert_answer, content=record["content"], model_id=model_id,
+                    question_id=question_id, frontend_order=order, prompt_version=prompt.version,
+                )
+            elif self.save_db:
+                await run_db(insert_llm_error, question_id=question_id, model_id=model_id, prompt=prompt.text, error=record["error"])
+        except Exception as e:
+            # the result is still written; it just is not in the database
+            logging.error(f"<evaluate> Error in storing the result of task {task_id} for {model_id}: {e}")
+
+        self._write(record)
+        self.stats.add(model_id, record["latency"], record["status"] == "ok")
+
+
+evaluate_cli = AppGroup("evaluate", help="Run offline evaluations of the models.")
+
+
+@evaluate_cli.command("run")
+@click.argument("tasks", type=click.Path(exists=True, dir_okay=False))
+@click.argument("output", type=click.Path(dir_okay=False))
+@click.option("--model", "model_ids", multiple=True, help="Model to evaluate, can be repeated. Default: all configured models.")
+@click.option("--concurrency", type=int, default=16, show_default=True, help="Most tasks in flight.")
+@click.option("--provider-concurrency", type=int, default=4, show_default=True, help="Most calls in flight per provider.")
+@click.option("--save-db", is_flag=True, help="Store the questions, answers and errors in the database.")
+@click.option("--use-cache", is_flag=True, help="Allow cached answers instead of fresh generations.")
+@click.option("--retry-errors", is_flag=True, help="Run the calls that failed in a previous run again.")
+@click.option("--checkpoint-every", type=int, default=50, show_default=True, help="Results between fsyncs of OUTPUT.")
+@click.option("--progress-interval", type=float, default=10, show_default=True, help="Seconds between progress reports.")
+def run_command(tasks, output, model_ids, concurrency, provider_concurrency, save_db, use_cache, retry_errors,
+                checkpoint_every, progress_interval):
+    """Answer every task of TASKS with every model, appending the results to OUTPUT."""
+    model_ids = list(model_ids) or list(config.LLM_CHAINS)
+    unknown = [model_id for model_id in model_ids if model_id not in config.LLM_CHAINS]
+    if unknown:
+        raise click.ClickException(f"unknown models: {', '.join(unknown)}")
+
+    run = EvaluationRun(
+        model_ids=model_ids,
+        output=output,
+        concurrency=max(1, concurrency),
+        provider_concurrency=max(1, provider_concurrency),
+        save_db=save_db,
+        use_cache=use_cache,
+        retry_errors=retry_errors,
+        checkpoint_every=max(1, checkpoint_every),
+        progress_interval=progress_interval,
+    )
+    summary = asyncio.run(run.run(tasks))
+    click.echo(json.dumps(summary, indent=2))
+    if summary["failed_tasks"]:
+        raise SystemExit(1)
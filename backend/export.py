@@ -0,0 +1,407 @@
+"""
+Bulk export of the collected questions, answers, votes and LLM errors.
+
+Records are read in keyset chunks (id > last id, ordered by id), each chunk
+in its own short read transaction on a separate connection. Memory stays
+bounded by the chunk size however large the table is, and with the WAL
+journal the export never holds the write lock or keeps a snapshot open long
+enough to stall checkpoints of the live app.
+
+Exports are incremental by id: the watermark of an export is the highest id
+that existed when it started, and passing it as after_id to the next export
+returns only the rows added since. Votes of already exported answers keep
+changing, so a full export is needed for final vote counts.
+"""
+import hmac
+import io
+import json
+import os
+from datetime import datetime
+from typing import Iterator, Optional
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import select
+from sqlalchemy.engine import Engine
+
+from config import config
+from models import db, Answer, Feedback, LLMError, Question
+
+DATASETS = ("answers", "errors")
+FORMATS = ("jsonl", "parquet")
+
+CONTENT_TYPES = {
+    "jsonl": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+class ExportFilters:
+    """Which rows an export returns."""
+
+    def __init__(
+        self,
+        *,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        task: Optional[str] = None,
+        model_ids: Optional[list[str]] = None,
+        after_id: int = 0
+    ):
+        """
+        :param since: only rows created at or after this time
+        :param until: only rows created before this time
+        :param task: only rows of questions of this task
+        :param model_ids: only rows of these models
+        :param after_id: only rows with a larger id (the watermark of a previous export)
+        """
+        self.since = since
+        self.until = until
+        self.task = task
+        self.model_ids = model_ids or None
+        self.after_id = after_id
+
+
+def parse_time(value: Optional[str]) -> Optional[datetime]:
+    """
+    :raises ValueError: if the value is not an ISO 8601 date or time
+    """
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"invalid date: {value}")
+
+
+def check_token(authorization: Optional[str]) -> bool:
+    """
+    :param authorization: the Authorization header of the request
+    :return: whether it carries the configured export token
+    """
+    if not config.EXPORT_TOKEN or not authorization:
+        return False
+    scheme, _, token = authorization.partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(token.encode(), config.EXPORT_TOKEN.encode())
+
+
+def _name(value) -> Optional[str]:
+    # the language columns hold names despite their declared type
+    return None if value is None else str(value)
+
+
+def _answer_chunks(engine: Engine, filters: ExportFilters, upper_id: int, chunk_size: int) -> Iterator[list[dict]]:
+    statement = (
+        select(
+            Answer.id, Answer.question_id, Answer.model_id, Answer.content, Answer.upvotes, Answer.downvotes,
+            Answer.frontend_order, Answer.created_at, Answer.updated_at,
+            Question.title, Question.content.label("question_content"), Question.task, Question.language,
+            Question.source_language, Question.target_language, Question.accepted_answer_id,
+            Question.created_at.label("question_created_at"),
+        )
+        .join(Question, Question.id == Answer.question_id)
+        .where(Answer.id <= upper_id)
+        .order_by(Answer.id)
+        .limit(chunk_size)
+    )
+    if filters.since:
+        statement = statement.where(Answer.created_at >= filters.since)
+    if filters.until:
+        statement = statement.where(Answer.created_at < filters.until)
+    if filters.task:
+        statement = statement.where(Question.task == filters.task)
+    if filters.model_ids:
+        statement = statement.where(Answer.model_id.in_(filters.model_ids))
+
+    last_id = filters.after_id
+    while True:
+        with engine.connect() as connection:
+            rows = connection.execute(statement.where(Answer.id > last_id)).all()
+            if not rows:
+                return
+            feedbacks: dict[int, list[dict]] = {}
+            for feedback in connection.execute(
+                select(
+                    Feedback.answer_id, Feedback.predefined_feedbacks, Feedback.text_feedback,
+                    Feedback.active, Feedback.created_at,
+                )
+                .where(Feedback.answer_id.in_([row.id for row in rows]))
+                .order_by(Feedback.id)
+            ):
+                feedbacks.setdefault(feedback.answer_id, []).append({
+                    "predefined_feedbacks": [str(item) for item in feedback.predefined_feedbacks or []],
+                    "text_feedback": feedback.text_feedback,
+                    "active": feedback.active,
+                    "created_at": feedback.created_at,
+                })
+
+        yield [
+            {
+                "answer_id": row.id,
+                "question_id": row.question_id,
+                "model_id": row.model_id,
+                "content": row.content,
+                "upvotes": row.upvotes or 0,
+                "downvotes": row.downvotes or 0,
+                "accepted": row.accepted_answer_id == row.id,
+                "frontend_order": row.frontend_order,
+                "created_at": row.created_at,
+                "updated_at": row.updated_at,
+                "question_title": row.title,
+                "question_content": row.question_content,
+                "task": row.task,
+                "language": _name(row.language),
+                "source_language": _name(row.source_language),
+                "target_language": _name(row.target_language),
+                "question_created_at": row.question_created_at,
+                "feedbacks": feedbacks.get(row.id, []),
+            }
+            for row in rows
+        ]
+        last_id = rows[-1].id
+
+
+def _error_chunks(engine: Engine, filters: ExportFilters, upper_id: int, chunk_size: int) -> Iterator[list[dict]]:
+    statement = (
+        select(
+            LLMError.id, LLMError.question_id, LLMError.model_id, LLMError.prompt, LLMError.error,
+            LLMError.created_at, LLMError.resolved_at, LLMError.resolved_answer_id, LLMError.replay_attempts,
+            LLMError.request_id,
+            Question.task,
+        )
+        .join(Question, Question.id == LLMError.question_id)
+        .where(LLMError.id <= upper_id)
+        .order_by(LLMError.id)
+        .limit(chunk_size)
+    )
+    if filters.since:
+        statement = statement.where(LLMError.created_at >= filters.since)
+    if filters.until:
+        statement = statement.where(LLMError.created_at < filters.until)
+    if filters.task:
+        statement = statement.where(Question.task == filters.task)
+    if filters.model_ids:
+        statement = statement.where(LLMError.model_id.in_(filters.model_ids))
+
+    last_id = filters.after_id
+    while True:
+        with engine.connect() as connection:
+            rows = connection.execute(statement.where(LLMError.id > last_id)).all()
+        if not rows:
+            return
+        yield [
+            {
+                "error_id": row.id,
+                "question_id": row.question_id,
+                "model_id": row.model_id,
+                "task": row.task,
+                "prompt": row.prompt,
+                "error": row.error,
+                "created_at": row.created_at,
+                "resolved_at": row.resolved_at,
+                "resolved_answer_id": row.resolved_answer_id,
+                "replay_attempts": row.replay_attempts,
+                "request_id": row.request_id,
+            }
+            for row in rows
+        ]
+        last_id = rows[-1].id
+
+
+_CHUNKS = {
+    "answers": (Answer, _answer_chunks),
+    "errors": (LLMError, _error_chunks),
+}
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _jsonl(chunks: Iterator[list[dict]]) -> Iterator[bytes]:
+    for records in chunks:
+        yield "".join(
+            json.dumps(record, default=_json_default, ensure_ascii=False) + "\n" for record in records
+        ).encode()
+
+
+def _parquet_schema(pa, dataset: str):
+    if dataset == "errors":
+        return pa.schema([
+            ("error_id", pa.int64()),
+            ("question_id", pa.int64()),
+            ("model_id", pa.string()),
+            ("task", pa.string()),
+            ("prompt", pa.string()),
+            ("error", pa.string()),
+            ("created_at", pa.timestamp("us")),
+            ("resolved_at", pa.timestamp("us")),
+            ("resolved_answer_id", pa.int64()),
+            ("replay_attempts", pa.int64()),
+            ("request_id", pa.string()),
+        ])
+    return pa.schema([
+        ("answer_id", pa.int64()),
+        ("question_id", pa.int64()),
+        ("model_id", pa.string()),
+        ("content", pa.string()),
+        ("upvotes", pa.int64()),
+        ("downvotes", pa.int64()),
+        ("accepted", pa.bool_()),
+        ("frontend_order", pa.int64()),
+        ("created_at", pa.timestamp("us")),
+        ("updated_at", pa.timestamp("us")),
+        ("question_title", pa.string()),
+        ("question_content", pa.string()),
+        ("task", pa.string()),
+        ("language", pa.string()),
+        ("source_language", pa.string()),
+        ("target_language", pa.string()),
+        ("question_created_at", pa.timestamp("us")),
+        ("feedbacks", pa.list_(pa.struct([
+            ("predefined_feedbacks", pa.list_(pa.string())),
+            ("text_feedback", pa.string()),
+            ("active", pa.bool_()),
+            ("created_at", pa.timestamp("us")),
+        ]))),
+    ])
+
+
+class _StreamSink(io.RawIOBase):
+    # write-only file that hands what is written to the response as it goes
+    def __init__(self):
+        super().__init__()
+        self._buffer: list[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._buffer.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+def _import_pyarrow():
+    """
+    :raises RuntimeError: if pyarrow is not installed
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("parquet export needs pyarrow, install it with `pip install pyarrow`")
+    return pyarrow, pyarrow.parquet
+
+
+def _parquet(dataset: str, chunks: Iterator[list[dict]]) -> Iterator[bytes]:
+    pa, pq = _import_pyarrow()
+    schema = _parquet_schema(pa, dataset)
+    sink = _StreamSink()
+    # one row group per chunk, so only one chunk is ever held in memory
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    try:
+        for records in chunks:
+            writer.write_table(pa.Table.from_pylist(records, schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def export(
+    engine: Engine,
+    *,
+    dataset: str,
+    file_format: str,
+    filters: ExportFilters,
+    chunk_size: Optional[int] = None
+) -> tuple[int, Iterator[bytes]]:
+    """
+    Export a dataset as a stream of bytes
+    :param engine: the engine to read from; each chunk is read on its own connection
+    :param dataset: "answers" (with their questions, votes and feedback) or "errors"
+    :param file_format: "jsonl" or "parquet"
+    :param filters: which rows to export
+    :param chunk_size: rows per read, default export.chunk_size
+    :return: the watermark of the export and its content
+    :raises ValueError: on an unknown dataset or format
+    :raises RuntimeError: for parquet if pyarrow is not installed
+    """
+    if dataset not in DATASETS:
+        raise ValueError(f"dataset must be one of {', '.join(DATASETS)}")
+    if file_format not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    if file_format == "parquet":
+        # fail before the response starts rather than in the middle of it
+        _import_pyarrow()
+
+    model, read_chunks = _CHUNKS[dataset]
+    # rows added while the export runs belong to the next one
+    with engine.connect() as connection:
+        upper_id = connection.execute(select(db.func.max(model.id))).scalar() or 0
+    watermark = max(upper_id, filters.after_id)
+    chunks = read_chunks(engine, filters, upper_id, chunk_size or config.EXPORT_CHUNK_SIZE)
+    if file_format == "parquet":
+        return watermark, _parquet(dataset, chunks)
+    return watermark, _jsonl(chunks)
+
+
+export_cli = AppGroup("export", help="Export the collected data for evaluation datasets.")
+
+
+@export_cli.command("dump")
+@click.argument("dataset", type=click.Choice(DATASETS))
+@click.option("--output", "-o", type=click.Path(dir_okay=False), required=True, help="File to write.")
+@click.option("--format", "format_", type=click.Choice(FORMATS), default="jsonl", show_default=True)
+@click.option("--since", help="Only rows created at or after this ISO date.")
+@click.option("--until", help="Only rows created before this ISO date.")
+@click.option("--task", help="Only rows of questions of this task.")
+@click.option("--model", "model_ids", multiple=True, help="Only rows of this model, can be repeated.")
+@click.option("--after", type=int, default=0, help="Only rows after this watermark.")
+@click.option(
+    "--watermark-file",
+    type=click.Path(dir_okay=False),
+    help="Read --after from this file if it exists and store the new watermark in it after a complete export.",
+)
+@click.option("--chunk-size", type=int, default=None, help="Rows per read, default export.chunk_size.")
+def dump_command(dataset, output, format_, since, until, task, model_ids, after, watermark_file, chunk_size):
+    """Export DATASET (answers or errors) to a JSONL or Parquet file."""
+    if watermark_file and os.path.exists(watermark_file):
+        with open(watermark_file) as file:
+            after = int(file.read().strip() or 0)
+    try:
+        filters = ExportFilters(
+            since=parse_time(since),
+            until=parse_time(until),
+            task=task,
+            model_ids=list(model_ids),
+            after_id=after,
+        )
+        watermark, content = export(db.engine, dataset=dataset, file_format=format_, filters=filters, chunk_size=chunk_size)
+    except (ValueError, RuntimeError) as e:
+        raise click.ClickException(str(e))
+
+    written = 0
+    with open(output, "wb") as file:
+        for data in content:
+            file.write(data)
+            written += len(data)
+
+    if watermark_file:
+        temporary = f"{watermark_file}.tmp"
+        with open(temporary, "w") as file:
+            file.write(str(watermark))
+        os.replace(temporary, watermark_file)
+    click.echo(f"exported {dataset} after id {after} up to id {watermark} ({written} bytes) to {output}")
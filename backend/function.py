@@ -1,11 +1,20 @@
-from typing import Optional
-from models import db, Question, Answer, LLMError
+import asyncio
+from typing import AsyncIterator, Optional
+from flask import current_app
+from sqlalchemy import select, update
+from models import db, Question, Answer, Feedback, LLMError
 from config import config
-from langchain.prompts import (
-    ChatPromptTemplate,
-    SystemMessagePromptTemplate,
-    HumanMessagePromptTemplate,
-)
+from database import commit, db_writer
+from cache import answer_cache, make_cache_key
+from leaderboard import record_vote_deltas
+from dedup import QuestionIndex, find_reusable_answers, index_question
+from singleflight import llm_calls
+from limits import llm_limits
+from resilience import CircuitOpen, call_with_retries, circuit_breakers, iterate_with_timeout, with_timeout
+from metrics import LLMUsage, observe_db_write, observe_llm_call, record_tokens, token_counts, track_usage
+from tracing import CLIENT, current_request_id, span
+from prompts import Prompt, build_prompt
+from langchain_core.messages import BaseMessage, BaseMessageChunk
 
 def insert_question(
     *,
@@ -15,7 +24,8 @@ def insert_question(
     source_language: Optional[str],
     target_language: Optional[str],
     task: str,
-    ip_address: str
+    ip_address: str,
+    index: Optional[QuestionIndex] = None
 ) -> int:
     """
     Add a question to the database
@@ -25,6 +35,7 @@ def insert_question(
     :param source_language: the source language of the question (if any)
     :param target_language: the target language of the question (if any)
     :param task: the chosen task category of the question
+    :param index: the near-duplicate index rows of the content, see dedup.question_index
     :return: the id of the question (primary key)
     """
 
@@ -39,7 +50,10 @@ def insert_question(
     )
 
     db.session.add(question)
-    db.session.commit()
+    if index is not None:
+        db.session.flush()
+        index_question(question.id, index)
+    commit()
 
     return question.id
 
@@ -49,7 +63,9 @@ def insert_answer(
     content: str,
     model_id: str,
     question_id: int,
-    frontend_order: int
+    frontend_order: int,
+    usage: Optional[dict] = None,
+    prompt_version: Optional[str] = None
 ) -> int:
     """
     Add an answer to the database
@@ -57,6 +73,8 @@ def insert_answer(
     :param model: the model id used to generate the answer
     :param question_id: the id of the question
     :param frontend_order: the order of the answer in the frontend
+    :param usage: the latency, token and cost columns of the answer (if recorded)
+    :param prompt_version: the version of the task prompt the answer was generated with (if known)
     :return: the id of the answer (primary key)
     """
 
@@ -65,13 +83,232 @@ def insert_answer(
         model_id=model_id,
         question_id=question_id,
         frontend_order=frontend_order,
+        prompt_version=prompt_version,
+        **(usage or {}),
     )
 
     db.session.add(answer)
-    db.session.commit()
+    commit()
 
     return answer.id
 
+def insert_llm_error(
+    *,
+    question_id: int,
+    model_id: str,
+    prompt: str,
+    error: str,
+    request_id: Optional[str] = None
+) -> int:
+    """
+    Record that a model failed to answer a question
+    :param question_id: the id of the question
+    :param model_id: the model id that failed
+    :param prompt: the prompt sent to the model
+    :param error: the error raised by the model
+    :param request_id: the id of the request that called the model (if any)
+    :return: the id of the error (primary key)
+    """
+
+    llm_error = LLMError(
+        question_id=question_id,
+        model_id=model_id,
+        prompt=prompt,
+        error=error,
+        request_id=request_id,
+    )
+
+    db.session.add(llm_error)
+    commit()
+
+    return llm_error.id
+
+
+def insert_answers(*, answers: list[dict], llm_errors: list[dict]) -> list[int]:
+    """
+    Add several answers and errors to the database in a single transaction
+    :param answers: keyword arguments of each Answer
+    :param llm_errors: keyword arguments of each LLMError
+    :return: the ids of the answers, in order
+    """
+
+    answer_rows = [Answer(**answer) for answer in answers]
+    db.session.add_all(answer_rows)
+    db.session.add_all([LLMError(**llm_error) for llm_error in llm_errors])
+    commit()
+
+    return [answer.id for answer in answer_rows]
+
+
+async def run_db(func, /, *args, **kwargs):
+    """
+    Run a blocking database write from async code without stalling the event
+    loop. The write is queued to the database writer when it is running,
+    otherwise it runs like run_read, so concurrent writes do not share a
+    session.
+    """
+    with observe_db_write(func.__name__), span(f"db.{func.__name__}"):
+        if db_writer.running:
+            return await asyncio.wrap_future(db_writer.submit(func, *args, **kwargs))
+        return await run_read(func, *args, **kwargs)
+
+
+async def run_read(func, /, *args, **kwargs):
+    """
+    Run a blocking database call from async code in a worker thread with
+    its own app context. Reads do not go through the database writer.
+    """
+    app = current_app._get_current_object()
+
+    def run():
+        with app.app_context():
+            return func(*args, **kwargs)
+
+    return await asyncio.to_thread(run)
+
+
+def parse_answer_request(data: dict, *, require_model_id: bool = True, require_question_id: bool = True) -> dict:
+    """
+    Validate the body of an answer request and normalize its language fields
+    :param data: the decoded JSON body of the request
+    :param require_model_id: whether the request must name a single model
+    :param require_question_id: whether the question must already be stored
+    :return: keyword arguments for get_answer_from_model / get_answers_from_models
+    :raises ValueError: if a required field is missing
+    """
+    model_id = data.get("modelId")
+    if require_model_id and model_id is None:
+        raise ValueError("model_id is missing")
+
+    question_content = data.get("content")
+    if question_content is None:
+        raise ValueError("question_content is missing")
+
+    task = data.get("task")
+    if task is None:
+        raise ValueError("task is missing")
+
+    language = data.get("language")
+    source_language = data.get("sourceLanguage")
+    target_language = data.get("targetLanguage")
+
+    if task == "Code Translation":
+        if source_language is None or target_language is None:
+            raise ValueError("both sourceLanguage and targetLanguage must be provided for translation.")
+
+        # ignore language if passed in for tranlation
+        language = ""
+    else:
+        if language is None:
+            raise ValueError("language be set for non-translation.")
+
+        # ignore source and target language if not for tranlation
+        source_language = ""
+        target_language = ""
+
+    question_id = data.get("questionId")
+    if require_question_id and question_id is None:
+        raise ValueError("question_id is missing")
+
+    fields = {
+        "content": question_content,
+        "language": language,
+        "source_language": source_language,
+        "target_language": target_language,
+        "task": task,
+        "question_id": question_id,
+        # evaluation runs set bypassCache to force fresh generations
+        "use_cache": not data.get("bypassCache", False),
+    }
+    if require_model_id:
+        fields["model_id"] = model_id
+        fields["frontend_order"] = data.get("frontendOrder")
+    return fields
+
+
+async def call_model(model_id: str, prompt: Prompt) -> str:
+    """
+    Send a prompt to a model within the concurrency and rate limits of the
+    model and its provider, enforcing its deadline and retrying failures.
+    Fails fast with CircuitOpen while the model keeps failing.
+    :param model_id: the id of the model
+    :param prompt: the prompt built for the question
+    :return: the answer content
+    """
+    async def attempt() -> str:
+        # the time before the provider call is spent waiting for a slot
+        with span("llm_call", model=model_id):
+            async with circuit_breakers.guard(model_id), llm_limits.slot(model_id):
+                with observe_llm_call(model_id, call="generate"), span("provider_call", kind=CLIENT, model=model_id):
+                    content, message = await with_timeout(
+                        model_id, async_llm_call(prompt.messages, config.LLM_CHAINS[model_id])
+                    )
+                record_tokens(model_id, *token_counts(prompt.text, message, content))
+                return content
+
+    return await call_with_retries(model_id, attempt)
+
+
+async def generate_answer(model_id: str, prompt: Prompt, *, use_cache: bool = True) -> str:
+    """
+    Generate the answer of a model for a prompt. Cached answers are served
+    first, and concurrent identical calls share a single provider request.
+    :param model_id: the id of the model
+    :param prompt: the prompt built for the question
+    :param use_cache: whether a cached or in-flight answer may be reused
+    :return: the answer content
+    """
+    if not use_cache:
+        return await call_model(model_id, prompt)
+
+    cache_key = make_cache_key(model_id, prompt.text, prompt.version)
+    if answer_cache.enabled:
+        with span("cache_lookup", model=model_id) as lookup:
+            cached_content = await answer_cache.get(cache_key)
+            lookup.set(hit=cached_content is not None)
+        if cached_content is not None:
+            return cached_content
+
+    async def call() -> str:
+        content = await call_model(model_id, prompt)
+        if answer_cache.enabled:
+            await answer_cache.set(cache_key, content)
+        return content
+
+    return await llm_calls.do(cache_key, call)
+
+
+async def reusable_answers(
+    model_ids: list[str],
+    *,
+    content: str,
+    language: str,
+    source_language: str,
+    target_language: str,
+    task: str,
+    question_id: int,
+    use_cache: bool
+) -> dict[str, str]:
+    """
+    Stored answers of near-duplicate questions to serve instead of calling
+    the models, when dedup.reuse is enabled
+    :return: model id -> answer content, for the models that have one
+    """
+    if not (use_cache and config.DEDUP_ENABLED and config.DEDUP_REUSE_ENABLED):
+        return {}
+    with span("reuse_lookup"):
+        return await run_read(
+            find_reusable_answers,
+            model_ids,
+            content=content,
+            task=task,
+            language=language,
+            source_language=source_language,
+            target_language=target_language,
+            question_id=question_id,
+        )
+
+
 async def get_answer_from_model(
     *,
     model_id: str,
@@ -81,7 +318,8 @@ async def get_answer_from_model(
     target_language: str,
     task: str,
     question_id: int,
-    frontend_order: int
+    frontend_order: int,
+    use_cache: bool = True
 ) -> dict[str, str]:
     """
     Get answer from a specific model
@@ -92,79 +330,434 @@ async def get_answer_from_model(
     :param target_language: the target language of the question (if any)
     :param task: the chosen task category of the question
     :param question_id: the id of the question
+    :param use_cache: whether a cached answer may be served
     :return:
     """
-    task_template = config.TASK_PROMPTS[task]
+    prompt = build_prompt(
+        task=task,
+        content=content,
+        language=language,
+        source_language=source_language,
+        target_language=target_language,
+    )
 
-    # Gather input data to chain
-    input_data = {}
-    if task == "Code Translation":
-        input_data["source_language"] = source_language
-        input_data["target_language"] = target_language
-        input_data["content"] = content
-    else:
-        input_data["language"] = language
-        input_data["content"] = content
+    reused = await reusable_answers(
+        [model_id],
+        content=content,
+        language=language,
+        source_language=source_language,
+        target_language=target_language,
+        task=task,
+        question_id=question_id,
+        use_cache=use_cache,
+    )
 
-    # llm chains is mapping from model id to client
-    llm_client = config.LLM_CHAINS[model_id]
-    prompt = task_template.format(**input_data)
     try:
-        content = await async_llm_call(prompt, llm_client)
+        with track_usage(task) as usage:
+            if model_id in reused:
+                content = reused[model_id]
+            else:
+                content = await generate_answer(model_id, prompt, use_cache=use_cache)
+    except CircuitOpen:
+        # the failures that opened the circuit are already recorded
+        raise
     except Exception as e:
-        llm_error = LLMError(
+        await run_db(
+            insert_llm_error,
             question_id=question_id,
             model_id=model_id,
-            prompt=prompt,
+            prompt=prompt.text,
             error=str(e),
+            request_id=current_request_id(),
         )
-        db.session.add(llm_error)
-        db.session.commit()
         raise
 
     response: dict[str, str] = {}
     response["model_name"] = config.LLM_ID_NAME[model_id]
     response["model_id"] = model_id
     response["content"] = content
-    answer_id = insert_answer(
+    answer_id = await run_db(
+        insert_answer,
         content=content,
         model_id=model_id,
         question_id=question_id,
-        frontend_order=frontend_order
+        frontend_order=frontend_order,
+        usage=usage.columns(),
+        # answers reused from another question may come from an older prompt
+        prompt_version=None if model_id in reused else prompt.version,
     )
     response["answer_id"] = answer_id
     return response
 
+
+async def get_answers_from_models(
+    *,
+    model_ids: list[str],
+    content: str,
+    language: str,
+    source_language: str,
+    target_language: str,
+    task: str,
+    question_id: int,
+    use_cache: bool = True
+) -> list[dict[str, str]]:
+    """
+    Get answers from several models concurrently and store them in one transaction
+    :param model_ids: the ids of the models, in frontend order
+    :param content: the question content
+    :param language: the language of the question (if any)
+    :param source_language: the source language of the question (if any)
+    :param target_language: the target language of the question (if any)
+    :param task: the chosen task category of the question
+    :param question_id: the id of the question
+    :param use_cache: whether cached answers may be served
+    :return: one response per model; failed models carry an "error" instead of an answer
+    """
+    prompt = build_prompt(
+        task=task,
+        content=content,
+        language=language,
+        source_language=source_language,
+        target_language=target_language,
+    )
+
+    reused = await reusable_answers(
+        model_ids,
+        content=content,
+        language=language,
+        source_language=source_language,
+        target_language=target_language,
+        task=task,
+        question_id=question_id,
+        use_cache=use_cache,
+    )
+
+    usages: dict[str, LLMUsage] = {}
+
+    async def answer(model_id: str) -> str:
+        if model_id in reused:
+            return reused[model_id]
+        # each model runs in its own task, so their usages are kept apart
+        with track_usage(task) as usages[model_id]:
+            return await generate_answer(model_id, prompt, use_cache=use_cache)
+
+    results = await asyncio.gather(
+        *(answer(model_id) for model_id in model_ids),
+        return_exceptions=True,
+    )
+
+    responses: list[dict[str, str]] = []
+    answers: list[dict] = []
+    llm_errors: list[dict] = []
+    for frontend_order, (model_id, result) in enumerate(zip(model_ids, results)):
+        response: dict[str, str] = {}
+        response["model_name"] = config.LLM_ID_NAME[model_id]
+        response["model_id"] = model_id
+        response["frontend_order"] = frontend_order
+
+        if isinstance(result, BaseException):
+            if not isinstance(result, CircuitOpen):
+                llm_errors.append({
+                    "question_id": question_id,
+                    "model_id": model_id,
+                    "prompt": prompt.text,
+                    "error": str(result),
+                    "request_id": current_request_id(),
+                })
+            response["error"] = str(result)
+        else:
+            answers.append({
+                "content": result,
+                "model_id": model_id,
+                "question_id": question_id,
+                "frontend_order": frontend_order,
+                "prompt_version": None if model_id in reused else prompt.version,
+                **(usages[model_id].columns() if model_id in usages else {}),
+            })
+            response["content"] = result
+        responses.append(response)
+
+    # all answers and errors of the question are written in a single commit
+    answer_ids = iter(await run_db(insert_answers, answers=answers, llm_errors=llm_errors))
+
+    for response in responses:
+        if "error" not in response:
+            response["answer_id"] = next(answer_ids)
+    return responses
+
+
+async def stream_answer_from_model(
+    *,
+    model_id: str,
+    content: str,
+    language: str,
+    source_language: str,
+    target_language: str,
+    task: str,
+    question_id: int,
+    frontend_order: int,
+    use_cache: bool = True
+) -> AsyncIterator[tuple[str, dict]]:
+    """
+    Stream the answer of a specific model as (event, data) pairs.
+    "token" events carry the generated text as it arrives, followed by a single
+    "answer" event once the full answer is stored, or an "error" event if the
+    generation fails (the failure is recorded in LLMError unless the circuit
+    of the model is open).
+    :param model_id: the id of the model
+    :param content: the question content
+    :param language: the language of the question (if any)
+    :param source_language: the source language of the question (if any)
+    :param target_language: the target language of the question (if any)
+    :param task: the chosen task category of the question
+    :param question_id: the id of the question
+    :param frontend_order: the order of the answer in the frontend
+    :param use_cache: whether a cached answer may be served
+    :return: an async iterator of (event, data) pairs
+    """
+    prompt = build_prompt(
+        task=task,
+        content=content,
+        language=language,
+        source_language=source_language,
+        target_language=target_language,
+    )
+
+    reused = await reusable_answers(
+        [model_id],
+        content=content,
+        language=language,
+        source_language=source_language,
+        target_language=target_language,
+        task=task,
+        question_id=question_id,
+        use_cache=use_cache,
+    )
+    cache_key = make_cache_key(model_id, prompt.text, prompt.version)
+    cached_content = reused.get(model_id)
+    if cached_content is None and use_cache and answer_cache.enabled:
+        cached_content = await answer_cache.get(cache_key)
+
+    chunks: list[str] = []
+    # passed explicitly: the steps of a streamed response may not share a context
+    usage = LLMUsage(task)
+    try:
+        if cached_content is not None:
+            chunks.append(cached_content)
+            yield "token", {"content": cached_content}
+        else:
+            async with circuit_breakers.guard(model_id), llm_limits.slot(model_id):
+                message = None
+                with observe_llm_call(model_id, call="stream", usage=usage):
+                    stream = async_llm_stream(prompt.messages, config.LLM_CHAINS[model_id])
+                    async for chunk in iterate_with_timeout(model_id, stream):
+                        # the usage of the call, if reported, comes with the chunks
+                        message = chunk if message is None else message + chunk
+                        if chunk.content:
+                            chunks.append(chunk.content)
+                            yield "token", {"content": chunk.content}
+                record_tokens(model_id, *token_counts(prompt.text, message, "".join(chunks)), usage=usage)
+    except Exception as e:
+        if not isinstance(e, CircuitOpen):
+            await run_db(
+                insert_llm_error,
+                question_id=question_id,
+                model_id=model_id,
+                prompt=prompt.text,
+                error=str(e),
+                request_id=current_request_id(),
+            )
+        yield "error", {"error": str(e)}
+        return
+
+    response: dict[str, str] = {}
+    response["model_name"] = config.LLM_ID_NAME[model_id]
+    response["model_id"] = model_id
+    response["content"] = "".join(chunks).strip()
+    if cached_content is None and use_cache and answer_cache.enabled:
+        await answer_cache.set(cache_key, response["content"])
+    response["answer_id"] = await run_db(
+        insert_answer,
+        content=response["content"],
+        model_id=model_id,
+        question_id=question_id,
+        frontend_order=frontend_order,
+        usage=usage.columns(),
+        prompt_version=None if model_id in reused else prompt.version,
+    )
+    yield "answer", response
+
+class AnswerNotFound(Exception):
+    """Raised for votes on answers that do not exist."""
+
+
 def update_answer(answer_id: int, upvote_change: int, downvote_change: int) -> None:
     """
-    Update the upvotes and downvotes of an answer
+    Update the upvotes and downvotes of an answer with a single atomic
+    UPDATE in the current transaction; the caller commits
     :param answer_id: the id of the answer
     :param upvote_change: the number of upvotes changed
     :param downvote_change: the number of downvotes changed
     :return: None
     """
 
-    answer = Answer.query.get(answer_id)
-    if not answer:
-        raise Exception("update_answer: Answer not found")
-    answer.upvotes += upvote_change
-    answer.downvotes += downvote_change
+    result = db.session.execute(
+        update(Answer.__table__)
+        .where(Answer.id == answer_id)
+        .values(
+            upvotes=db.func.coalesce(Answer.upvotes, 0) + upvote_change,
+            downvotes=db.func.coalesce(Answer.downvotes, 0) + downvote_change,
+        )
+    )
+    if result.rowcount == 0:
+        raise AnswerNotFound(f"answer not found: [{answer_id}]")
+
+def missing_answer_ids(answer_ids: list[int]) -> list[int]:
+    """
+    :param answer_ids: the ids of the answers voted on
+    :return: the ids with no answer, in order
+    """
+    found = set(db.session.scalars(select(Answer.id).where(Answer.id.in_(set(answer_ids)))))
+    return [answer_id for answer_id in dict.fromkeys(answer_ids) if answer_id not in found]
+
+def parse_answer_id(data: dict) -> int:
+    """
+    Read the answer id of a vote or feedback request
+    :param data: the decoded JSON body of the request
+    :return: the answer id
+    :raises ValueError: if the answer id is missing or not an integer
+    """
+    answer_id = data.get("answer_id")
+
+    if answer_id is None:
+        raise ValueError("answer_id is missing")
+    try:
+        return int(answer_id)
+    except ValueError:
+        raise ValueError("answer_id must be an integer")
+
+# vote action -> (upvote change, downvote change, feedback active)
+# accepting marks the feedback of the answer inactive, rejecting marks it active
+VOTE_ACTIONS = {
+    "accept": (1, 0, False),
+    "unaccept": (-1, 0, None),
+    "reject": (0, 1, True),
+    "unreject": (0, -1, None),
+}
+
+def vote_answer(
+    answer_id: int,
+    upvote_change: int,
+    downvote_change: int,
+    feedback_active: Optional[bool] = None
+) -> None:
+    """
+    Apply a vote to an answer in one transaction.
+    accept is tranlated to number of upvotes, reject to number of downvotes.
+    :param answer_id: the id of the answer
+    :param upvote_change: the number of upvotes changed
+    :param downvote_change: the number of downvotes changed
+    :param feedback_active: if set, mark all feedback of the answer active/inactive
+    :return: None
+    """
 
-    db.session.commit()
+    update_answer(answer_id, upvote_change, downvote_change)
+    record_vote_deltas({answer_id: (upvote_change, downvote_change)})
+    if feedback_active is not None:
+        set_feedback_active(answer_id, feedback_active)
+    commit()
 
-async def async_llm_call(prompt_text: int, llm_client) -> str:
-    # Create the prompt
-    system_message = SystemMessagePromptTemplate.from_template(
-        "You are a helpful programming assistant."
+def set_feedback_active(answer_id: int, active: bool) -> None:
+    """
+    Mark all feedback of an answer active/inactive in the current transaction
+    """
+    db.session.execute(
+        update(Feedback.__table__).where(Feedback.answer_id == answer_id).values(active=active)
     )
-    human_message = HumanMessagePromptTemplate.from_template("{input_text}")
-    chat_prompt = ChatPromptTemplate.from_messages([system_message, human_message])
 
-    # Format the prompt
-    messages = chat_prompt.format_prompt(input_text=prompt_text).to_messages()
+def parse_votes(data: dict) -> list[tuple[int, str]]:
+    """
+    Read the votes of a bulk vote request
+    :param data: the decoded JSON body, {"votes": [{"answer_id": ..., "action": ...}, ...]}
+    :return: (answer id, action) pairs in request order
+    :raises ValueError: if a vote is malformed
+    """
+    votes = data.get("votes")
+    if not isinstance(votes, list) or not votes:
+        raise ValueError("votes must be a non-empty list")
+
+    parsed = []
+    for vote in votes:
+        if not isinstance(vote, dict):
+            raise ValueError("each vote must be an object")
+        action = vote.get("action")
+        if action not in VOTE_ACTIONS:
+            raise ValueError(f"action must be one of {list(VOTE_ACTIONS)}")
+        parsed.append((parse_answer_id(vote), action))
+    return parsed
+
+def vote_answers(votes: list[tuple[int, str]]) -> None:
+    """
+    Apply a batch of votes in one transaction. The deltas of each answer are
+    summed into one UPDATE; the last vote that sets feedback activity wins.
+    :param votes: (answer id, action) pairs in the order they were cast
+    :return: None
+    :raises AnswerNotFound: if an answer does not exist; no vote is applied then
+    """
 
+    deltas: dict[int, list[int]] = {}
+    feedback_active: dict[int, bool] = {}
+    for answer_id, action in votes:
+        upvote_change, downvote_change, active = VOTE_ACTIONS[action]
+        delta = deltas.setdefault(answer_id, [0, 0])
+        delta[0] += upvote_change
+        delta[1] += downvote_change
+        if active is not None:
+            feedback_active[answer_id] = active
+
+    for answer_id, (upvote_change, downvote_change) in deltas.items():
+        update_answer(answer_id, upvote_change, downvote_change)
+    record_vote_deltas(deltas)
+    for answer_id, active in feedback_active.items():
+        set_feedback_active(answer_id, active)
+    commit()
+
+def upsert_feedback(answer_id: int, predefined_feedbacks: list, text_feedback: Optional[str]) -> None:
+    """
+    Add feedback for the answer in the database or update it if exists
+    :param answer_id: the id of the answer
+    :param predefined_feedbacks: the predefined feedback options chosen
+    :param text_feedback: the free text feedback (if any)
+    :return: None
+    """
+
+    feedback = Feedback.query.filter_by(answer_id=answer_id).first()
+
+    if feedback:
+        # If feedback exists, update the existing record
+        feedback.predefined_feedbacks = predefined_feedbacks
+        feedback.text_feedback = text_feedback
+    else:
+        # If no feedback exists, create a new feedback record
+        feedback = Feedback(
+            predefined_feedbacks=predefined_feedbacks,
+            text_feedback=text_feedback,
+            answer_id=answer_id,
+            active=True,
+        )
+        db.session.add(feedback)
+
+    commit()
+
+async def async_llm_call(messages: list[BaseMessage], llm_client) -> tuple[str, BaseMessage]:
     # Invoke the LLM asynchronously
     response = await llm_client.agenerate([messages])
 
-    # Extract and return the assistant"s reply along with the model name
-    return response.generations[0][0].text.strip()
\ No newline at end of file
+    # Return the assistant's reply and its message, which carries the token usage
+    generation = response.generations[0][0]
+    return generation.text.strip(), generation.message
+
+async def async_llm_stream(messages: list[BaseMessage], llm_client) -> AsyncIterator[BaseMessageChunk]:
+    # Stream the assistant's reply chunk by chunk
+    async for chunk in llm_client.astream(messages):
+        yield chunk
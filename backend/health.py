@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Optional
+
+from config import config
+from providers import import_report
+from resilience import circuit_breakers
+
+PENDING = "pending"
+HEALTHY = "healthy"
+FAILED = "failed"
+
+
+class ModelHealth:
+    """
+    Tracks whether each configured model has passed its sanity check.
+    Checks run concurrently on a background thread so workers can serve
+    requests while providers are still being probed.
+    """
+
+    def __init__(self, model_ids: list[str]):
+        self._lock = threading.Lock()
+        self._status = {
+            model_id: {"status": PENDING, "error": None, "latency": None, "checked_at": None}
+            for model_id in model_ids
+        }
+        self._thread: Optional[threading.Thread] = None
+
+    def is_healthy(self, model_id: str) -> bool:
+        with self._lock:
+            return self._status.get(model_id, {}).get("status") == HEALTHY
+
+    def healthy_model_ids(self) -> list[str]:
+        with self._lock:
+            return [model_id for model_id, status in self._status.items() if status["status"] == HEALTHY]
+
+    def available_model_ids(self) -> list[str]:
+        """the healthy models whose circuit breaker is not open"""
+        return [model_id for model_id in self.healthy_model_ids() if circuit_breakers.is_available(model_id)]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {model_id: dict(status) for model_id, status in self._status.items()}
+
+    def _set_status(self, model_id: str, status: str, error: Optional[str] = None, latency: Optional[float] = None):
+        with self._lock:
+            self._status[model_id] = {
+                "status": status,
+                "error": error,
+                "latency": latency,
+                "checked_at": time.time(),
+            }
+
+    def start_warmup(self) -> None:
+        """
+        Start probing the models on a daemon thread. Does nothing if the
+        warm-up is already running. When warm-up is disabled every model is
+        trusted as healthy.
+        """
+        if not config.LLM_WARMUP_ENABLED:
+            for model_id in self._status:
+                self._set_status(model_id, HEALTHY)
+            return
+
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="model-warmup", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        model_ids = list(self._status)
+        asyncio.run(self.check_models(model_ids, deadline=config.LLM_WARMUP_DEADLINE))
+        log_import_report()
+        while True:
+            if not config.LLM_WARMUP_RETRY_INTERVAL:
+                return
+            # only models that have not passed yet are probed again
+            model_ids = [model_id for model_id, status in self.snapshot().items() if status["status"] != HEALTHY]
+            if not model_ids:
+                return
+            time.sleep(config.LLM_WARMUP_RETRY_INTERVAL)
+            asyncio.run(self.check_models(model_ids, deadline=config.LLM_WARMUP_DEADLINE))
+
+    async def check_models(self, model_ids: list[str], *, deadline: float) -> None:
+        """
+        Sanity check models concurrently
+        :param model_ids: the ids of the models to check
+        :param deadline: seconds after which unfinished checks count as failed
+        """
+        tasks = {asyncio.create_task(self._check_model(model_id)): model_id for model_id in model_ids}
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=deadline)
+        for task in pending:
+            task.cancel()
+            model_id = tasks[task]
+            self._set_status(model_id, FAILED, error=f"sanity check did not finish within {deadline}s")
+            logging.error(f"<warmup> {model_id} did not pass the sanity check within {deadline}s")
+
+    async def _check_model(self, model_id: str) -> None:
+        start = time.perf_counter()
+        try:
+            # creating a client may block on the provider, keep it off the loop
+            llm_client = await asyncio.to_thread(config.LLM_CHAINS.__getitem__, model_id)
+            await llm_client.ainvoke("Sanity test")
+        except Exception as e:
+            self._set_status(model_id, FAILED, error=str(e))
+            logging.error(f"<warmup> Error with model {model_id}: {e}")
+            return
+        latency = time.perf_counter() - start
+        self._set_status(model_id, HEALTHY, latency=latency)
+        logging.info(f"<warmup> {model_id} passed the sanity check in {latency:.2f}s")
+
+
+def log_import_report() -> None:
+    """log how much importing each provider SDK cost this worker"""
+    for provider, cost in import_report().items():
+        logging.info(
+            f"<warmup> provider {provider}: {cost['seconds'] * 1000:.0f} ms, "
+            f"+{cost['max_rss_kb'] / 1024:.1f} MB peak RSS importing {', '.join(cost['modules'])}"
+        )
+
+
+model_health = ModelHealth(list(config.LLM_CHAINS.keys()))
@@ -0,0 +1,364 @@
+"""
+Asynchronous answer generation through a job queue in the database.
+
+POST /api/question with "async": true stores the question, queues one Job
+per model and returns right away. Workers claim queued jobs with a single
+UPDATE ... RETURNING, so any number of processes can share the queue
+without handing a job out twice, and run them through
+get_answer_from_model with at most jobs.concurrency jobs in flight each.
+Claimed jobs hold a lease, renewed by their worker while they run: the job
+of a worker that died is claimed again once its lease runs out, up to
+jobs.max_attempts times.
+
+Workers run in the app processes (jobs.worker_in_app) or on their own with
+`flask jobs work`. Clients poll GET /api/jobs/<id> or subscribe to the
+server-sent events of GET /api/questions/<id>/jobs/stream.
+"""
+import asyncio
+import concurrent.futures.thread
+import logging
+import os
+import signal
+import socket
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Optional
+
+import click
+from flask import Flask, current_app
+from flask.cli import AppGroup
+from sqlalchemy import and_, or_, select, update
+
+from config import config
+from database import commit, renewing
+from function import get_answer_from_model, run_db, run_read
+from models import db, Answer, Job, Question
+import tracing
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+FINISHED = (DONE, FAILED)
+
+
+def _now() -> datetime:
+    # naive UTC, like the timestamps SQLite stores
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def enqueue_jobs(*, question_id: int, model_ids: list[str], params: dict) -> list[int]:
+    """
+    Queue the generation of the answer of each model to a question
+    :param question_id: the id of the stored question
+    :param model_ids: the models to answer; frontend order follows their order
+    :param params: the answer request fields besides the question id and content
+    :return: the ids of the jobs, in the order of the models
+    """
+    jobs = [
+        Job(question_id=question_id, model_id=model_id, frontend_order=order, params=params)
+        for order, model_id in enumerate(model_ids)
+    ]
+    db.session.add_all(jobs)
+    commit()
+
+    return [job.id for job in jobs]
+
+
+def claim_jobs(*, worker_id: str, limit: int) -> list[dict]:
+    """
+    Take up to limit jobs off the queue, oldest first, including running
+    jobs whose lease has expired
+    :param worker_id: the worker taking the jobs
+    :param limit: the most jobs to take
+    :return: the fields for get_answer_from_model of each job, with its "job_id"
+    """
+    now = _now()
+    jobs = Job.__table__
+    expired = and_(jobs.c.status == RUNNING, jobs.c.lease_expires_at < now)
+    # jobs whose worker died too many times are not tried again
+    db.session.execute(
+        update(jobs)
+        .where(expired, jobs.c.attempts >= config.JOBS_MAX_ATTEMPTS)
+        .values(status=FAILED, error="the worker of the job stopped", finished_at=now)
+    )
+    claimable = (
+        select(jobs.c.id)
+        .where(or_(jobs.c.status == QUEUED, expired))
+        .order_by(jobs.c.id)
+        .limit(limit)
+    )
+    claimed = db.session.execute(
+        update(jobs)
+        .where(jobs.c.id.in_(claimable))
+        .values(
+            status=RUNNING,
+            worker_id=worker_id,
+            attempts=jobs.c.attempts + 1,
+            started_at=now,
+            lease_expires_at=now + timedelta(seconds=config.JOBS_LEASE),
+        )
+        .returning(jobs.c.id, jobs.c.question_id, jobs.c.model_id, jobs.c.frontend_order, jobs.c.params)
+    ).all()
+    contents = dict(db.session.execute(
+        select(Question.id, Question.content).where(Question.id.in_({job.question_id for job in claimed}))
+    ).all()) if claimed else {}
+    commit()
+
+    return [
+        {
+            **job.params,
+            "job_id": job.id,
+            "question_id": job.question_id,
+            "model_id": job.model_id,
+            "frontend_order": job.frontend_order,
+            "content": contents.get(job.question_id, ""),
+        }
+        for job in sorted(claimed, key=lambda job: job.id)
+    ]
+
+
+def renew_job_lease(job_id: int, *, worker_id: str) -> None:
+    """extend the lease of a running job, unless another worker has claimed it since"""
+    jobs = Job.__table__
+    db.session.execute(
+        update(jobs)
+        .where(jobs.c.id == job_id, jobs.c.worker_id == worker_id, jobs.c.status == RUNNING)
+        .values(lease_expires_at=_now() + timedelta(seconds=config.JOBS_LEASE))
+    )
+    commit()
+
+
+def finish_job(job_id: int, *, worker_id: str, answer_id: Optional[int] = None, error: Optional[str] = None) -> None:
+    """record the outcome of a job, unless another worker has claimed it since"""
+    jobs = Job.__table__
+    db.session.execute(
+        update(jobs)
+        .where(jobs.c.id == job_id, jobs.c.worker_id == worker_id, jobs.c.status == RUNNING)
+        .values(
+            status=FAILED if error is not None else DONE,
+            answer_id=answer_id,
+            error=error,
+            finished_at=_now(),
+            lease_expires_at=None,
+        )
+    )
+    commit()
+
+
+def job_to_dict(job: Job, answer: Optional[Answer]) -> dict:
+    result = {
+        "job_id": job.id,
+        "question_id": job.question_id,
+        "model_id": job.model_id,
+        "status": job.status,
+        "attempts": job.attempts,
+        "created_at": str(job.created_at),
+        "started_at": str(job.started_at) if job.started_at else None,
+        "finished_at": str(job.finished_at) if job.finished_at else None,
+    }
+    if job.status == FAILED:
+        result["error"] = job.error
+    if answer is not None:
+        # same fields as the response of /api/answer
+        result["answer"] = {
+            "answer_id": answer.id,
+            "model_id": answer.model_id,
+            "model_name": config.LLM_ID_NAME.get(answer.model_id, answer.model_id),
+            "content": answer.content,
+        }
+    return result
+
+
+def get_jobs(*, job_id: Optional[int] = None, question_id: Optional[int] = None) -> list[dict]:
+    """
+    :return: a job, or the jobs of a question in frontend order, with the answers of the done ones
+    """
+    query = Job.query
+    if job_id is not None:
+        query = query.filter(Job.id == job_id)
+    if question_id is not None:
+        query = query.filter(Job.question_id == question_id)
+    jobs = query.order_by(Job.frontend_order, Job.id).all()
+    answer_ids = [job.answer_id for job in jobs if job.answer_id is not None]
+    answers = {answer.id: answer for answer in Answer.query.filter(Answer.id.in_(answer_ids))} if answer_ids else {}
+    return [job_to_dict(job, answers.get(job.answer_id)) for job in jobs]
+
+
+async def job_events(question_id: int, *, timeout: float) -> AsyncIterator[tuple[str, dict]]:
+    """
+    Server-sent events of the jobs of a question: a "job" event as each one
+    finishes, then "done" once all have, or "timeout"
+    :param question_id: the id of the question
+    :param timeout: seconds to wait for the jobs
+    """
+    sent: set[int] = set()
+    deadline = asyncio.get_running_loop().time() + timeout
+    while True:
+        jobs = await run_read(get_jobs, question_id=question_id)
+        for job in jobs:
+            if job["status"] in FINISHED and job["job_id"] not in sent:
+                sent.add(job["job_id"])
+                yield "job", job
+        if all(job["status"] in FINISHED for job in jobs):
+            yield "done", {"question_id": question_id, "jobs": len(jobs)}
+            return
+        if asyncio.get_running_loop().time() >= deadline:
+            yield "timeout", {"question_id": question_id}
+            return
+        await asyncio.sleep(config.JOBS_POLL_INTERVAL)
+
+
+def queue_stats() -> dict:
+    counts = dict(db.session.execute(select(Job.status, db.func.count()).group_by(Job.status)).all())
+    return {status: counts.get(status, 0) for status in (QUEUED, RUNNING, DONE, FAILED)}
+
+
+class JobWorker:
+    """Runs queued jobs on a background thread, at most concurrency at a time."""
+
+    def __init__(self, *, concurrency: int, poll_interval: float):
+        self.concurrency = max(1, concurrency)
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        self.in_flight = 0
+        self.done = 0
+        self.failed = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, app: Flask) -> None:
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self.run, args=(app,), name="job-worker", daemon=True)
+        self._thread.start()
+        # not atexit: the interpreter shuts down the thread pools behind
+        # asyncio.to_thread before atexit runs, and the jobs in flight need
+        # them to record their results. These hooks run last registered
+        # first, and importing concurrent.futures.thread above registers the
+        # shutdown of the pools before this one.
+        threading._register_atexit(self.stop)
+
+    def stop(self) -> None:
+        """stop claiming jobs and wait for the ones in flight"""
+        if self._thread is None:
+            return
+        self.request_stop()
+        self._thread.join()
+        self._thread = None
+
+    def request_stop(self) -> None:
+        self._stopping = True
+        self.notify()
+
+    def notify(self) -> None:
+        """wake the worker up, for jobs queued by this process"""
+        loop, wake = self._loop, self._wake
+        if loop is not None and wake is not None:
+            try:
+                loop.call_soon_threadsafe(wake.set)
+            except RuntimeError:
+                # the loop has just closed
+                pass
+
+    def run(self, app: Flask) -> None:
+        """run jobs until stopped; blocks"""
+        with app.app_context():
+            asyncio.run(self._work())
+
+    async def _work(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        running: set[asyncio.Task] = set()
+        logging.info(f"<jobs> worker {self.worker_id} running {self.concurrency} jobs at a time")
+        try:
+            while not self._stopping:
+                free = self.concurrency - len(running)
+                claimed = []
+                if free > 0:
+                    try:
+                        claimed = await run_db(claim_jobs, worker_id=self.worker_id, limit=free)
+                    except Exception as e:
+                        logging.error(f"<jobs> Error in claiming jobs: {e}")
+                for fields in claimed:
+                    task = asyncio.create_task(self._run_job(fields))
+                    running.add(task)
+                    task.add_done_callback(running.discard)
+                    task.add_done_callback(lambda _: self._wake.set())
+                # woken up early by a finished job or a job queued by this process
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wake.clear()
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+        finally:
+            self._loop = None
+            self._wake = None
+
+    async def _run_job(self, fields: dict) -> None:
+        job_id = fields.pop("job_id")
+        with self._lock:
+            self.in_flight += 1
+        try:
+            # the request id of a job, in its logs and LLMError rows
+            with tracing.trace("job", request_id=f"job-{job_id}", **{"job.id": job_id, "model": fields["model_id"]}):
+                # retries, hedging and timeouts may outlast a single lease
+                async with renewing(
+                    lambda: run_db(renew_job_lease, job_id, worker_id=self.worker_id),
+                    interval=config.JOBS_LEASE / 3,
+                ):
+                    response = await get_answer_from_model(**fields)
+            await run_db(finish_job, job_id, worker_id=self.worker_id, answer_id=response["answer_id"])
+            outcome = "done"
+        except Exception as e:
+            logging.warning(f"<jobs> job {job_id} of {fields['model_id']} failed: {e}")
+            try:
+                await run_db(finish_job, job_id, worker_id=self.worker_id, error=str(e) or type(e).__name__)
+            except Exception as db_error:
+                # the lease runs out and the job is claimed again
+                logging.error(f"<jobs> Error in recording the failure of job {job_id}: {db_error}")
+            outcome = "failed"
+        with self._lock:
+            self.in_flight -= 1
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "running": self.running,
+                "worker_id": self.worker_id,
+                "concurrency": self.concurrency,
+                "in_flight": self.in_flight,
+                "done": self.done,
+                "failed": self.failed,
+            }
+
+
+job_worker = JobWorker(concurrency=config.JOBS_CONCURRENCY, poll_interval=config.JOBS_POLL_INTERVAL)
+
+
+jobs_cli = AppGroup("jobs", help="Run the answer generation job queue.")
+
+
+@jobs_cli.command("work")
+@click.option("--concurrency", type=int, default=None, help="Jobs in flight, default jobs.concurrency.")
+def work_command(concurrency: Optional[int]):
+    """Run queued jobs until interrupted."""
+    worker = JobWorker(concurrency=concurrency or config.JOBS_CONCURRENCY, poll_interval=config.JOBS_POLL_INTERVAL)
+    # finish the jobs in flight on ctrl-c or a service stop
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *_: worker.request_stop())
+    worker.run(current_app._get_current_object())
+    click.echo(f"stopped: {worker.stats()}")
@@ -0,0 +1,367 @@
+"""
+Model leaderboard from user votes.
+
+Two answers to the same question are a comparison between their models:
+the answer with the higher net score (upvotes - downvotes) wins, equal
+scores carry no preference. The wins of every model pair are kept in
+PairwiseResult per slice (all questions, per task and per language) and
+updated in the vote transaction, right after the vote counts, by a single
+INSERT ... SELECT over the questions the votes touch; that upsert is all a
+vote pays for. The Bradley-Terry ratings of a slice are
+refitted from those counts when its in-memory snapshot expires, which reads
+one row per model pair and writes nothing. ModelRating keeps the ratings
+and bootstrap confidence intervals of the last full recompute.
+"""
+import logging
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from itertools import combinations
+from typing import Iterable, Optional
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import delete, select, text
+from sqlalchemy.dialects.sqlite import insert
+
+from config import config
+from models import db, Answer, Question, PairwiseResult, ModelRating
+
+ALL = "all"
+
+# Elo scale of the ratings: a 400 point gap means 10:1 odds
+BASE_RATING = 1000
+SCALE = 400
+
+
+def question_slices(task: Optional[str], language: Optional[str], target_language: Optional[str]) -> list[str]:
+    """
+    :return: the leaderboard slices a question counts towards; translations
+        are sliced by their target language
+    """
+    slices = [ALL]
+    if task:
+        slices.append(f"task:{task}")
+    if language or target_language:
+        slices.append(f"language:{language or target_language}")
+    return slices
+
+
+def _outcome(score_a: int, score_b: int) -> int:
+    return (score_a > score_b) - (score_a < score_b)
+
+
+def _pair(model_x: str, model_y: str, outcome: int) -> tuple[str, str, int]:
+    # orders a comparison so that model_a < model_b
+    if model_x < model_y:
+        return model_x, model_y, outcome
+    return model_y, model_x, -outcome
+
+
+def fit_bradley_terry(pairs: Iterable[tuple[str, str, float, float]], iterations: int = 200) -> dict[str, float]:
+    """
+    Fit Bradley-Terry strengths with the MM algorithm
+    :param pairs: (model a, model b, wins of a, wins of b)
+    :param iterations: the most MM iterations
+    :return: the rating of each model on the Elo scale
+    """
+    wins: dict[str, float] = defaultdict(float)
+    games: dict[tuple[str, str], float] = {}
+    for model_a, model_b, wins_a, wins_b in pairs:
+        if wins_a + wins_b <= 0:
+            continue
+        # half a win each way keeps undefeated models finite
+        wins[model_a] += wins_a + 0.5
+        wins[model_b] += wins_b + 0.5
+        games[(model_a, model_b)] = games.get((model_a, model_b), 0.0) + wins_a + wins_b + 1
+
+    models = sorted(wins)
+    if not models:
+        return {}
+    strength = {model: 1.0 for model in models}
+    for _ in range(iterations):
+        denominators = dict.fromkeys(models, 0.0)
+        for (model_a, model_b), n in games.items():
+            share = n / (strength[model_a] + strength[model_b])
+            denominators[model_a] += share
+            denominators[model_b] += share
+        updated = {model: wins[model] / denominators[model] for model in models}
+        # normalize to a geometric mean of one
+        log_mean = sum(math.log(value) for value in updated.values()) / len(updated)
+        updated = {model: value / math.exp(log_mean) for model, value in updated.items()}
+        converged = max(abs(updated[model] - strength[model]) for model in models) < 1e-9
+        strength = updated
+        if converged:
+            break
+    return {model: BASE_RATING + SCALE * math.log10(value) for model, value in strength.items()}
+
+
+# the pairwise result changes of the questions whose answers just got votes,
+# from the vote counts after the votes and those counts minus the votes
+_RECORD_VOTE_DELTAS = """
+WITH delta (answer_id, up, down) AS (VALUES {values}),
+pair AS (
+    SELECT
+        question.task AS task,
+        COALESCE(NULLIF(question.language, ''), NULLIF(question.target_language, '')) AS language,
+        x.model_id AS model_a,
+        y.model_id AS model_b,
+        COALESCE(x.upvotes, 0) - COALESCE(x.downvotes, 0) AS score_a,
+        COALESCE(y.upvotes, 0) - COALESCE(y.downvotes, 0) AS score_b,
+        COALESCE(x.upvotes, 0) - COALESCE(x.downvotes, 0) - COALESCE(dx.up, 0) + COALESCE(dx.down, 0) AS before_a,
+        COALESCE(y.upvotes, 0) - COALESCE(y.downvotes, 0) - COALESCE(dy.up, 0) + COALESCE(dy.down, 0) AS before_b
+    FROM answer AS x
+    JOIN answer AS y ON y.question_id = x.question_id AND x.model_id < y.model_id
+    JOIN question ON question.id = x.question_id
+    LEFT JOIN delta AS dx ON dx.answer_id = x.id
+    LEFT JOIN delta AS dy ON dy.answer_id = y.id
+    WHERE x.question_id IN (SELECT answer.question_id FROM answer JOIN delta ON delta.answer_id = answer.id)
+      AND (dx.answer_id IS NOT NULL OR dy.answer_id IS NOT NULL)
+),
+change AS (
+    SELECT task, language, model_a, model_b,
+        (score_a > score_b) - (before_a > before_b) AS wins_a,
+        (score_a < score_b) - (before_a < before_b) AS wins_b
+    FROM pair
+),
+sliced AS (
+    SELECT :all AS slice, model_a, model_b, wins_a, wins_b FROM change
+    UNION ALL
+    SELECT 'task:' || task, model_a, model_b, wins_a, wins_b FROM change WHERE task IS NOT NULL AND task != ''
+    UNION ALL
+    SELECT 'language:' || language, model_a, model_b, wins_a, wins_b FROM change WHERE language IS NOT NULL
+)
+INSERT INTO pairwise_result (slice, model_a, model_b, wins_a, wins_b)
+SELECT slice, model_a, model_b, SUM(wins_a), SUM(wins_b) FROM sliced
+WHERE true
+GROUP BY slice, model_a, model_b
+HAVING SUM(wins_a) != 0 OR SUM(wins_b) != 0
+ON CONFLICT (slice, model_a, model_b) DO UPDATE SET
+    wins_a = pairwise_result.wins_a + excluded.wins_a,
+    wins_b = pairwise_result.wins_b + excluded.wins_b
+"""
+
+
+def record_vote_deltas(deltas: dict[int, tuple[int, int]]) -> None:
+    """
+    Update the pairwise results for votes just applied, with one statement.
+    Must run in the vote transaction, after the answer counters changed, so
+    the transaction only writes. Votes on answers that do not exist change
+    nothing.
+    :param deltas: answer id -> (upvote change, downvote change)
+    :return: None
+    """
+    if not deltas:
+        return
+    values = ", ".join(f"(:id_{i}, :up_{i}, :down_{i})" for i in range(len(deltas)))
+    params = {"all": ALL}
+    for i, (answer_id, (up, down)) in enumerate(deltas.items()):
+        params.update({f"id_{i}": answer_id, f"up_{i}": up, f"down_{i}": down})
+    db.session.execute(text(_RECORD_VOTE_DELTAS.format(values=values)), params)
+
+
+def _comparisons(pairs: Iterable[tuple[str, str, int, int]]) -> dict[str, int]:
+    comparisons: dict[str, int] = defaultdict(int)
+    for model_a, model_b, wins_a, wins_b in pairs:
+        comparisons[model_a] += wins_a + wins_b
+        comparisons[model_b] += wins_a + wins_b
+    return comparisons
+
+
+def _write_ratings(slice_name: str, ratings: dict[str, float], comparisons: dict[str, int], intervals: Optional[dict] = None) -> None:
+    db.session.execute(delete(ModelRating).where(
+        ModelRating.slice == slice_name, ModelRating.model_id.not_in(list(ratings))
+    ))
+    if not ratings:
+        return
+    statement = insert(ModelRating.__table__)
+    set_ = {"rating": statement.excluded.rating, "comparisons": statement.excluded.comparisons, "updated_at": db.func.now()}
+    if intervals is not None:
+        set_.update(ci_lower=statement.excluded.ci_lower, ci_upper=statement.excluded.ci_upper)
+    db.session.execute(
+        statement.on_conflict_do_update(index_elements=["slice", "model_id"], set_=set_),
+        [
+            {
+                "slice": slice_name,
+                "model_id": model_id,
+                "rating": rating,
+                "comparisons": comparisons.get(model_id, 0),
+                "ci_lower": (intervals or {}).get(model_id, (None, None))[0],
+                "ci_upper": (intervals or {}).get(model_id, (None, None))[1],
+            }
+            for model_id, rating in ratings.items()
+        ],
+    )
+
+
+class LeaderboardSnapshots:
+    """Short-lived in-memory leaderboard slices, refitted from PairwiseResult when they expire."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._snapshots: dict[str, tuple[float, list[dict]]] = {}
+
+    def get(self, slice_name: str) -> list[dict]:
+        """
+        :return: the models of a slice by descending rating
+        """
+        with self._lock:
+            cached = self._snapshots.get(slice_name)
+        if cached is not None and time.monotonic() - cached[0] < self.ttl:
+            return cached[1]
+
+        pairs = db.session.execute(
+            select(PairwiseResult.model_a, PairwiseResult.model_b, PairwiseResult.wins_a, PairwiseResult.wins_b)
+            .where(PairwiseResult.slice == slice_name)
+        ).all()
+        ratings = fit_bradley_terry(pairs)
+        comparisons = _comparisons(pairs)
+        # the intervals of the last full recompute
+        intervals = {
+            row.model_id: (row.ci_lower, row.ci_upper)
+            for row in db.session.execute(
+                select(ModelRating.model_id, ModelRating.ci_lower, ModelRating.ci_upper)
+                .where(ModelRating.slice == slice_name)
+            )
+        }
+        models = []
+        for model_id, rating in sorted(ratings.items(), key=lambda item: item[1], reverse=True):
+            ci_lower, ci_upper = intervals.get(model_id, (None, None))
+            models.append({
+                "model_id": model_id,
+                "model_name": config.LLM_ID_NAME.get(model_id, model_id),
+                "rating": round(rating, 1),
+                "comparisons": comparisons.get(model_id, 0),
+                "ci_lower": None if ci_lower is None else round(ci_lower, 1),
+                "ci_upper": None if ci_upper is None else round(ci_upper, 1),
+            })
+        with self._lock:
+            self._snapshots[slice_name] = (time.monotonic(), models)
+        return models
+
+
+leaderboard_snapshots = LeaderboardSnapshots(ttl=config.LEADERBOARD_CACHE_TTL)
+
+
+def parse_slice(args) -> str:
+    """
+    :param args: the query arguments of a leaderboard request
+    :return: the requested slice
+    :raises ValueError: if both task and language are given
+    """
+    task = args.get("task")
+    language = args.get("language")
+    if task and language:
+        raise ValueError("filter the leaderboard by task or by language, not both")
+    if task:
+        return f"task:{task}"
+    if language:
+        return f"language:{language}"
+    return ALL
+
+
+def _question_comparisons() -> Iterable[tuple[list[str], list[tuple[str, str, int]]]]:
+    # (slices, decided comparisons) of every question, streaming the answers
+    rows = db.session.execute(
+        select(
+            Answer.question_id, Answer.model_id, Answer.upvotes, Answer.downvotes,
+            Question.task, Question.language, Question.target_language,
+        )
+        .join(Question, Question.id == Answer.question_id)
+        .order_by(Answer.question_id)
+        .execution_options(yield_per=1000)
+    )
+    current_id, current = None, []
+
+    def comparisons(question_answers):
+        decided = []
+        for x, y in combinations(question_answers, 2):
+            outcome = _outcome((x.upvotes or 0) - (x.downvotes or 0), (y.upvotes or 0) - (y.downvotes or 0))
+            if x.model_id != y.model_id and outcome:
+                decided.append(_pair(x.model_id, y.model_id, outcome))
+        first = question_answers[0]
+        return question_slices(first.task, first.language, first.target_language), decided
+
+    for row in rows:
+        if row.question_id != current_id and current:
+            yield comparisons(current)
+            current = []
+        current_id = row.question_id
+        current.append(row)
+    if current:
+        yield comparisons(current)
+
+
+def _count(questions: Iterable[list[tuple[str, str, int]]]) -> list[tuple[str, str, int, int]]:
+    counts: dict[tuple[str, str], list[int]] = defaultdict(lambda: [0, 0])
+    for decided in questions:
+        for model_a, model_b, outcome in decided:
+            counts[(model_a, model_b)][0 if outcome > 0 else 1] += 1
+    return [(model_a, model_b, wins_a, wins_b) for (model_a, model_b), (wins_a, wins_b) in counts.items()]
+
+
+def recompute(samples: int, seed: Optional[int] = None) -> dict[str, int]:
+    """
+    Rebuild the pairwise results and ratings of every slice from all answers,
+    with bootstrap confidence intervals over questions
+    :param samples: the number of bootstrap resamples, 0 to skip the intervals
+    :param seed: seed of the resampling, for reproducible intervals
+    :return: the number of questions with comparisons in each slice
+    """
+    by_slice: dict[str, list[list[tuple[str, str, int]]]] = defaultdict(list)
+    for slices, decided in _question_comparisons():
+        if decided:
+            for slice_name in slices:
+                by_slice[slice_name].append(decided)
+
+    rng = random.Random(seed)
+    db.session.execute(delete(PairwiseResult))
+    db.session.execute(delete(ModelRating))
+    for slice_name, questions in by_slice.items():
+        pairs = _count(questions)
+        db.session.execute(
+            insert(PairwiseResult.__table__),
+            [
+                {"slice": slice_name, "model_a": model_a, "model_b": model_b, "wins_a": wins_a, "wins_b": wins_b}
+                for model_a, model_b, wins_a, wins_b in pairs
+            ],
+        )
+        ratings = fit_bradley_terry(pairs)
+        comparisons = _comparisons(pairs)
+
+        intervals = None
+        if samples:
+            resampled: dict[str, list[float]] = defaultdict(list)
+            for _ in range(samples):
+                sample = rng.choices(questions, k=len(questions))
+                for model_id, rating in fit_bradley_terry(_count(sample)).items():
+                    resampled[model_id].append(rating)
+            intervals = {}
+            for model_id, values in resampled.items():
+                values.sort()
+                intervals[model_id] = (
+                    values[int(0.025 * (len(values) - 1))],
+                    values[int(0.975 * (len(values) - 1))],
+                )
+        _write_ratings(slice_name, ratings, comparisons, intervals)
+    db.session.commit()
+    return {slice_name: len(questions) for slice_name, questions in by_slice.items()}
+
+
+leaderboard_cli = AppGroup("leaderboard", help="Maintain the model leaderboard.")
+
+
+@leaderboard_cli.command("recompute")
+@click.option("--samples", type=int, default=lambda: config.LEADERBOARD_BOOTSTRAP_SAMPLES, show_default="leaderboard.bootstrap_samples",
+              help="Bootstrap resamples for the confidence intervals, 0 to skip them.")
+@click.option("--seed", type=int, default=None, help="Seed of the bootstrap resampling.")
+def recompute_command(samples: int, seed: Optional[int]):
+    """Rebuild the leaderboard from all answers."""
+    start = time.perf_counter()
+    counts = recompute(samples, seed)
+    logging.info(f"<leaderboard> recomputed {len(counts)} slices in {time.perf_counter() - start:.1f}s")
+    for slice_name, questions in sorted(counts.items()):
+        click.echo(f"{slice_name}: {questions} questions")
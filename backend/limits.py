@@ -0,0 +1,249 @@
+import asyncio
+import contextlib
+import logging
+import threading
+import time
+from collections import deque
+from typing import AsyncIterator, Optional
+
+from config import config
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a request waited longer than allowed for a provider slot."""
+
+
+def is_rate_limit_error(error: BaseException) -> bool:
+    """
+    Whether a provider error means we are sending too many requests.
+    The LangChain clients surface the SDK errors, which expose the HTTP status
+    in different places depending on the provider.
+    """
+    if isinstance(error, RateLimitExceeded):
+        # our own queue timed out; the provider did not push back
+        return False
+    for candidate in (error, getattr(error, "response", None)):
+        if getattr(candidate, "status_code", None) == 429 or getattr(candidate, "code", None) == 429:
+            return True
+    name = type(error).__name__
+    message = str(error).lower()
+    return (
+        "RateLimit" in name
+        or "ResourceExhausted" in name
+        or "429" in message
+        or "rate limit" in message
+        or "too many requests" in message
+    )
+
+
+def _resolve(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency semaphore plus token bucket for one provider or model.
+    Both limits are scaled down when the provider answers 429 and recover
+    step by step while requests succeed. The limiter is thread-safe and can
+    be awaited from any event loop, since flask runs each async view on its
+    own loop.
+    """
+
+    # scale never drops below this fraction of the configured limits
+    MIN_SCALE = 0.1
+    # 429s within this many seconds of the last decrease count as the same burst
+    DECREASE_COOLDOWN = 5.0
+
+    def __init__(self, name: str, *, max_concurrency: Optional[int], requests_per_second: Optional[float], burst: Optional[int]):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.requests_per_second = requests_per_second
+        self.burst = burst or max(1, int(requests_per_second or 1))
+        self._lock = threading.Lock()
+        self._scale = 1.0
+        self._last_decrease = 0.0
+        self._successes = 0
+        self._in_use = 0
+        self._waiters: deque = deque()
+        self._tokens = float(self.burst)
+        self._refilled_at = time.monotonic()
+
+    @property
+    def concurrency_limit(self) -> Optional[int]:
+        if self.max_concurrency is None:
+            return None
+        return max(1, int(self.max_concurrency * self._scale))
+
+    @property
+    def rate(self) -> Optional[float]:
+        if self.requests_per_second is None:
+            return None
+        return self.requests_per_second * self._scale
+
+    async def acquire(self, timeout: float) -> None:
+        """
+        Wait for a rate token and a concurrency slot
+        :param timeout: the longest time to wait, in seconds
+        :raises RateLimitExceeded: if the wait would take longer than timeout
+        """
+        deadline = time.monotonic() + timeout
+        await self._take_token(timeout)
+        await self._take_slot(max(0.0, deadline - time.monotonic()))
+
+    async def _take_token(self, timeout: float) -> None:
+        if self.requests_per_second is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            rate = self.rate
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * rate)
+            self._refilled_at = now
+            wait = max(0.0, (1 - self._tokens) / rate)
+            if wait > timeout:
+                raise RateLimitExceeded(f"{self.name}: rate limit wait of {wait:.1f}s exceeds {timeout:.1f}s")
+            # reserve the token now; waiting callers queue up behind each other
+            self._tokens -= 1
+        if wait:
+            await asyncio.sleep(wait)
+
+    async def _take_slot(self, timeout: float) -> None:
+        if self.max_concurrency is None:
+            return
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._in_use < self.concurrency_limit and not self._waiters:
+                self._in_use += 1
+                return
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+
+        try:
+            await asyncio.wait_for(waiter[1], timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            with self._lock:
+                granted = waiter not in self._waiters
+                if not granted:
+                    self._waiters.remove(waiter)
+            if granted and isinstance(e, asyncio.TimeoutError):
+                # the slot was handed over just as the wait ran out
+                return
+            if granted:
+                self.release()
+            if isinstance(e, asyncio.TimeoutError):
+                raise RateLimitExceeded(f"{self.name}: no free slot within {timeout:.1f}s")
+            raise
+
+    def release(self) -> None:
+        if self.max_concurrency is None:
+            return
+        with self._lock:
+            self._in_use -= 1
+            self._wake_waiters()
+
+    def _wake_waiters(self) -> None:
+        # must be called with the lock held; slots are counted for the waiter
+        while self._waiters and self._in_use < self.concurrency_limit:
+            loop, future = self._waiters.popleft()
+            try:
+                loop.call_soon_threadsafe(_resolve, future)
+            except RuntimeError:
+                # the waiter's event loop is gone
+                continue
+            self._in_use += 1
+
+    def on_rate_limited(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_decrease < self.DECREASE_COOLDOWN:
+                return
+            self._last_decrease = now
+            self._successes = 0
+            self._scale = max(self.MIN_SCALE, self._scale / 2)
+            logging.warning(
+                f"<limits> {self.name} is rate limited, backing off to concurrency "
+                f"{self.concurrency_limit} and rate {self.rate}"
+            )
+
+    def on_success(self) -> None:
+        with self._lock:
+            if self._scale >= 1.0:
+                return
+            self._successes += 1
+            # grow back by a tenth after a full window of successful requests
+            if self._successes >= (self.concurrency_limit or 10):
+                self._successes = 0
+                self._scale = min(1.0, self._scale + 0.1)
+                if self.max_concurrency is not None:
+                    self._wake_waiters()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "concurrency_limit": self.concurrency_limit,
+                "in_use": self._in_use,
+                "waiting": len(self._waiters),
+                "requests_per_second": self.rate,
+                "scale": self._scale,
+            }
+
+
+class LLMLimits:
+    """The provider and model limiters configured for the LLM clients."""
+
+    def __init__(self):
+        self._limiters: dict[str, AdaptiveLimiter] = {}
+        for source, limits in config.LLM_PROVIDER_LIMITS.items():
+            self._add(f"provider:{source}", limits)
+        for model_id, model in config.LLM_ID_CONFIG.items():
+            self._add(f"model:{model_id}", model)
+
+    def _add(self, name: str, limits: dict) -> None:
+        if limits.get("max_concurrency") is None and limits.get("requests_per_second") is None:
+            return
+        self._limiters[name] = AdaptiveLimiter(
+            name,
+            max_concurrency=limits.get("max_concurrency"),
+            requests_per_second=limits.get("requests_per_second"),
+            burst=limits.get("burst"),
+        )
+
+    def _limiters_for(self, model_id: str) -> list[AdaptiveLimiter]:
+        # always provider before model so waiters cannot deadlock each other
+        names = (f"provider:{config.LLM_ID_SOURCE.get(model_id)}", f"model:{model_id}")
+        return [self._limiters[name] for name in names if name in self._limiters]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, model_id: str) -> AsyncIterator[None]:
+        """
+        Hold a slot for one provider call of a model, queueing for at most
+        llm.limits.max_wait seconds. Limits back off when the call fails with
+        a rate limit error.
+        :param model_id: the id of the model
+        :raises RateLimitExceeded: if no slot frees up in time
+        """
+        limiters = self._limiters_for(model_id)
+        deadline = time.monotonic() + config.LLM_LIMITS_MAX_WAIT
+        acquired: list[AdaptiveLimiter] = []
+        try:
+            for limiter in limiters:
+                await limiter.acquire(max(0.0, deadline - time.monotonic()))
+                acquired.append(limiter)
+            try:
+                yield
+            except Exception as e:
+                if is_rate_limit_error(e):
+                    for limiter in limiters:
+                        limiter.on_rate_limited()
+                raise
+            for limiter in limiters:
+                limiter.on_success()
+        finally:
+            for limiter in reversed(acquired):
+                limiter.release()
+
+    def stats(self) -> dict:
+        return {name: limiter.stats() for name, limiter in self._limiters.items()}
+
+
+llm_limits = LLMLimits()
@@ -0,0 +1,147 @@
+"""
+Logging setup from the logging section of the config.
+
+Records are put on a bounded in-memory queue by the thread that logs them
+and written to the console or the rotating log file by a background
+listener, so requests never wait on log I/O. When the queue is full, new
+records are dropped and counted rather than blocking. Messages and extra
+fields longer than logging.max_field_length are truncated before they are
+queued. Records are written as text lines, or with logging.format: "json"
+as one JSON object per line.
+"""
+import atexit
+import copy
+import json
+import logging
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Optional
+
+# attributes of every LogRecord; any other attribute was passed through extra=
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id"}
+
+
+def truncate(value: str, max_length: int) -> str:
+    if max_length <= 0 or len(value) <= max_length:
+        return value
+    return f"{value[:max_length]}... [{len(value) - max_length} more characters]"
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object, with its extra fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Queues records for the listener, truncating large fields and dropping records when the queue is full."""
+
+    def __init__(self, log_queue: queue.Queue, *, max_field_length: int):
+        super().__init__(log_queue)
+        self.max_field_length = max_field_length
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # formats the message and the traceback in the logging thread, without the handler's formatter
+        record = copy.copy(record)
+        record.message = truncate(record.getMessage(), self.max_field_length)
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and isinstance(value, str):
+                setattr(record, key, truncate(value, self.max_field_length))
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+
+_listener: Optional[QueueListener] = None
+_queue_handler: Optional[NonBlockingQueueHandler] = None
+
+
+def setup_logging(
+    *,
+    log_file: Optional[str],
+    level: str,
+    log_format: str,
+    max_bytes: int,
+    backup_count: int,
+    queue_size: int,
+    max_field_length: int,
+    levels: dict[str, str]
+) -> None:
+    """
+    Send the records of the root logger through a queue to the console or a rotating file
+    :param log_file: the file to write to, or None for the console
+    :param level: the lowest level logged
+    :param log_format: "text" or "json"
+    :param max_bytes: the size at which the log file is rotated
+    :param backup_count: the rotated files kept
+    :param queue_size: the most records waiting to be written
+    :param max_field_length: characters kept of the message and each extra field, 0 for all
+    :param levels: logger name -> lowest level logged, e.g. to quiet the HTTP clients of the providers
+    """
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+
+    if log_file is None:
+        output = logging.StreamHandler()
+    else:
+        output = RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    if log_format == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        # request_id is set on records by tracing.init_app
+        output.setFormatter(logging.Formatter(
+            "%(asctime)s - %(name)s - %(levelname)s - %(request_id)s - %(message)s", defaults={"request_id": "-"}
+        ))
+
+    _queue_handler = NonBlockingQueueHandler(queue.Queue(maxsize=queue_size), max_field_length=max_field_length)
+    root_logger = logging.getLogger()
+    root_logger.addHandler(_queue_handler)
+    root_logger.setLevel(level)
+    for name, logger_level in levels.items():
+        logging.getLogger(name).setLevel(logger_level)
+
+    _listener = QueueListener(_queue_handler.queue, output, respect_handler_level=True)
+    _listener.start()
+    # write the queued records before the process exits
+    atexit.register(stop_logging)
+
+
+def stop_logging() -> None:
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def stats() -> dict:
+    if _queue_handler is None:
+        return {}
+    return {"queued": _queue_handler.queue.qsize(), "dropped": _queue_handler.dropped}
@@ -0,0 +1,376 @@
+"""
+Latency, token, cost and error metrics of the model calls, served by
+GET /metrics in the Prometheus text format.
+
+Each provider call is timed per model, task and kind of call (generate or
+stream), and counts its prompt and completion tokens as reported by the
+provider, or estimated at about 4 characters per token when the provider
+reports none. The cost of a call comes from the input_price and
+output_price of its model entry, in dollars per million tokens. Database
+writes are timed per write function, including the wait for the writer.
+
+Metrics are kept per process. With several app workers, set
+metrics.directory: every process then writes its metrics there every
+metrics.flush_interval seconds, and /metrics serves the sum over all of
+them. A process that exits merges its totals into one file of all stopped
+processes and removes its own, so the directory does not grow with worker
+restarts. With metrics.store_usage, the latency, tokens and cost of the calls
+behind an answer are also stored on its Answer row.
+"""
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterable, Iterator, Optional
+
+from config import config
+
+LLM_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+DB_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+CHARS_PER_TOKEN = 4
+
+# the totals of the processes that stopped, in metrics.directory
+STOPPED_FILE = "stopped.json"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    labels = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Counter:
+    """A monotonically increasing value per combination of labels."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def snapshot(self) -> dict[tuple, float]:
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def merge(total: float, value: float) -> float:
+        return total + value
+
+    def render(self, values: dict[tuple, float]) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labels, key)} {value:g}" for key, value in sorted(values.items())]
+
+
+class Histogram:
+    """Observations counted into buckets per combination of labels."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...], buckets: tuple[float, ...]):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # per label values: count of each bucket (not cumulative), of +Inf, then the sum
+        self._values: dict[tuple, list[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self._lock:
+            counts = self._values.setdefault(key, [0.0] * (len(self.buckets) + 2))
+            counts[index] += 1
+            counts[-1] += value
+
+    def snapshot(self) -> dict[tuple, list[float]]:
+        with self._lock:
+            return {key: list(counts) for key, counts in self._values.items()}
+
+    @staticmethod
+    def merge(total: list[float], value: list[float]) -> list[float]:
+        return [a + b for a, b in zip(total, value)]
+
+    def render(self, values: dict[tuple, list[float]]) -> list[str]:
+        lines = []
+        for key, counts in sorted(values.items()):
+            cumulative = 0.0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = f'le="{bound:g}"' if bound != "+Inf" else 'le="+Inf"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative:g}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {counts[-1]:g}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative:g}")
+        return lines
+
+
+class MetricsRegistry:
+    """The metrics of this process, optionally shared with the other workers through files."""
+
+    def __init__(self, *, directory: Optional[str], flush_interval: float):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.metrics: dict[str, Counter | Histogram] = {}
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._file_name: Optional[str] = None
+
+    def counter(self, name: str, help_text: str, labels: tuple[str, ...]) -> Counter:
+        self.metrics[name] = Counter(name, help_text, labels)
+        return self.metrics[name]
+
+    def histogram(self, name: str, help_text: str, labels: tuple[str, ...], buckets: tuple[float, ...]) -> Histogram:
+        self.metrics[name] = Histogram(name, help_text, labels, buckets)
+        return self.metrics[name]
+
+    def start(self) -> None:
+        """write the metrics of this process to metrics.directory in the background"""
+        if self._thread is not None or not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        # unique per run, so a process reusing the pid of a stopped one does not overwrite its totals
+        self._file_name = f"{os.getpid()}-{uuid.uuid4().hex[:8]}.json"
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="metrics-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        self.write()
+        try:
+            self._retire()
+        except (OSError, ValueError) as e:
+            logging.error(f"<metrics> Error in merging the metrics into {STOPPED_FILE}: {e}")
+
+    def _run(self) -> None:
+        while not self._stopping.wait(self.flush_interval):
+            try:
+                self.write()
+            except OSError as e:
+                logging.error(f"<metrics> Error in writing the metrics: {e}")
+
+    def write(self) -> None:
+        self._dump(self._file_name, {name: metric.snapshot() for name, metric in self.metrics.items()})
+
+    def _dump(self, file_name: str, snapshot: dict[str, dict]) -> None:
+        data = {name: [[list(key), value] for key, value in values.items()] for name, values in snapshot.items()}
+        # written aside and renamed, so readers never see a partial file
+        path = os.path.join(self.directory, file_name)
+        with open(f"{path}.tmp", "w") as file:
+            json.dump(data, file)
+        os.replace(f"{path}.tmp", path)
+
+    def _load(self, file_name: str) -> dict[str, dict]:
+        with open(os.path.join(self.directory, file_name)) as file:
+            data = json.load(file)
+        return {name: {tuple(key): value for key, value in values} for name, values in data.items()}
+
+    @contextmanager
+    def _locked(self, exclusive: bool) -> Iterator[None]:
+        # readers share the lock, so they never see a process both merged and in its own file
+        with open(os.path.join(self.directory, ".lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _retire(self) -> None:
+        """merge the file of this process into STOPPED_FILE and remove it"""
+        with self._locked(exclusive=True):
+            stopped = self._load(STOPPED_FILE) if os.path.exists(os.path.join(self.directory, STOPPED_FILE)) else {}
+            self._dump(STOPPED_FILE, self._merge([stopped, self._load(self._file_name)]))
+            os.remove(os.path.join(self.directory, self._file_name))
+        self._file_name = None
+
+    def _merge(self, snapshots: Iterable[dict[str, dict]]) -> dict[str, dict]:
+        totals: dict[str, dict] = {name: {} for name in self.metrics}
+        for snapshot in snapshots:
+            for name, values in snapshot.items():
+                metric = self.metrics.get(name)
+                if metric is None:
+                    continue
+                for key, value in values.items():
+                    total = totals[name].get(key)
+                    totals[name][key] = value if total is None else metric.merge(total, value)
+        return totals
+
+    def _snapshots(self) -> Iterator[dict[str, dict]]:
+        yield {name: metric.snapshot() for name, metric in self.metrics.items()}
+        if self._file_name is None:
+            return
+        with self._locked(exclusive=False):
+            for file_name in os.listdir(self.directory):
+                if not file_name.endswith(".json") or file_name == self._file_name:
+                    continue
+                try:
+                    yield self._load(file_name)
+                except (OSError, ValueError):
+                    continue
+
+    def render(self) -> str:
+        """the metrics of all processes in the Prometheus text format"""
+        totals = self._merge(self._snapshots())
+
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric.help_text}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            lines.extend(metric.render(totals[name]))
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry(directory=config.METRICS_DIRECTORY, flush_interval=config.METRICS_FLUSH_INTERVAL)
+
+llm_call_seconds = registry.histogram(
+    "lmcode_llm_call_seconds", "Duration of provider calls.", ("model", "task", "call"), LLM_BUCKETS
+)
+llm_errors = registry.counter(
+    "lmcode_llm_errors_total", "Failed provider calls.", ("model", "task", "error")
+)
+llm_tokens = registry.counter(
+    "lmcode_llm_tokens_total", "Prompt and completion tokens of provider calls.", ("model", "task", "kind")
+)
+llm_cost = registry.counter(
+    "lmcode_llm_cost_dollars_total", "Estimated cost of provider calls.", ("model", "task")
+)
+db_write_seconds = registry.histogram(
+    "lmcode_db_write_seconds", "Duration of database writes, including the wait for the writer.", ("operation",), DB_BUCKETS
+)
+
+
+class LLMUsage:
+    """Provider time, tokens and cost of the calls made for one answer."""
+
+    def __init__(self, task: str):
+        self.task = task
+        self.calls = 0
+        self.latency = 0.0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+
+    def columns(self) -> dict:
+        """the usage columns of the Answer, empty if not stored or no call was made"""
+        if not config.METRICS_STORE_USAGE or not self.calls:
+            return {}
+        return {
+            "latency": self.latency,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cost": self.cost,
+        }
+
+
+_usage: ContextVar[Optional[LLMUsage]] = ContextVar("llm_usage", default=None)
+
+
+@contextmanager
+def track_usage(task: str) -> Iterator[LLMUsage]:
+    """
+    Collect the usage of the provider calls made by this asyncio task, and
+    by the tasks it starts, for one answer
+    :param task: the task of the question, as the label of the metrics
+    """
+    usage = LLMUsage(task)
+    token = _usage.set(usage)
+    try:
+        yield usage
+    finally:
+        _usage.reset(token)
+
+
+@contextmanager
+def observe_llm_call(model_id: str, *, call: str, usage: Optional[LLMUsage] = None) -> Iterator[None]:
+    """
+    Time one provider call and count it if it fails
+    :param model_id: the model called
+    :param call: "generate" or "stream"
+    :param usage: the usage to add the call to, default that of track_usage
+    """
+    usage = usage or _usage.get()
+    task = usage.task if usage is not None else ""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        llm_errors.inc(model=model_id, task=task, error=type(e).__name__)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        llm_call_seconds.observe(elapsed, model=model_id, task=task, call=call)
+        if usage is not None:
+            usage.calls += 1
+            usage.latency += elapsed
+
+
+def token_counts(prompt_text: str, message, content: str) -> tuple[int, int]:
+    """
+    :param prompt_text: the prompt sent
+    :param message: the AIMessage of the reply, if any
+    :param content: the text of the reply
+    :return: the prompt and completion tokens, as reported by the provider or estimated
+    """
+    usage_metadata = getattr(message, "usage_metadata", None)
+    if usage_metadata:
+        return usage_metadata.get("input_tokens", 0), usage_metadata.get("output_tokens", 0)
+    response_metadata = getattr(message, "response_metadata", None) or {}
+    token_usage = response_metadata.get("token_usage") or response_metadata.get("usage") or {}
+    prompt_tokens = token_usage.get("prompt_tokens", token_usage.get("input_tokens"))
+    completion_tokens = token_usage.get("completion_tokens", token_usage.get("output_tokens"))
+    if prompt_tokens is not None and completion_tokens is not None:
+        return prompt_tokens, completion_tokens
+    return len(prompt_text) // CHARS_PER_TOKEN + 1, len(content) // CHARS_PER_TOKEN + 1
+
+
+def record_tokens(model_id: str, prompt_tokens: int, completion_tokens: int, *, usage: Optional[LLMUsage] = None) -> None:
+    """
+    Count the tokens and the cost of a provider call
+    :param usage: the usage to add the call to, default that of track_usage
+    """
+    usage = usage or _usage.get()
+    task = usage.task if usage is not None else ""
+    model = config.LLM_ID_CONFIG.get(model_id, {})
+    cost = (
+        prompt_tokens * model.get("input_price", 0.0) + completion_tokens * model.get("output_price", 0.0)
+    ) / 1_000_000
+    llm_tokens.inc(prompt_tokens, model=model_id, task=task, kind="prompt")
+    llm_tokens.inc(completion_tokens, model=model_id, task=task, kind="completion")
+    llm_cost.inc(cost, model=model_id, task=task)
+    if usage is not None:
+        usage.prompt_tokens += prompt_tokens
+        usage.completion_tokens += completion_tokens
+        usage.cost += cost
+
+
+@contextmanager
+def observe_db_write(operation: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        db_write_seconds.observe(time.perf_counter() - start, operation=operation)
@@ -0,0 +1,171 @@
+"""
+Local mock chat model for load tests, configured as the "mock" provider.
+
+Answers are deterministic: the same model and prompt always give the same
+content. Latency, streaming speed and failures are drawn from the
+distributions in the model entry of the config:
+
+    llm:
+      mock:
+        - id: "mock-fast"
+          name: "Mock-fast"
+          answer_tokens: 120 # words per answer
+          latency: {distribution: "lognormal", median: 0.5, sigma: 0.4} # seconds
+          stream_rate: 50 # chunks per second when streaming
+          error_rate: 0.01 # share of calls failing with a server error
+          rate_limit_rate: 0.02 # share of calls rejected with a 429
+          seed: 1 # of the latency and failure draws; unset for a random run
+
+Latency distributions: constant (value), uniform (min, max), normal (mean,
+stddev), lognormal (median, sigma) and exponential (mean).
+"""
+import asyncio
+import hashlib
+import math
+import random
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.pydantic_v1 import PrivateAttr
+
+_WORDS = (
+    "def return if else for while in range len list dict value result index item "
+    "count total node left right key data self None True False print append sort"
+).split()
+
+
+class MockProviderError(Exception):
+    status_code = 500
+
+
+class MockRateLimitError(Exception):
+    # recognized by limits.is_rate_limit_error like the 429 of a real provider
+    status_code = 429
+
+
+def sample_latency(spec: dict, rng: random.Random) -> float:
+    """
+    :param spec: the latency entry of a mock model
+    :return: a latency in seconds
+    """
+    distribution = spec.get("distribution", "constant")
+    if distribution == "constant":
+        return float(spec.get("value", 0.0))
+    if distribution == "uniform":
+        return rng.uniform(spec.get("min", 0.0), spec.get("max", 1.0))
+    if distribution == "normal":
+        return max(0.0, rng.gauss(spec.get("mean", 1.0), spec.get("stddev", 0.0)))
+    if distribution == "lognormal":
+        return rng.lognormvariate(math.log(spec.get("median", 1.0)), spec.get("sigma", 0.5))
+    if distribution == "exponential":
+        return rng.expovariate(1 / spec.get("mean", 1.0))
+    raise ValueError(f"unknown latency distribution {distribution}")
+
+
+class MockChatModel(BaseChatModel):
+    """Chat model answering from a hash of the prompt after a simulated delay."""
+
+    model_id: str
+    answer_tokens: int = 120
+    latency: dict = {}
+    stream_rate: float = 50.0
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    seed: Optional[int] = None
+    _rng: random.Random = PrivateAttr()
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._rng = random.Random(self.seed)
+
+    @property
+    def _llm_type(self) -> str:
+        return "mock"
+
+    def answer(self, messages: List[BaseMessage]) -> str:
+        """the deterministic answer to a conversation"""
+        prompt = "\n".join(str(message.content) for message in messages)
+        digest = hashlib.blake2b(f"{self.model_id}\n{prompt}".encode(), digest_size=8).digest()
+        words = random.Random(digest).choices(_WORDS, k=self.answer_tokens)
+        return f"mock answer of {self.model_id} ({digest.hex()}):\n" + " ".join(words)
+
+    def _draw(self) -> float:
+        """
+        :return: the latency of a call
+        :raises MockRateLimitError, MockProviderError: at the configured rates
+        """
+        draw = self._rng.random()
+        if draw < self.rate_limit_rate:
+            raise MockRateLimitError(f"429 Too Many Requests from mock model {self.model_id}")
+        latency = sample_latency(self.latency, self._rng)
+        if draw < self.rate_limit_rate + self.error_rate:
+            raise MockProviderError(f"500 Internal Server Error from mock model {self.model_id}")
+        return latency
+
+    def _usage(self, messages: List[BaseMessage], content: str) -> dict:
+        # a word is a token, like the answer_tokens of the config
+        input_tokens = sum(len(str(message.content).split()) for message in messages)
+        output_tokens = len(content.split())
+        return {"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens}
+
+    def _message(self, messages: List[BaseMessage]) -> AIMessage:
+        content = self.answer(messages)
+        return AIMessage(content=content, usage_metadata=self._usage(messages, content))
+
+    def _chunks(self, content: str) -> list[str]:
+        words = content.split(" ")
+        return [word if i == 0 else " " + word for i, word in enumerate(words)]
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        time.sleep(self._draw())
+        return ChatResult(generations=[ChatGeneration(message=self._message(messages))])
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        await asyncio.sleep(self._draw())
+        return ChatResult(generations=[ChatGeneration(message=self._message(messages))])
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        # the latency is the time to the first chunk
+        time.sleep(self._draw())
+        content = self.answer(messages)
+        for chunk in self._chunks(content):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=chunk))
+            time.sleep(1 / self.stream_rate)
+        # the usage comes last, like with stream_usage of OpenAI
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=self._usage(messages, content)))
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self._draw())
+        content = self.answer(messages)
+        for chunk in self._chunks(content):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=chunk))
+            await asyncio.sleep(1 / self.stream_rate)
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=self._usage(messages, content)))
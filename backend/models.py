@@ -61,6 +61,13 @@ class Answer(db.Model):
         foreign_keys=[question_id]
     )
     frontend_order = db.Column(db.Integer, default=-1)
+    # usage of the provider calls behind the answer, when metrics.store_usage is on
+    latency = db.Column(db.Float, nullable=True)  # seconds
+    prompt_tokens = db.Column(db.Integer, nullable=True)
+    completion_tokens = db.Column(db.Integer, nullable=True)
+    cost = db.Column(db.Float, nullable=True)  # dollars
+    # the version of the task prompt the answer was generated with (see prompts.py)
+    prompt_version = db.Column(db.String(16), nullable=True)
 
 
 class Feedback(db.Model):
@@ -98,4 +105,71 @@ class LLMError(db.Model):
         db.DateTime,
         default=db.func.now(),
         onupdate=db.func.now(), nullable=False
-    )
\ No newline at end of file
+    )
+    # set by the replay worker (replay.py) once the question has an answer of the model
+    resolved_at = db.Column(db.DateTime, nullable=True)
+    resolved_answer_id = db.Column(db.Integer, db.ForeignKey("answer.id"), nullable=True)
+    replay_attempts = db.Column(db.Integer, default=0, server_default=db.text("0"), nullable=False)
+    # claimed by a replayer until then, so concurrent replayers skip the error
+    replay_lease_expires_at = db.Column(db.DateTime, nullable=True)
+    # the request that called the model, to find its logs and trace (see tracing.py)
+    request_id = db.Column(db.String(64), nullable=True)
+
+class PairwiseResult(db.Model):
+    # how often the answer of model_a was voted above the answer of model_b
+    # to the same question; model_a < model_b, one row per leaderboard slice
+    slice = db.Column(db.String, primary_key=True)
+    model_a = db.Column(db.String, primary_key=True)
+    model_b = db.Column(db.String, primary_key=True)
+    wins_a = db.Column(db.Integer, default=0, nullable=False)
+    wins_b = db.Column(db.Integer, default=0, nullable=False)
+
+
+class ModelRating(db.Model):
+    # ratings and confidence intervals of the last full leaderboard recompute
+    slice = db.Column(db.String, primary_key=True)
+    model_id = db.Column(db.String, primary_key=True)
+    rating = db.Column(db.Float, nullable=False)
+    comparisons = db.Column(db.Integer, default=0, nullable=False)
+    # bootstrap confidence interval from the last full recompute
+    ci_lower = db.Column(db.Float, nullable=True)
+    ci_upper = db.Column(db.Float, nullable=True)
+    updated_at = db.Column(
+        db.DateTime,
+        default=db.func.now(),
+        onupdate=db.func.now(),
+        nullable=False
+    )
+
+
+class QuestionSignature(db.Model):
+    # MinHash signature of the question content, see dedup.py
+    question_id = db.Column(db.Integer, db.ForeignKey("question.id"), primary_key=True)
+    signature = db.Column(db.LargeBinary, nullable=False)
+
+
+class LSHBucket(db.Model):
+    # questions whose signatures agree on a whole band share its bucket
+    band = db.Column(db.Integer, primary_key=True)
+    bucket = db.Column(db.BigInteger, primary_key=True)
+    question_id = db.Column(db.Integer, db.ForeignKey("question.id"), primary_key=True)
+
+
+class Job(db.Model):
+    # queued generation of the answer of a model to a question, see jobs.py
+    id = db.Column(db.Integer, primary_key=True)
+    question_id = db.Column(db.Integer, db.ForeignKey("question.id"), nullable=False, index=True)
+    model_id = db.Column(db.String, nullable=False)
+    frontend_order = db.Column(db.Integer, default=-1)
+    # the answer request fields besides the question content
+    params = db.Column(db.JSON, nullable=False)
+    status = db.Column(db.String(16), default="queued", nullable=False, index=True)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    worker_id = db.Column(db.String, nullable=True)
+    # a running job whose lease ran out is claimed again (its worker died)
+    lease_expires_at = db.Column(db.DateTime, nullable=True)
+    answer_id = db.Column(db.Integer, db.ForeignKey("answer.id"), nullable=True)
+    error = db.Column(db.String, nullable=True)
+    created_at = db.Column(db.DateTime, default=db.func.now(), nullable=False)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
@@ -0,0 +1,88 @@
+"""
+Task prompts, compiled once into the messages sent to the models.
+
+Each task has one system message and one human message template. The
+system message is built once and shared; a request only fills the human
+template, with no prompt template objects built per call. A prompt's
+version is a hash of its two templates, so any edit of a prompt gives it a
+new version. The version is stored on every Answer generated with it and is
+part of the answer cache key.
+"""
+import hashlib
+from typing import NamedTuple
+
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage, get_buffer_string
+
+from tracing import span
+
+SYSTEM_PROMPT = (
+    "You are a programming assistant skilled in different tasks like code completion, translation, and explanation."
+)
+
+
+class Prompt(NamedTuple):
+    """The messages of one request to a model."""
+
+    messages: list[BaseMessage]
+    # the version of the task prompt it was filled from
+    version: str
+    # the messages as one string, for cache keys and LLMError rows
+    text: str
+
+
+class TaskPrompt:
+    """The compiled prompt of a task."""
+
+    def __init__(self, task: str, *, system: str, human: str):
+        self.task = task
+        self.system_message = SystemMessage(content=system)
+        self.human = human
+        self.version = hashlib.sha256(f"{system}\0{human}".encode("utf-8")).hexdigest()[:12]
+
+    def render(self, **fields: str) -> Prompt:
+        """
+        :param fields: the values of the fields of the human template; others are ignored
+        :raises KeyError: if a field of the template is missing
+        """
+        messages = [self.system_message, HumanMessage(content=self.human.format_map(fields))]
+        return Prompt(messages=messages, version=self.version, text=get_buffer_string(messages))
+
+
+# These should be consistent with frontend passing in
+TASK_PROMPTS = {
+    task: TaskPrompt(task, system=SYSTEM_PROMPT, human=human)
+    for task, human in {
+        "Code Completion": "Complete the code snippet written in {language}:\n{content}",
+        "Code Translation": "Translate the code snippet from {source_language} to {target_language}:\n{content}",
+        "Code Repair": "Fix the code snippet written in {language}:\n{content}",
+        "Text-to-Code Generation": "Follow the instructions below to write a code snippet:\n{content}",
+        "Code Summarization": "Explain the code snippet written in {language}:\n{content}",
+        "Input/Output Examples": "Provide code snippet that satisfies the input and output examples written in {language}:\n{content}",
+    }.items()
+}
+
+
+def build_prompt(
+    *,
+    task: str,
+    content: str,
+    language: str,
+    source_language: str,
+    target_language: str
+) -> Prompt:
+    """
+    Fill the task prompt for a question
+    :param task: the chosen task category of the question
+    :param content: the question content
+    :param language: the language of the question (if any)
+    :param source_language: the source language of the question (if any)
+    :param target_language: the target language of the question (if any)
+    :return: the prompt to send to the models
+    """
+    with span("build_prompt", task=task):
+        return TASK_PROMPTS[task].render(
+            content=content,
+            language=language,
+            source_language=source_language,
+            target_language=target_language,
+        )
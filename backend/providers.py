@@ -0,0 +1,158 @@
+import importlib
+import logging
+import resource
+import sys
+import threading
+import time
+from typing import Callable
+
+# provider name (as used in the llm: section of the config) -> client factory
+PROVIDERS: dict[str, Callable] = {}
+
+# provider name -> cost of importing its SDK
+_import_costs: dict[str, dict] = {}
+_import_lock = threading.Lock()
+
+
+def register_provider(name: str):
+    """
+    Register a client factory for a provider. The factory is called with the
+    model entry from the config and the Config object, and must import its
+    SDK through import_sdk so nothing is loaded for unused providers.
+    """
+    def decorator(create_client: Callable) -> Callable:
+        PROVIDERS[name] = create_client
+        return create_client
+    return decorator
+
+
+def import_sdk(provider: str, module_name: str):
+    """
+    Import a provider SDK module, recording the time and memory it cost the
+    first time it is loaded
+    :param provider: the name of the provider importing the module
+    :param module_name: the module to import
+    :return: the imported module
+    """
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+
+    with _import_lock:
+        if module_name in sys.modules:
+            return sys.modules[module_name]
+        start = time.perf_counter()
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        module = importlib.import_module(module_name)
+        elapsed = time.perf_counter() - start
+        # ru_maxrss is in kilobytes on linux
+        rss_delta = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+
+        cost = _import_costs.setdefault(provider, {"modules": [], "seconds": 0.0, "max_rss_kb": 0})
+        cost["modules"].append(module_name)
+        cost["seconds"] += elapsed
+        cost["max_rss_kb"] += rss_delta
+    logging.info(
+        f"<providers> {provider} imported {module_name} in {elapsed * 1000:.0f} ms (+{rss_delta / 1024:.1f} MB peak RSS)"
+    )
+    return module
+
+
+def import_report() -> dict:
+    """
+    :return: the import cost of each provider loaded so far
+    """
+    return {provider: dict(cost) for provider, cost in _import_costs.items()}
+
+
+def create_llm_client(provider: str, model: dict, config):
+    """
+    Create the client of a configured model. Clients are built without their
+    own retries; function.call_model retries according to llm.retries.
+    :param provider: the registered name of the provider
+    :param model: the model entry from the config
+    :param config: the application Config
+    :return: a LangChain chat model
+    """
+    return PROVIDERS[provider](model, config)
+
+
+@register_provider("openai")
+def create_openai_client(model: dict, config):
+    ChatOpenAI = import_sdk("openai", "langchain_openai").ChatOpenAI
+    return ChatOpenAI(
+        openai_api_key=config.OPENAI_API_KEY,
+        model=model.get("id"),
+        max_tokens=model.get("max_tokens"),
+        max_retries=0,
+    )
+
+
+@register_provider("anthropic")
+def create_anthropic_client(model: dict, config):
+    ChatAnthropic = import_sdk("anthropic", "langchain_anthropic").ChatAnthropic
+    return ChatAnthropic(
+        anthropic_api_key=config.ANTHROPIC_API_KEY,
+        model=model.get("id"),
+        max_tokens_to_sample=model.get("max_tokens"),
+        max_retries=0,
+    )
+
+
+@register_provider("hf")
+def create_hf_client(model: dict, config):
+    langchain_huggingface = import_sdk("hf", "langchain_huggingface")
+    llm = langchain_huggingface.HuggingFaceEndpoint(
+        repo_id=model.get("id"),
+        task="text-generation",
+        huggingfacehub_api_token=config.HF_API_KEY,
+        max_new_tokens=model.get("max_tokens"),
+    )
+    return langchain_huggingface.ChatHuggingFace(llm=llm).bind(
+        max_tokens=model.get("max_tokens")
+    )
+
+
+_vertexai_initialized = False
+
+
+@register_provider("gemini")
+def create_gemini_client(model: dict, config):
+    global _vertexai_initialized
+
+    if config.IS_GOOGLE_AI_PLATFORM:
+        vertexai = import_sdk("gemini", "vertexai")
+        with _import_lock:
+            if not _vertexai_initialized:
+                vertexai.init(
+                    project=config.GOOGLE_AI_PLATFORM_PROJECT_NAME,
+                    location=config.GOOGLE_AI_PLATFORM_LOCATION,
+                )
+                _vertexai_initialized = True
+        ChatVertexAI = import_sdk("gemini", "langchain_google_vertexai").ChatVertexAI
+        return ChatVertexAI(
+            model=model.get("id"),
+            max_tokens=model.get("max_tokens"),
+            max_retries=0,
+        )
+
+    ChatGoogleGenerativeAI = import_sdk("gemini", "langchain_google_genai").ChatGoogleGenerativeAI
+    return ChatGoogleGenerativeAI(
+        google_api_key=config.GEMINI_API_KEY,
+        model=model.get("id"),
+        max_output_tokens=model.get("max_tokens"),
+        max_retries=0,
+    )
+
+
+@register_provider("mock")
+def create_mock_client(model: dict, config):
+    MockChatModel = import_sdk("mock", "mock_llm").MockChatModel
+    return MockChatModel(
+        model_id=model.get("id"),
+        answer_tokens=model.get("answer_tokens", 120),
+        latency=model.get("latency", {}),
+        stream_rate=model.get("stream_rate", 50),
+        error_rate=model.get("error_rate", 0.0),
+        rate_limit_rate=model.get("rate_limit_rate", 0.0),
+        seed=model.get("seed"),
+    )
@@ -0,0 +1,378 @@
+"""
+Replay of failed model calls recorded in LLMError.
+
+Every replay.interval seconds a background thread claims the unresolved
+errors older than replay.min_age in batches, oldest first. A batch is
+claimed with a single UPDATE ... RETURNING that leases it for
+replay.lease seconds, renewed while it is replayed, so the replayers of
+several processes never replay the same error at once. Errors of a
+question that has since been answered by the model are resolved with that
+answer. The others are replayed with the current prompt of their question, grouped by model
+with at most replay.concurrency calls in flight per model, through the same
+limits, circuit breakers and retries as live requests. A successful replay
+stores the missing Answer and resolves every error of that question and
+model; a failed one counts an attempt, and errors are given up on after
+replay.max_attempts.
+"""
+import asyncio
+import logging
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+import click
+from flask import Flask
+from flask.cli import AppGroup
+from sqlalchemy import or_, select, tuple_, update
+
+from config import config
+from database import commit, renewing
+from function import generate_answer, run_db, run_read
+from models import db, Answer, LLMError, Question
+from prompts import build_prompt
+from resilience import CircuitOpen, circuit_breakers
+
+
+def _now() -> datetime:
+    # naive UTC, like the timestamps SQLite stores
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def claim_errors(*, after_id: int, limit: int, min_age: float, model_ids: list[str]) -> list:
+    """
+    Lease the next unresolved errors to replay that no other replayer holds
+    :return: the claimed errors with the fields of their question, by id
+    """
+    now = _now()
+    errors = LLMError.__table__
+    claimable = (
+        select(errors.c.id)
+        .where(
+            errors.c.id > after_id,
+            errors.c.resolved_at.is_(None),
+            errors.c.replay_attempts < config.REPLAY_MAX_ATTEMPTS,
+            errors.c.created_at <= now - timedelta(seconds=min_age),
+            errors.c.model_id.in_(model_ids),
+            or_(errors.c.replay_lease_expires_at.is_(None), errors.c.replay_lease_expires_at < now),
+        )
+        .order_by(errors.c.id)
+        .limit(limit)
+    )
+    claimed = db.session.execute(
+        update(errors)
+        .where(errors.c.id.in_(claimable))
+        .values(replay_lease_expires_at=now + timedelta(seconds=config.REPLAY_LEASE))
+        .returning(errors.c.id)
+    ).scalars().all()
+    rows = db.session.execute(
+        select(
+            LLMError.id, LLMError.question_id, LLMError.model_id,
+            Question.task, Question.content, Question.language, Question.source_language, Question.target_language,
+        )
+        .join(Question, Question.id == LLMError.question_id)
+        .where(LLMError.id.in_(claimed))
+        .order_by(LLMError.id)
+    ).all() if claimed else []
+    commit()
+    return rows
+
+
+def renew_error_leases(error_ids: list[int]) -> None:
+    """extend the lease of the claimed errors not resolved yet"""
+    errors = LLMError.__table__
+    db.session.execute(
+        update(errors)
+        .where(errors.c.id.in_(error_ids), errors.c.resolved_at.is_(None), errors.c.replay_lease_expires_at.is_not(None))
+        .values(replay_lease_expires_at=_now() + timedelta(seconds=config.REPLAY_LEASE))
+    )
+    commit()
+
+
+def release_errors(error_ids: list[int]) -> None:
+    """give claimed errors back for the next pass"""
+    errors = LLMError.__table__
+    db.session.execute(update(errors).where(errors.c.id.in_(error_ids)).values(replay_lease_expires_at=None))
+    commit()
+
+
+def existing_answers(pairs: list[tuple[int, str]]) -> dict[tuple[int, str], int]:
+    """
+    :param pairs: (question id, model id) pairs
+    :return: (question id, model id) -> id of an answer stored since
+    """
+    if not pairs:
+        return {}
+    rows = db.session.execute(
+        select(Answer.question_id, Answer.model_id, db.func.min(Answer.id))
+        .where(tuple_(Answer.question_id, Answer.model_id).in_(pairs))
+        .group_by(Answer.question_id, Answer.model_id)
+    )
+    return {(question_id, model_id): answer_id for question_id, model_id, answer_id in rows}
+
+
+def resolve_llm_errors(error_ids: list[int], answer_id: int) -> None:
+    """mark errors as answered by an answer"""
+    errors = LLMError.__table__
+    db.session.execute(
+        update(errors)
+        .where(errors.c.id.in_(error_ids))
+        .values(resolved_at=db.func.now(), resolved_answer_id=answer_id, replay_lease_expires_at=None)
+    )
+    commit()
+
+
+def insert_replayed_answer(
+    *, error_ids: list[int], question_id: int, model_id: str, content: str, prompt_version: str
+) -> Optional[int]:
+    """
+    Store the answer of a replay and resolve its errors in one transaction
+    :return: the id of the answer, or None if the errors were resolved in the meantime
+    """
+    # a replayer whose lease ran out may finish after another one took over
+    unresolved = db.session.scalar(
+        select(db.func.count()).select_from(LLMError).where(LLMError.id.in_(error_ids), LLMError.resolved_at.is_(None))
+    )
+    if not unresolved:
+        return None
+    answer = Answer(content=content, model_id=model_id, question_id=question_id, prompt_version=prompt_version)
+    db.session.add(answer)
+    db.session.flush()
+    resolve_llm_errors(error_ids, answer.id)
+    return answer.id
+
+
+def count_failed_replay(error_ids: list[int]) -> None:
+    errors = LLMError.__table__
+    db.session.execute(
+        update(errors)
+        .where(errors.c.id.in_(error_ids))
+        .values(replay_attempts=errors.c.replay_attempts + 1, replay_lease_expires_at=None)
+    )
+    commit()
+
+
+class ErrorReplayer:
+    """Replays unresolved LLM errors on a background thread."""
+
+    def __init__(self, *, interval: float, batch_size: int, concurrency: int, min_age: float):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.concurrency = max(1, concurrency)
+        self.min_age = min_age
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+        self._app: Optional[Flask] = None
+        self.passes = 0
+        self.replayed = 0
+        self.resolved = 0
+        self.already_answered = 0
+        self.failed = 0
+        self.skipped_open_circuit = 0
+        self.last_pass_at: Optional[str] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, app: Flask) -> None:
+        if self._thread is not None:
+            return
+        self._app = app
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="llm-error-replay", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """stop the thread after the calls in flight"""
+        if self._thread is None:
+            return
+        self._stopping = True
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self) -> None:
+        with self._app.app_context():
+            while not self._stopping:
+                self._wake.wait(self.interval)
+                if self._stopping:
+                    break
+                try:
+                    asyncio.run(self.replay())
+                except Exception as e:
+                    logging.error(f"<replay> Error in replaying LLM errors: {e}")
+
+    def _count(self, **counts: int) -> None:
+        with self._lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    async def replay(self, *, model_ids: Optional[list[str]] = None, limit: Optional[int] = None) -> dict:
+        """
+        Replay the unresolved errors, one batch at a time. Must run in an app context.
+        :param model_ids: only replay errors of these models, default all configured models
+        :param limit: the most errors to look at
+        :return: the counts of this pass
+        """
+        model_ids = [model_id for model_id in (model_ids or config.LLM_CHAINS) if model_id in config.LLM_CHAINS]
+        totals = defaultdict(int)
+        after_id = 0
+        seen = 0
+        while not self._stopping and (limit is None or seen < limit):
+            batch_size = self.batch_size if limit is None else min(self.batch_size, limit - seen)
+            rows = await run_db(
+                claim_errors, after_id=after_id, limit=batch_size, min_age=self.min_age, model_ids=model_ids
+            )
+            if not rows:
+                break
+            seen += len(rows)
+            after_id = rows[-1].id
+            error_ids = [row.id for row in rows]
+            async with renewing(lambda: run_db(renew_error_leases, error_ids), interval=config.REPLAY_LEASE / 3):
+                counts = await self._replay_batch(rows)
+            for name, count in counts.items():
+                totals[name] += count
+
+        with self._lock:
+            self.passes += 1
+            self.last_pass_at = datetime.now(timezone.utc).isoformat()
+        if seen:
+            logging.info(f"<replay> looked at {seen} errors: {dict(totals)}")
+        return dict(totals)
+
+    async def _replay_batch(self, rows: list) -> dict:
+        # several failed requests for the same question are replayed once
+        groups: dict[tuple[int, str], list] = defaultdict(list)
+        for row in rows:
+            groups[(row.question_id, row.model_id)].append(row)
+
+        counts = defaultdict(int)
+        answered = await run_read(existing_answers, list(groups))
+        for pair, answer_id in answered.items():
+            await run_db(resolve_llm_errors, [row.id for row in groups.pop(pair)], answer_id)
+            counts["already_answered"] += 1
+
+        by_model: dict[str, list[list]] = defaultdict(list)
+        skipped: list[int] = []
+        for (_, model_id), group in groups.items():
+            if circuit_breakers.is_available(model_id):
+                by_model[model_id].append(group)
+            else:
+                counts["skipped_open_circuit"] += 1
+                skipped.extend(row.id for row in group)
+        if skipped:
+            await run_db(release_errors, skipped)
+
+        async def replay_model(model_id: str, model_groups: list[list]) -> None:
+            semaphore = asyncio.Semaphore(self.concurrency)
+
+            async def replay_group(group: list) -> None:
+                async with semaphore:
+                    await self._replay_group(model_id, group, counts)
+
+            await asyncio.gather(*(replay_group(group) for group in model_groups))
+
+        await asyncio.gather(*(replay_model(model_id, model_groups) for model_id, model_groups in by_model.items()))
+        self._count(**counts)
+        return counts
+
+    async def _replay_group(self, model_id: str, group: list, counts: dict) -> None:
+        error_ids = [row.id for row in group]
+        row = group[0]
+        try:
+            # the current prompt of the task, in case the prompts changed in between;
+            # the language columns hold names despite their declared type
+            prompt = build_prompt(
+                task=row.task,
+                content=row.content,
+                language=str(row.language or ""),
+                source_language=str(row.source_language or ""),
+                target_language=str(row.target_language or ""),
+            )
+            content = await generate_answer(model_id, prompt)
+        except CircuitOpen:
+            counts["skipped_open_circuit"] += 1
+            await run_db(release_errors, error_ids)
+            return
+        except Exception as e:
+            counts["replayed"] += 1
+            logging.warning(f"<replay> {model_id} failed again on question {row.question_id}: {e}")
+            counts["failed"] += 1
+            await run_db(count_failed_replay, error_ids)
+            return
+
+        counts["replayed"] += 1
+        answer_id = await run_db(
+            insert_replayed_answer,
+            error_ids=error_ids,
+            question_id=row.question_id,
+            model_id=model_id,
+            content=content,
+            prompt_version=prompt.version,
+        )
+        if answer_id is None:
+            counts["already_answered"] += 1
+            return
+        counts["resolved"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "running": self.running,
+                "passes": self.passes,
+                "last_pass_at": self.last_pass_at,
+                "replayed": self.replayed,
+                "resolved": self.resolved,
+                "already_answered": self.already_answered,
+                "failed": self.failed,
+                "skipped_open_circuit": self.skipped_open_circuit,
+            }
+
+
+error_replayer = ErrorReplayer(
+    interval=config.REPLAY_INTERVAL,
+    batch_size=config.REPLAY_BATCH_SIZE,
+    concurrency=config.REPLAY_CONCURRENCY,
+    min_age=config.REPLAY_MIN_AGE,
+)
+
+
+def backlog() -> dict:
+    """
+    :return: per model, the errors waiting for a replay and those given up on
+    """
+    result: dict[str, dict] = {}
+    for model_id, exhausted, count in db.session.execute(
+        select(
+            LLMError.model_id,
+            LLMError.replay_attempts >= config.REPLAY_MAX_ATTEMPTS,
+            db.func.count(),
+        )
+        .where(LLMError.resolved_at.is_(None))
+        .group_by(LLMError.model_id, LLMError.replay_attempts >= config.REPLAY_MAX_ATTEMPTS)
+    ):
+        entry = result.setdefault(model_id, {"pending": 0, "given_up": 0})
+        entry["given_up" if exhausted else "pending"] += count
+    return result
+
+
+replay_cli = AppGroup("replay", help="Replay failed model calls.")
+
+
+@replay_cli.command("run")
+@click.option("--model", "model_ids", multiple=True, help="Only replay errors of this model, can be repeated.")
+@click.option("--limit", type=int, default=None, help="Most errors to look at.")
+@click.option("--min-age", type=float, default=None, help="Only errors older than this many seconds, default replay.min_age.")
+def run_command(model_ids, limit, min_age):
+    """Replay the unresolved LLM errors once, now."""
+    replayer = ErrorReplayer(
+        interval=config.REPLAY_INTERVAL,
+        batch_size=config.REPLAY_BATCH_SIZE,
+        concurrency=config.REPLAY_CONCURRENCY,
+        min_age=config.REPLAY_MIN_AGE if min_age is None else min_age,
+    )
+    counts = asyncio.run(replayer.replay(model_ids=list(model_ids), limit=limit))
+    click.echo(f"replay: {counts or 'nothing to replay'}")
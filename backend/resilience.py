@@ -0,0 +1,333 @@
+import asyncio
+import contextlib
+import logging
+import random
+import threading
+import time
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Optional, TypeVar
+
+import httpx
+
+from config import config
+from limits import RateLimitExceeded, is_rate_limit_error
+
+T = TypeVar("T")
+
+
+class LLMTimeout(Exception):
+    """Raised when a model does not answer within its deadline."""
+
+
+def status_code(error: BaseException) -> Optional[int]:
+    """the HTTP status of a provider error, wherever its SDK keeps it"""
+    for candidate in (error, getattr(error, "response", None)):
+        for attribute in ("status_code", "code"):
+            value = getattr(candidate, attribute, None)
+            if isinstance(value, int) and 100 <= value < 600:
+                return value
+    return None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Whether a failed call may succeed when tried again: timeouts, connection
+    errors, rate limits and server errors. Requests the provider refused,
+    like a 400 or a 403, fail the same way every time.
+    """
+    if isinstance(error, (LLMTimeout, asyncio.TimeoutError, ConnectionError, httpx.TransportError)):
+        return True
+    code = status_code(error)
+    if code is not None:
+        return code >= 500 or code == 408 or code == 429
+    if is_rate_limit_error(error):
+        return True
+    # the timeout and connection errors of the provider SDKs carry no status
+    name = type(error).__name__
+    return "Timeout" in name or "Connection" in name
+
+
+class LatencyTracker:
+    """Recent successful call latencies of each model."""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._latencies: dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def record(self, model_id: str, latency: float) -> None:
+        with self._lock:
+            self._latencies.setdefault(model_id, deque(maxlen=self.window)).append(latency)
+
+    def percentile(self, model_id: str, percentile: float, min_samples: int) -> Optional[float]:
+        """
+        :return: the latency percentile of a model, or None without enough samples
+        """
+        with self._lock:
+            latencies = sorted(self._latencies.get(model_id, ()))
+        if len(latencies) < max(1, min_samples):
+            return None
+        index = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+        return latencies[index]
+
+
+latency_tracker = LatencyTracker()
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a model whose circuit breaker is open."""
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Stops calling a model once too many of its recent calls failed.
+    The circuit opens when the error rate over the sliding window reaches
+    the threshold; after open_seconds a few probe calls are let through
+    (half-open) and the circuit closes again once they all succeed.
+    """
+
+    def __init__(self, model_id: str, *, window: float, min_calls: int, error_rate: float, open_seconds: float, half_open_probes: int):
+        self.model_id = model_id
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._outcomes: deque = deque()  # (time, succeeded)
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+
+    def _update_state(self, now: float) -> None:
+        # must be called with the lock held
+        if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probes_in_flight = 0
+            self._probe_successes = 0
+
+    def is_available(self) -> bool:
+        with self._lock:
+            self._update_state(time.monotonic())
+            return self._state != OPEN
+
+    def before_call(self) -> None:
+        """
+        :raises CircuitOpen: if the model must not be called right now
+        """
+        with self._lock:
+            self._update_state(time.monotonic())
+            if self._state == OPEN:
+                raise CircuitOpen(f"{self.model_id} is unavailable after repeated failures")
+            if self._state == HALF_OPEN:
+                if self._probes_in_flight >= self.half_open_probes:
+                    raise CircuitOpen(f"{self.model_id} is being probed after repeated failures")
+                self._probes_in_flight += 1
+
+    def after_call(self, succeeded: Optional[bool]) -> None:
+        """
+        :param succeeded: the outcome of the call, None if it was abandoned
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._state == HALF_OPEN:
+                self._probes_in_flight -= 1
+                if succeeded is None:
+                    return
+                if not succeeded:
+                    self._open(now)
+                    return
+                self._probe_successes += 1
+                if self._probe_successes >= self.half_open_probes:
+                    logging.info(f"<circuit> {self.model_id} recovered, closing its circuit")
+                    self._state = CLOSED
+                    self._outcomes.clear()
+                return
+
+            if succeeded is None or self._state == OPEN:
+                return
+            self._outcomes.append((now, succeeded))
+            while self._outcomes and now - self._outcomes[0][0] > self.window:
+                self._outcomes.popleft()
+            failures = sum(1 for _, ok in self._outcomes if not ok)
+            if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.error_rate:
+                self._open(now)
+
+    def _open(self, now: float) -> None:
+        # must be called with the lock held
+        logging.error(f"<circuit> opening the circuit of {self.model_id} for {self.open_seconds}s")
+        self._state = OPEN
+        self._opened_at = now
+        self._outcomes.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._update_state(time.monotonic())
+            failures = sum(1 for _, ok in self._outcomes if not ok)
+            return {"state": self._state, "calls": len(self._outcomes), "failures": failures}
+
+
+class CircuitBreakers:
+    """The circuit breaker of every model, created on first use."""
+
+    def __init__(self):
+        self._breakers: dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def get(self, model_id: str) -> CircuitBreaker:
+        with self._lock:
+            if model_id not in self._breakers:
+                self._breakers[model_id] = CircuitBreaker(
+                    model_id,
+                    window=config.LLM_CIRCUIT_WINDOW,
+                    min_calls=config.LLM_CIRCUIT_MIN_CALLS,
+                    error_rate=config.LLM_CIRCUIT_ERROR_RATE,
+                    open_seconds=config.LLM_CIRCUIT_OPEN_SECONDS,
+                    half_open_probes=config.LLM_CIRCUIT_HALF_OPEN_PROBES,
+                )
+            return self._breakers[model_id]
+
+    def is_available(self, model_id: str) -> bool:
+        return not config.LLM_CIRCUIT_ENABLED or self.get(model_id).is_available()
+
+    @contextlib.asynccontextmanager
+    async def guard(self, model_id: str) -> AsyncIterator[None]:
+        """
+        Wrap one provider call of a model in its circuit breaker. Our own
+        queue timeouts do not count as failures of the model.
+        :raises CircuitOpen: if the circuit of the model is open
+        """
+        if not config.LLM_CIRCUIT_ENABLED:
+            yield
+            return
+
+        breaker = self.get(model_id)
+        breaker.before_call()
+        try:
+            yield
+        except RateLimitExceeded:
+            breaker.after_call(None)
+            raise
+        except Exception:
+            breaker.after_call(False)
+            raise
+        except BaseException:
+            # cancelled, e.g. the losing half of a hedged request
+            breaker.after_call(None)
+            raise
+        breaker.after_call(True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return {breaker.model_id: breaker.stats() for breaker in breakers}
+
+
+circuit_breakers = CircuitBreakers()
+
+
+def model_timeout(model_id: str) -> float:
+    """the deadline of one call to a model: its own timeout or llm.timeout"""
+    return config.LLM_ID_CONFIG.get(model_id, {}).get("timeout", config.LLM_TIMEOUT)
+
+
+async def with_timeout(model_id: str, call: Awaitable[T]) -> T:
+    """
+    Await a provider call within the deadline of its model
+    :raises LLMTimeout: if the deadline passes first
+    """
+    timeout = model_timeout(model_id)
+    try:
+        return await asyncio.wait_for(call, timeout)
+    except asyncio.TimeoutError:
+        raise LLMTimeout(f"{model_id} did not answer within {timeout}s")
+
+
+async def iterate_with_timeout(model_id: str, chunks: AsyncIterator[T]) -> AsyncIterator[T]:
+    """
+    Iterate a provider stream, failing if the model stays silent for longer
+    than its deadline between two chunks
+    :raises LLMTimeout: if no chunk arrives in time
+    """
+    timeout = model_timeout(model_id)
+    iterator = chunks.__aiter__()
+    while True:
+        try:
+            chunk = await asyncio.wait_for(iterator.__anext__(), timeout)
+        except StopAsyncIteration:
+            return
+        except asyncio.TimeoutError:
+            raise LLMTimeout(f"{model_id} sent nothing for {timeout}s")
+        yield chunk
+
+
+async def call_with_retries(model_id: str, attempt: Callable[[], Awaitable[T]]) -> T:
+    """
+    Run a provider call, retrying transient failures (see is_retryable) up to
+    llm.retries times with exponential backoff and full jitter. Each try may
+    be hedged.
+    :param model_id: the id of the model
+    :param attempt: starts one try of the call
+    :return: the result of the first successful try
+    """
+    for retry in range(config.LLM_RETRIES + 1):
+        try:
+            return await _hedged(model_id, attempt)
+        except (RateLimitExceeded, CircuitOpen):
+            # the request already waited its full share for a provider slot,
+            # or the model is known to be failing
+            raise
+        except Exception as e:
+            if retry == config.LLM_RETRIES or not is_retryable(e):
+                raise
+            delay = random.uniform(0, min(config.LLM_RETRY_BACKOFF_MAX, config.LLM_RETRY_BACKOFF * 2 ** retry))
+            logging.warning(f"<retry> {model_id} failed ({e}), retry {retry + 1}/{config.LLM_RETRIES} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+async def _timed(model_id: str, attempt: Callable[[], Awaitable[T]]) -> T:
+    start = time.perf_counter()
+    result = await attempt()
+    latency_tracker.record(model_id, time.perf_counter() - start)
+    return result
+
+
+async def _hedged(model_id: str, attempt: Callable[[], Awaitable[T]]) -> T:
+    """
+    Run a try; if hedging is on and it is still running after the observed
+    latency percentile of the model, start a second one and keep whichever
+    succeeds first.
+    """
+    hedge_after = None
+    if config.LLM_HEDGING_ENABLED:
+        hedge_after = latency_tracker.percentile(
+            model_id, config.LLM_HEDGING_PERCENTILE, config.LLM_HEDGING_MIN_SAMPLES
+        )
+    if hedge_after is None:
+        return await _timed(model_id, attempt)
+
+    tasks = {asyncio.ensure_future(_timed(model_id, attempt))}
+    try:
+        done, tasks = await asyncio.wait(tasks, timeout=hedge_after)
+        if done:
+            return done.pop().result()
+
+        logging.info(f"<hedge> {model_id} slower than {hedge_after:.1f}s, sending a hedged request")
+        tasks.add(asyncio.ensure_future(_timed(model_id, attempt)))
+        error = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,236 @@
+"""
+Full-text search over questions and their answers.
+
+question_fts and answer_fts are external-content SQLite FTS5 indexes over
+question and answer content; question titles are not indexed, they are all
+the same placeholder. Triggers keep them in sync with
+every insert, update and delete, so the index never needs a rescan; the
+first start on an existing database builds them from the stored rows.
+"""
+import base64
+import json
+import logging
+import re
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+# answer matches rank below question matches of the same relevance
+ANSWER_WEIGHT = 0.5
+
+MAX_LIMIT = 100
+# the best matches of each index a search ranks and pages through; a short
+# prefix can match every row, and ranking all of them is what costs
+MAX_CANDIDATES = 1000
+# the tokens of question content shown around the matched words, and the
+# characters shown of questions matched through their answers
+EXCERPT_TOKENS = 24
+EXCERPT_CHARS = 200
+
+_SCHEMA = [
+    # prefix indexes make type-ahead queries of 2 and 3 characters cheap
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS question_fts USING fts5(
+        content, content='question', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """,
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS answer_fts USING fts5(
+        content, content='answer', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS question_fts_insert AFTER INSERT ON question BEGIN
+        INSERT INTO question_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS question_fts_delete AFTER DELETE ON question BEGIN
+        INSERT INTO question_fts(question_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS question_fts_update AFTER UPDATE OF content ON question BEGIN
+        INSERT INTO question_fts(question_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO question_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS answer_fts_insert AFTER INSERT ON answer BEGIN
+        INSERT INTO answer_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS answer_fts_delete AFTER DELETE ON answer BEGIN
+        INSERT INTO answer_fts(answer_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """,
+    # vote counter updates do not touch the index
+    """
+    CREATE TRIGGER IF NOT EXISTS answer_fts_update AFTER UPDATE OF content ON answer BEGIN
+        INSERT INTO answer_fts(answer_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO answer_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+]
+
+# the filters are applied inside each arm so that the candidates cut off by
+# MAX_CANDIDATES are the best matches that can be returned
+_SEARCH = """
+WITH question_matches AS (
+    SELECT question_fts.rowid AS question_id, question_fts.rank AS score,
+           snippet(question_fts, 0, '', '', '…', :excerpt_tokens) AS excerpt
+    FROM question_fts JOIN question ON question.id = question_fts.rowid
+    WHERE question_fts MATCH :query
+      AND (:task IS NULL OR question.task = :task)
+      AND (:language IS NULL OR :language IN (question.language, question.source_language, question.target_language))
+    ORDER BY question_fts.rank
+    LIMIT :candidates
+), answer_matches AS (
+    SELECT answer.question_id, answer_fts.rank * :answer_weight AS score, NULL AS excerpt
+    FROM answer_fts JOIN answer ON answer.id = answer_fts.rowid
+    JOIN question ON question.id = answer.question_id
+    WHERE answer_fts MATCH :query
+      AND (:task IS NULL OR question.task = :task)
+      AND (:language IS NULL OR :language IN (question.language, question.source_language, question.target_language))
+    ORDER BY answer_fts.rank
+    LIMIT :candidates
+), matches AS (
+    SELECT * FROM question_matches UNION ALL SELECT * FROM answer_matches
+), ranked AS (
+    SELECT question_id, MIN(score) AS score, MAX(excerpt) AS excerpt FROM matches GROUP BY question_id
+)
+SELECT question.id, question.task, question.language, question.source_language,
+       question.target_language, question.created_at, ranked.score,
+       COALESCE(ranked.excerpt, substr(question.content, 1, :excerpt_chars)) AS excerpt
+FROM ranked JOIN question ON question.id = ranked.question_id
+WHERE :after_score IS NULL OR ranked.score > :after_score
+   OR (ranked.score = :after_score AND question.id > :after_id)
+ORDER BY ranked.score, question.id
+LIMIT :limit
+"""
+
+
+def ensure_search_index(engine: Engine) -> None:
+    """
+    Create the FTS5 indexes and their triggers if missing, building a new
+    index from the rows already stored
+    """
+    if engine.dialect.name != "sqlite":
+        return
+    with engine.begin() as connection:
+        existing = {
+            name for (name,) in connection.execute(
+                text("SELECT name FROM sqlite_master WHERE name IN ('question_fts', 'answer_fts')")
+            )
+        }
+        if "question_fts" in existing and "title" in {
+            row.name for row in connection.execute(text("PRAGMA table_info(question_fts)"))
+        }:
+            # older indexes also covered the title; drop them with their triggers
+            logging.info("<search> dropping question_fts to rebuild it without titles")
+            for trigger in ("question_fts_insert", "question_fts_delete", "question_fts_update"):
+                connection.execute(text(f"DROP TRIGGER IF EXISTS {trigger}"))
+            connection.execute(text("DROP TABLE question_fts"))
+            existing.discard("question_fts")
+        for statement in _SCHEMA:
+            connection.execute(text(statement))
+        for table in ("question_fts", "answer_fts"):
+            if table not in existing:
+                logging.info(f"<search> building {table} from the stored rows")
+                connection.execute(text(f"INSERT INTO {table}({table}) VALUES ('rebuild')"))
+
+
+def build_match_query(query: str, *, prefix: bool) -> Optional[str]:
+    """
+    Turn user input into an FTS5 query matching all of its words. Words are
+    quoted so FTS5 operators in the input are searched for literally.
+    :param query: the text typed by the user
+    :param prefix: whether the last word may be incomplete (type-ahead)
+    :return: the MATCH expression, or None if the input has no words
+    """
+    words = re.findall(r"\w+", query)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    if prefix and not query[-1:].isspace():
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+def encode_cursor(score: float, question_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([score, question_id]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[float, int]:
+    """
+    :raises ValueError: if the cursor was not returned by a search
+    """
+    try:
+        score, question_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(score), int(question_id)
+    except (ValueError, TypeError):
+        raise ValueError("invalid cursor")
+
+
+def search_questions(
+    session,
+    *,
+    query: str,
+    task: Optional[str] = None,
+    language: Optional[str] = None,
+    prefix: bool = True,
+    limit: int = 20,
+    cursor: Optional[str] = None
+) -> dict:
+    """
+    Search questions by their own text and the text of their answers, best
+    match first
+    :param session: the database session
+    :param query: the search text
+    :param task: only return questions of this task
+    :param language: only return questions in (or translating from/to) this language
+    :param prefix: whether the last word is matched as a prefix
+    :param limit: the page size
+    :param cursor: the next_cursor of the previous page
+    :return: {"questions": [...], "next_cursor": str or None}
+    :raises ValueError: on an invalid limit or cursor
+    """
+    if not 1 <= limit <= MAX_LIMIT:
+        raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+    match_query = build_match_query(query, prefix=prefix)
+    if match_query is None:
+        return {"questions": [], "next_cursor": None}
+    after_score, after_id = decode_cursor(cursor) if cursor else (None, None)
+
+    rows = session.execute(text(_SEARCH), {
+        "query": match_query,
+        "answer_weight": ANSWER_WEIGHT,
+        "candidates": MAX_CANDIDATES,
+        "excerpt_tokens": EXCERPT_TOKENS,
+        "excerpt_chars": EXCERPT_CHARS,
+        "task": task,
+        "language": language,
+        "after_score": after_score,
+        "after_id": after_id,
+        # one extra row tells whether there is a next page
+        "limit": limit + 1,
+    }).all()
+
+    questions = [
+        {
+            "id": row.id,
+            "excerpt": row.excerpt,
+            "task": row.task,
+            "language": row.language,
+            "source_language": row.source_language,
+            "target_language": row.target_language,
+            "created_at": str(row.created_at),
+        }
+        for row in rows[:limit]
+    ]
+    next_cursor = encode_cursor(rows[limit - 1].score, rows[limit - 1].id) if len(rows) > limit else None
+    return {"questions": questions, "next_cursor": next_cursor}
@@ -0,0 +1,80 @@
+import asyncio
+import concurrent.futures
+import threading
+from typing import Awaitable, Callable, TypeVar
+
+T = TypeVar("T")
+
+
+class _LeaderCancelled(Exception):
+    pass
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key into a single execution.
+    The first caller runs the call and every caller arriving while it is in
+    flight awaits the same result. The shared state is thread-safe because
+    flask runs each async view on its own event loop in a worker thread.
+    """
+
+    def __init__(self):
+        self._calls: dict[str, concurrent.futures.Future] = {}
+        self._lock = threading.Lock()
+        self._coalesced = 0
+
+    async def do(self, key: str, call: Callable[[], Awaitable[T]]) -> T:
+        """
+        Run call() unless a call with the same key is already in flight
+        :param key: identifies calls that may share a result
+        :param call: creates the awaitable to run when this caller leads
+        :return: the result of the shared call
+        """
+        while True:
+            with self._lock:
+                future = self._calls.get(key)
+                is_leader = future is None
+                if is_leader:
+                    future = concurrent.futures.Future()
+                    self._calls[key] = future
+                else:
+                    self._coalesced += 1
+
+            if is_leader:
+                return await self._lead(key, future, call)
+
+            try:
+                # shield so a cancelled follower does not cancel the shared call
+                return await asyncio.shield(asyncio.wrap_future(future))
+            except _LeaderCancelled:
+                # the leading request went away; retry and possibly lead
+                continue
+
+    async def _lead(self, key: str, future: concurrent.futures.Future, call: Callable[[], Awaitable[T]]) -> T:
+        try:
+            result = await call()
+        except asyncio.CancelledError:
+            self._finish(key, future, exception=_LeaderCancelled())
+            raise
+        except Exception as e:
+            self._finish(key, future, exception=e)
+            raise
+        self._finish(key, future, result=result)
+        return result
+
+    def _finish(self, key: str, future: concurrent.futures.Future, *, result=None, exception=None) -> None:
+        # forget the call before resolving it so later callers start a fresh one
+        with self._lock:
+            self._calls.pop(key, None)
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"in_flight": len(self._calls), "coalesced": self._coalesced}
+
+
+# in-flight LLM calls keyed like the answer cache
+llm_calls = SingleFlight()
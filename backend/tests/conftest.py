@@ -0,0 +1,95 @@
+"""
+The tests run the app on the mock models of app_config.benchmark.yaml, with
+the database, cache and logs in a temporary instance directory. No
+background service starts on its own: the counter buffer, the job worker
+and the replayer are started by the tests that need them.
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+import yaml
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+INSTANCE = tempfile.mkdtemp(prefix="lmcode-tests-")
+
+with open(os.path.join(BACKEND, "app_config.benchmark.yaml")) as file:
+    _config = yaml.safe_load(file)
+_database = os.path.join(INSTANCE, "test.db")
+_config["instance"]["path"] = INSTANCE
+_config["database"].update(file_name=_database, uri=f"sqlite:///{_database}")
+_config["counters"]["enabled"] = False
+_config["replay"]["enabled"] = False
+_config["jobs"]["worker_in_app"] = False
+_config["metrics"]["directory"] = ""
+_config["tracing"]["enabled"] = False
+with open(os.path.join(INSTANCE, "app_config.test.yaml"), "w") as file:
+    yaml.safe_dump(_config, file)
+os.environ["APP_CONFIG"] = os.path.join(INSTANCE, "app_config.test.yaml")
+
+
+@pytest.fixture(scope="session", autouse=True)
+def instance():
+    yield INSTANCE
+    shutil.rmtree(INSTANCE, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
+def app():
+    from app import app
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def make_question(app):
+    """
+    Store a question with an answer of each model
+    :return: a function of (content, model ids, question fields) returning
+        the question id and the answer ids in model order
+    """
+    import database
+    from function import insert_answers, insert_question
+
+    def make(content: str, model_ids: tuple[str, ...] = ("mock-fast", "mock-steady"), **fields) -> tuple[int, list[int]]:
+        with app.app_context():
+            question_id = database.write(
+                insert_question,
+                title="placeholder",
+                content=content,
+                language=fields.get("language"),
+                source_language=fields.get("source_language"),
+                target_language=fields.get("target_language"),
+                task=fields.get("task", "Code Generation"),
+                ip_address=None,
+            )
+            answer_ids = database.write(
+                insert_answers,
+                answers=[
+                    {"content": f"answer of {model_id}", "model_id": model_id, "question_id": question_id, "frontend_order": i}
+                    for i, model_id in enumerate(model_ids)
+                ],
+                llm_errors=[],
+            )
+        return question_id, answer_ids
+
+    return make
+
+
+@pytest.fixture(params=["direct", "writer"])
+def write_path(request, app):
+    """writes by each thread on its own connection, or queued to the database writer"""
+    from database import db_writer
+
+    if request.param == "direct":
+        db_writer.stop()
+    yield request.param
+    db_writer.start(app)
@@ -0,0 +1,133 @@
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from sqlalchemy import delete
+
+import database
+import jobs
+from config import config
+from models import db, Job
+
+
+@pytest.fixture(autouse=True)
+def empty_queue(app):
+    # claims take any job of the queue
+    with app.app_context():
+        database.write(lambda: (db.session.execute(delete(Job)), database.commit()))
+
+
+def enqueue(app, question_id: int, count: int) -> list[int]:
+    with app.app_context():
+        return database.write(jobs.enqueue_jobs, question_id=question_id, model_ids=["mock-fast"] * count, params={})
+
+
+def claim(app, worker_id: str, limit: int = 100) -> list[int]:
+    with app.app_context():
+        return [fields["job_id"] for fields in database.write(jobs.claim_jobs, worker_id=worker_id, limit=limit)]
+
+
+def job_rows(app, job_ids: list[int]) -> list[tuple]:
+    with app.app_context():
+        return [
+            (job.status, job.worker_id, job.attempts)
+            for job in Job.query.filter(Job.id.in_(job_ids)).order_by(Job.id)
+        ]
+
+
+def test_concurrent_claims_are_disjoint(app, make_question, write_path):
+    question_id, _ = make_question("jobs concurrent claims")
+    job_ids = enqueue(app, question_id, 30)
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        claims = list(pool.map(lambda i: claim(app, f"worker-{i}", limit=10), range(4)))
+
+    assert sorted(job_id for ids in claims for job_id in ids) == job_ids
+    assert claim(app, "worker-late") == []
+    owners = {job_id: f"worker-{i}" for i, ids in enumerate(claims) for job_id in ids}
+    assert job_rows(app, job_ids) == [(jobs.RUNNING, owners[job_id], 1) for job_id in job_ids]
+
+
+def test_expired_leases_move_to_the_new_worker(app, make_question, monkeypatch):
+    question_id, _ = make_question("jobs expired leases")
+    job_ids = enqueue(app, question_id, 1)
+
+    monkeypatch.setattr(config, "JOBS_LEASE", -1)
+    assert claim(app, "worker-a") == job_ids
+    assert claim(app, "worker-b") == job_ids
+
+    # the first worker lost the job: its renewal and result are ignored
+    with app.app_context():
+        database.write(jobs.renew_job_lease, job_ids[0], worker_id="worker-a")
+        database.write(jobs.finish_job, job_ids[0], worker_id="worker-a", error="late")
+    assert job_rows(app, job_ids) == [(jobs.RUNNING, "worker-b", 2)]
+
+    with app.app_context():
+        database.write(jobs.finish_job, job_ids[0], worker_id="worker-b", answer_id=None)
+    assert job_rows(app, job_ids) == [(jobs.DONE, "worker-b", 2)]
+
+
+def test_jobs_of_workers_that_keep_dying_fail(app, make_question, monkeypatch):
+    question_id, _ = make_question("jobs max attempts")
+    job_ids = enqueue(app, question_id, 1)
+
+    monkeypatch.setattr(config, "JOBS_LEASE", -1)
+    for attempt in range(config.JOBS_MAX_ATTEMPTS):
+        assert claim(app, f"worker-{attempt}") == job_ids
+    assert claim(app, "worker-last") == []
+    assert job_rows(app, job_ids)[0][0] == jobs.FAILED
+
+
+def test_worker_renews_the_lease_of_a_slow_job(app, make_question, monkeypatch):
+    question_id, _ = make_question("jobs slow job")
+    job_ids = enqueue(app, question_id, 1)
+    calls = []
+
+    async def slow_answer(**fields):
+        calls.append(fields["model_id"])
+        await asyncio.sleep(2)
+        return {"answer_id": None}
+
+    monkeypatch.setattr(config, "JOBS_LEASE", 0.6)
+    monkeypatch.setattr(jobs, "get_answer_from_model", slow_answer)
+    first, second = jobs.JobWorker(concurrency=1, poll_interval=0.1), jobs.JobWorker(concurrency=1, poll_interval=0.1)
+    first.start(app)
+    time.sleep(0.3)
+    second.start(app)
+    time.sleep(2.5)
+    first.stop()
+    second.stop()
+
+    assert calls == ["mock-fast"]
+    assert job_rows(app, job_ids) == [(jobs.DONE, first.worker_id, 1)]
+
+
+_EXIT_WITH_A_JOB_IN_FLIGHT = """
+import asyncio, sys, time
+import database, jobs
+from app import app
+
+async def slow_answer(**fields):
+    await asyncio.sleep(1)
+    return {"answer_id": None}
+
+jobs.get_answer_from_model = slow_answer
+# through asyncio.to_thread, whose thread pools shut down before atexit
+database.db_writer.stop()
+jobs.JobWorker(concurrency=1, poll_interval=0.1).start(app)
+time.sleep(0.5)
+"""
+
+
+def test_exit_waits_for_the_jobs_in_flight(app, make_question):
+    question_id, _ = make_question("jobs exit")
+    job_ids = enqueue(app, question_id, 1)
+
+    backend = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, "-c", _EXIT_WITH_A_JOB_IN_FLIGHT], cwd=backend, check=True, timeout=60)
+
+    assert job_rows(app, job_ids)[0][0] == jobs.DONE
@@ -0,0 +1,68 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+from config import config
+from models import db, LLMError
+from replay import claim_errors, release_errors, renew_error_leases, resolve_llm_errors
+
+
+def add_errors(app, question_id: int, model_id: str, count: int) -> list[int]:
+    def add():
+        errors = [
+            LLMError(question_id=question_id, model_id=model_id, prompt="prompt", error="timeout")
+            for _ in range(count)
+        ]
+        db.session.add_all(errors)
+        database.commit()
+        return [error.id for error in errors]
+
+    with app.app_context():
+        return database.write(add)
+
+
+def claim(app, model_id: str, limit: int = 100) -> list[int]:
+    with app.app_context():
+        rows = database.write(claim_errors, after_id=0, limit=limit, min_age=0, model_ids=[model_id])
+        return [row.id for row in rows]
+
+
+def test_concurrent_claims_are_disjoint(app, make_question, write_path):
+    model_id = f"replay-concurrent-{write_path}"
+    question_id, _ = make_question("replay concurrent claims")
+    error_ids = add_errors(app, question_id, model_id, 40)
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        claims = list(pool.map(lambda _: claim(app, model_id, limit=15), range(4)))
+
+    claimed = [error_id for ids in claims for error_id in ids]
+    assert sorted(claimed) == error_ids
+    assert claim(app, model_id) == []
+
+
+def test_expired_and_released_leases_are_claimed_again(app, make_question, monkeypatch):
+    question_id, _ = make_question("replay expired leases")
+    error_ids = add_errors(app, question_id, "replay-expired", 3)
+
+    monkeypatch.setattr(config, "REPLAY_LEASE", -1)
+    assert claim(app, "replay-expired") == error_ids
+    # the replayer that held them is gone
+    assert claim(app, "replay-expired") == error_ids
+
+    monkeypatch.setattr(config, "REPLAY_LEASE", 600)
+    with app.app_context():
+        database.write(renew_error_leases, error_ids)
+    assert claim(app, "replay-expired") == []
+
+    with app.app_context():
+        database.write(release_errors, error_ids[:1])
+    assert claim(app, "replay-expired") == error_ids[:1]
+
+
+def test_resolved_errors_are_not_claimed(app, make_question):
+    question_id, (answer_id, _) = make_question("replay resolved errors")
+    error_ids = add_errors(app, question_id, "replay-resolved", 2)
+
+    with app.app_context():
+        database.write(resolve_llm_errors, error_ids[:1], answer_id)
+        database.write(release_errors, error_ids)
+    assert claim(app, "replay-resolved") == error_ids[1:]
@@ -0,0 +1,79 @@
+import pytest
+
+import search
+
+
+@pytest.fixture(scope="module")
+def sorting_questions(app):
+    import database
+    from function import insert_question
+
+    with app.app_context():
+        return [
+            database.write(
+                insert_question,
+                title="placeholder",
+                content=f"quokka sort {'quokka ' * (i % 4)}of list number {i}",
+                language="Python" if i % 2 else "Java",
+                source_language=None,
+                target_language=None,
+                task="Code Generation",
+                ip_address=None,
+            )
+            for i in range(25)
+        ]
+
+
+def search_pages(client, query: str, **params) -> list[list[dict]]:
+    pages, cursor = [], None
+    while True:
+        query_string = {"q": query, **params}
+        if cursor:
+            query_string["cursor"] = cursor
+        response = client.get("/api/questions/search", query_string=query_string)
+        assert response.status_code == 200
+        pages.append(response.json["questions"])
+        cursor = response.json["next_cursor"]
+        if cursor is None:
+            return pages
+
+
+def test_cursor_pages_through_every_match_once(client, sorting_questions):
+    pages = search_pages(client, "quokka", limit=7)
+    paged = [question["id"] for page in pages for question in page]
+
+    assert [len(page) for page in pages] == [7, 7, 7, 4]
+    assert sorted(paged) == sorting_questions
+    assert paged == [question["id"] for question in search_pages(client, "quokka", limit=100)[0]]
+
+
+def test_filters_apply_before_paging(client, sorting_questions):
+    pages = search_pages(client, "quokka", limit=5, language="Python")
+    assert sorted(question["id"] for page in pages for question in page) == sorting_questions[1::2]
+
+
+def test_candidates_are_capped(client, sorting_questions, monkeypatch):
+    monkeypatch.setattr(search, "MAX_CANDIDATES", 10)
+    pages = search_pages(client, "quokka", limit=4)
+    assert len([question for page in pages for question in page]) == 10
+
+
+def test_results_show_an_excerpt_of_the_content(client, make_question):
+    make_question("a question about " + "padding " * 40 + "wombat " + "padding " * 40)
+    question_id, _ = make_question("sort a list", model_ids=("okapi",))
+
+    excerpt = client.get("/api/questions/search?q=wombat").json["questions"][0]["excerpt"]
+    assert "wombat" in excerpt and len(excerpt) < 300
+    # matched through its answer
+    questions = client.get("/api/questions/search?q=okapi").json["questions"]
+    assert [(question["id"], question["excerpt"]) for question in questions] == [(question_id, "sort a list")]
+
+
+def test_titles_are_not_searched(client, sorting_questions):
+    assert client.get("/api/questions/search?q=placeholder").json["questions"] == []
+    assert client.get("/api/questions/search?q=pl").json["questions"] == []
+
+
+def test_invalid_cursor(client):
+    response = client.get("/api/questions/search?q=quokka&cursor=abc")
+    assert response.status_code == 400
@@ -0,0 +1,89 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from counters import counter_buffer
+from database import db_writer
+from models import db, Answer
+
+
+@pytest.fixture(params=["direct", "writer", "buffered"])
+def vote_path(request, app):
+    """votes written by each request, through the database writer, or buffered"""
+    if request.param == "direct":
+        db_writer.stop()
+    elif request.param == "buffered":
+        counter_buffer.start(app)
+    yield request.param
+    counter_buffer.stop()
+    db_writer.start(app)
+
+
+def votes_of(app, answer_id: int) -> tuple[int, int]:
+    if counter_buffer.running:
+        with app.app_context():
+            counter_buffer.flush()
+    with app.app_context():
+        answer = db.session.get(Answer, answer_id)
+        return answer.upvotes or 0, answer.downvotes or 0
+
+
+def test_concurrent_votes_lose_no_updates(app, make_question, vote_path):
+    _, (answer_id, _) = make_question(f"concurrent votes {vote_path}")
+
+    def vote(i: int) -> int:
+        action = "accept" if i % 3 else "reject"
+        return app.test_client().post(f"/api/answers/{action}", json={"answer_id": answer_id}).status_code
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        statuses = list(pool.map(vote, range(120)))
+
+    assert statuses == [200] * 120
+    assert votes_of(app, answer_id) == (80, 40)
+
+
+def test_concurrent_bulk_votes_lose_no_updates(app, make_question, vote_path):
+    _, (first, second) = make_question(f"concurrent bulk votes {vote_path}")
+    votes = {"votes": [
+        {"answer_id": first, "action": "accept"},
+        {"answer_id": second, "action": "reject"},
+        {"answer_id": first, "action": "accept"},
+    ]}
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        statuses = list(pool.map(lambda _: app.test_client().post("/api/answers/votes", json=votes).status_code, range(40)))
+
+    assert statuses == [200] * 40
+    assert votes_of(app, first) == (80, 0)
+    assert votes_of(app, second) == (0, 40)
+
+
+def test_bulk_votes_are_all_or_nothing(app, client, make_question, vote_path):
+    _, (first, second) = make_question(f"bulk votes {vote_path}")
+
+    response = client.post("/api/answers/votes", json={"votes": [
+        {"answer_id": first, "action": "accept"},
+        {"answer_id": second, "action": "reject"},
+        {"answer_id": 10 ** 9, "action": "accept"},
+    ]})
+    assert response.status_code == 404
+    response = client.post("/api/answers/votes", json={"votes": [
+        {"answer_id": first, "action": "accept"},
+        {"answer_id": second, "action": "downvote"},
+    ]})
+    assert response.status_code == 400
+    assert votes_of(app, first) == (0, 0)
+    assert votes_of(app, second) == (0, 0)
+
+    response = client.post("/api/answers/votes", json={"votes": [
+        {"answer_id": first, "action": "accept"},
+        {"answer_id": second, "action": "reject"},
+    ]})
+    assert response.status_code == 200
+    assert votes_of(app, first) == (1, 0)
+    assert votes_of(app, second) == (0, 1)
+
+
+def test_vote_on_a_missing_answer(client, vote_path):
+    response = client.post("/api/answers/accept", json={"answer_id": 10 ** 9})
+    assert response.status_code == 404
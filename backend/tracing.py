@@ -0,0 +1,378 @@
+"""
+Request ids and lightweight tracing of the answer pipeline.
+
+Every request gets a request id, taken from its X-Request-ID header or
+generated, which is returned in the X-Request-ID response header, added to
+every log record and stored on the LLMError rows of the request.
+
+With tracing.enabled, the stages of a request (parsing, prompt building,
+cache lookups, provider calls, database writes) are recorded as spans.
+Finished traces are kept when they fail, take longer than
+tracing.slow_threshold, or fall within tracing.sample_rate, and appended to
+tracing.file_name in the instance directory as one OTLP/JSON object per
+line, which OpenTelemetry collectors read with their otlpjsonfile receiver.
+A W3C traceparent header continues the trace of the caller.
+
+When tracing is off, span() costs one context variable lookup.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+from flask import Flask, g, request
+
+from config import config
+
+SERVER = 2
+INTERNAL = 1
+CLIENT = 3
+
+REQUEST_ID_HEADER = "X-Request-ID"
+_REQUEST_ID = re.compile(r"^[A-Za-z0-9._:-]{1,64}$")
+_TRACEPARENT = re.compile(r"^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+_request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+def current_request_id() -> Optional[str]:
+    return _request_id.get()
+
+
+def make_request_id(header: Optional[str] = None) -> str:
+    """the request id sent by the client if it is well formed, otherwise a new one"""
+    if header and _REQUEST_ID.match(header):
+        return header
+    return uuid.uuid4().hex
+
+
+def _attribute(key: str, value) -> dict:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class Trace:
+    """The spans of one request, exported together once its root span ends."""
+
+    def __init__(self, trace_id: Optional[str] = None):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.spans: list[Span] = []
+
+
+class Span:
+    """One timed stage of a request; a context manager making it the parent of nested spans."""
+
+    __slots__ = ("trace", "span_id", "parent_id", "name", "kind", "attributes", "start", "end", "error", "_token")
+
+    def __init__(self, trace: Trace, name: str, *, parent_id: Optional[str], kind: int, attributes: dict):
+        self.trace = trace
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes
+        self.start = time.time_ns()
+        self.end: Optional[int] = None
+        self.error: Optional[str] = None
+        self._token = None
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def set_status_code(self, status_code: int) -> None:
+        self.attributes["http.status_code"] = status_code
+        if status_code >= 500 and self.error is None:
+            self.error = f"HTTP {status_code}"
+
+    def __enter__(self) -> "Span":
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if isinstance(exc, Exception):
+            self.error = f"{exc_type.__name__}: {exc}"
+        self.finish()
+        try:
+            _current_span.reset(self._token)
+        except ValueError:
+            # ended in another context, e.g. a later step of a streamed response
+            pass
+
+    def finish(self) -> None:
+        self.end = time.time_ns()
+        # list.append is atomic, so spans of concurrent tasks can end at once
+        self.trace.spans.append(self)
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start),
+            "endTimeUnixNano": str(self.end),
+            "attributes": [_attribute(key, value) for key, value in self.attributes.items() if value is not None],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class _NoSpan:
+    """Stands in for a span when the request is not traced."""
+
+    def set(self, **attributes) -> None:
+        pass
+
+    def __enter__(self) -> "_NoSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name: str, *, kind: int = INTERNAL, **attributes):
+    """
+    A span of the traced request in progress, nested in the current span
+    :param name: the stage of the request
+    :param kind: INTERNAL, or CLIENT for calls to other services
+    :return: a context manager timing the stage; does nothing when the request is not traced
+    """
+    parent = _current_span.get()
+    if parent is None:
+        return _NO_SPAN
+    return Span(parent.trace, name, parent_id=parent.span_id, kind=kind, attributes=attributes)
+
+
+class TraceWriter:
+    """Appends kept traces to the trace file on a background thread."""
+
+    def __init__(self, *, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.written = 0
+        self.dropped = 0
+
+    def submit(self, trace: Trace) -> None:
+        if self._thread is None:
+            self.start()
+        self._queue.put(trace)
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="trace-writer", daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        """write the traces queued so far"""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def _run(self) -> None:
+        while True:
+            trace = self._queue.get()
+            if trace is None:
+                return
+            try:
+                self._write(trace)
+                self.written += 1
+            except OSError as e:
+                self.dropped += 1
+                logging.error(f"<tracing> Error in writing trace {trace.trace_id}: {e}")
+
+    def _write(self, trace: Trace) -> None:
+        line = json.dumps({
+            "resourceSpans": [{
+                "resource": {"attributes": [_attribute("service.name", config.TRACING_SERVICE_NAME)]},
+                "scopeSpans": [{
+                    "scope": {"name": "lmcode"},
+                    "spans": [span.to_otlp() for span in trace.spans],
+                }],
+            }]
+        })
+        if self.max_bytes and os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+            # keep a single previous file
+            os.replace(self.path, f"{self.path}.1")
+        with open(self.path, "a") as file:
+            file.write(line + "\n")
+
+    def stats(self) -> dict:
+        return {"written": self.written, "dropped": self.dropped, "queued": self._queue.qsize()}
+
+
+trace_writer = TraceWriter(path=config.TRACING_FILE, max_bytes=config.TRACING_MAX_BYTES)
+
+
+class RequestScope:
+    """The request id and, if traced, the root span of a request or a background job."""
+
+    def __init__(self, name: str, *, request_id: str, kind: int, traceparent: Optional[str], attributes: dict):
+        self.request_id = request_id
+        self._request_token = _request_id.set(request_id)
+        self.root: Optional[Span] = None
+        if config.TRACING_ENABLED:
+            match = _TRACEPARENT.match(traceparent or "")
+            trace = Trace(match.group(1) if match else None)
+            self.root = Span(
+                trace, name,
+                parent_id=match.group(2) if match else None,
+                kind=kind,
+                attributes={"request.id": request_id, **attributes},
+            ).__enter__()
+
+    def finish(self, error: Optional[str] = None, **attributes) -> None:
+        """end the request; its trace is written if it is kept"""
+        try:
+            _request_id.reset(self._request_token)
+        except ValueError:
+            pass
+        root = self.root
+        if root is None:
+            return
+        root.set(**attributes)
+        if error:
+            root.error = error
+        root.__exit__(None, None, None)
+        seconds = (root.end - root.start) / 1e9
+        if (
+            root.error
+            or seconds >= config.TRACING_SLOW_THRESHOLD
+            or random.random() < config.TRACING_SAMPLE_RATE
+        ):
+            trace_writer.submit(root.trace)
+
+
+def begin(name: str, *, request_id: Optional[str] = None, kind: int = SERVER,
+          traceparent: Optional[str] = None, **attributes) -> RequestScope:
+    """
+    Start a request: set its request id and, when tracing, its root span
+    :param name: the name of the root span, e.g. the route
+    :param request_id: default a new one
+    :param traceparent: the W3C traceparent header of the request, if any
+    :return: the scope to finish at the end of the request
+    """
+    return RequestScope(
+        name,
+        request_id=request_id or make_request_id(),
+        kind=kind,
+        traceparent=traceparent,
+        attributes=attributes,
+    )
+
+
+@contextmanager
+def trace(name: str, *, request_id: Optional[str] = None, **attributes) -> Iterator[RequestScope]:
+    """begin() and finish() around work outside a request, like a job"""
+    scope = begin(name, request_id=request_id, kind=INTERNAL, **attributes)
+    error = None
+    try:
+        yield scope
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        scope.finish(error=error)
+
+
+def init_app(app: Flask) -> None:
+    """give every request of the flask app a request id and, when tracing, a trace"""
+    factory = logging.getLogRecordFactory()
+
+    def record_factory(*args, **kwargs) -> logging.LogRecord:
+        record = factory(*args, **kwargs)
+        record.request_id = _request_id.get() or "-"
+        return record
+
+    logging.setLogRecordFactory(record_factory)
+
+    @app.before_request
+    def begin_request():
+        # requests through the ASGI app already have a scope from TracingMiddleware
+        if _request_id.get() is not None:
+            return
+        g.request_scope = begin(
+            f"{request.method} {request.url_rule.rule if request.url_rule else request.path}",
+            request_id=make_request_id(request.headers.get(REQUEST_ID_HEADER)),
+            traceparent=request.headers.get("traceparent"),
+            **{"http.method": request.method, "http.target": request.path},
+        )
+
+    @app.after_request
+    def add_request_id(response):
+        scope = g.get("request_scope")
+        if scope is not None:
+            response.headers[REQUEST_ID_HEADER] = scope.request_id
+            if scope.root is not None:
+                scope.root.set_status_code(response.status_code)
+        return response
+
+    @app.teardown_request
+    def finish_request(exc):
+        scope = g.pop("request_scope", None)
+        if scope is not None:
+            scope.finish(error=f"{type(exc).__name__}: {exc}" if exc is not None else None)
+
+
+class TracingMiddleware:
+    """ASGI middleware giving every HTTP request a request id and, when tracing, a trace."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope["headers"]}
+        request_scope = begin(
+            f"{scope['method']} {scope['path']}",
+            request_id=make_request_id(headers.get(REQUEST_ID_HEADER.lower())),
+            traceparent=headers.get("traceparent"),
+            **{"http.method": scope["method"], "http.target": scope["path"]},
+        )
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (REQUEST_ID_HEADER.encode("latin-1"), request_scope.request_id.encode("latin-1")),
+                ]
+                if request_scope.root is not None:
+                    request_scope.root.set_status_code(message["status"])
+            await send(message)
+
+        error = None
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            request_scope.finish(error=error)
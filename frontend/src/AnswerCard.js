@@ -7,7 +7,7 @@ import ContentCopyIcon from '@mui/icons-material/ContentCopy'; // Import copy ic
 import CodeBlock from './code/CodeBlock'; // Adjust the path as necessary
 import FeedbackDialog from './FeedbackDialog'; // Adjust the path as necessary
 import { copyToClipboard } from './utils/text';
-import { resolveUrl, makeApiRequestAndCheckStatus } from './utils/api';
+import { resolveUrl, makeApiRequestAndCheckStatus, streamServerSentEvents } from './utils/api';
 import { LOADING_MESSAGES } from './utils/constants';
 
 // Function to convert index to uppercase letter
@@ -50,37 +50,47 @@ const AnswerCard = ({
         return;
       }
       try {
-        const response = await fetch(resolveUrl('/api/answer'), {
-          method: 'POST',
-          headers: {
-            'Content-Type': 'application/json',
-          },
-          body: JSON.stringify({
-            questionId,
-            modelId,
-            content,
-            language,
-            sourceLanguage,
-            targetLanguage,
-            task,
-            frontendOrder: index,
-          }),
+        let streamedContent = '';
+        let failedMessage = null;
+        await streamServerSentEvents('/api/answer/stream', {
+          questionId,
+          modelId,
+          content,
+          language,
+          sourceLanguage,
+          targetLanguage,
+          task,
+          frontendOrder: index,
+        }, (event, data) => {
+          if (event === 'token') {
+            // Show the answer as it is generated; it can be voted on once stored
+            streamedContent += data.content;
+            setAnswer({
+              id: null,
+              model_id: modelId,
+              model_name: null,
+              content: streamedContent,
+              accepted: false,
+              rejected: false,
+            });
+            setIsLoaded(true);
+          } else if (event === 'answer') {
+            setAnswer({
+              id: data.answer_id,
+              model_id: data.model_id,
+              model_name: data.model_name,
+              content: data.content,
+              accepted: false,
+              rejected: false,
+            });
+            setIsLoaded(true);
+          } else if (event === 'error') {
+            failedMessage = data.error;
+          }
         });
-        if (!response.ok) {
-          throw new Error(`Failed to fetch answer for model ${modelId}: ${response.status}`);
+        if (failedMessage !== null) {
+          throw new Error(`Failed to fetch answer for model ${modelId}: ${failedMessage}`);
         }
-        const data = await response.json();
-
-        const answer = {
-          id: data.answer_id,
-          model_id: data.model_id,
-          model_name: data.model_name,
-          content: data.content,
-          accepted: false,
-          rejected: false,
-        }
-        setAnswer(answer);
-        setIsLoaded(true);
       } catch (error) {
         console.error('Error fetching answer for model:', modelId, error);
         setFailed(true);
@@ -97,7 +107,7 @@ const AnswerCard = ({
   const [reportDialogOpen, setReportDialogOpen] = useState(false);
 
   const handleAccept = () => {
-    if (!answer) {
+    if (!answer?.id) {
       return;
     }
     if (!answer.accepted) {
@@ -120,7 +130,7 @@ const AnswerCard = ({
   };
 
   const handleReject = () => {
-    if (!answer) {
+    if (!answer?.id) {
       return;
     }
     if (!answer.rejected) {
@@ -239,7 +249,7 @@ const AnswerCard = ({
           }}
         />
         }
-        {isLoaded && !failed &&
+        {isLoaded && !failed && answer?.id &&
         <Box sx={{ mt: 2, display: 'flex', alignItems: 'center' }}>
           <Tooltip
             title="Accept this answer"
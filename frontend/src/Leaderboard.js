@@ -1,13 +1,25 @@
-import React, { useState, useMemo } from 'react';
+import React, { useState, useEffect } from 'react';
+import { makeApiRequestAndCheckStatus } from './utils/api';
 
 const Leaderboard = () => {
-    const data = useMemo(() => ([
-        { id: 1, name: 'GPT-4o', votes: "-", rating: "-" },
-        { id: 2, name: 'Claude-3.5-sonnet', votes: "-", rating: "-" },
-        { id: 3, name: 'Gemini-1.5-pro', votes: "-", rating: "-" },
-        { id: 4, name: 'Llama-70b', votes: "-", rating: "-" },
-        { id: 5, name: 'Qwen2.5-Coder-32B', votes: "-", rating: "-" },
-    ]), []);
+    const [data, setData] = useState([]);
+    useEffect(() => {
+        const fetchLeaderboard = async () => {
+            const leaderboard = await makeApiRequestAndCheckStatus('/api/leaderboard', 'GET');
+            if (leaderboard) {
+                setData(leaderboard.models.map((model) => ({
+                    id: model.model_id,
+                    name: model.model_name,
+                    votes: model.comparisons,
+                    rating: Math.round(model.rating),
+                    interval: model.ci_lower !== null && model.ci_upper !== null
+                        ? `${Math.round(model.ci_lower)} – ${Math.round(model.ci_upper)}`
+                        : null,
+                })));
+            }
+        };
+        fetchLeaderboard();
+    }, []);
     const [sortConfig, setSortConfig] = useState(null);
 
     const sortedData = [...data];
@@ -69,6 +81,10 @@ const Leaderboard = () => {
         oddRow: {
             backgroundColor: '#fafafa',
         },
+        interval: {
+            fontSize: '14px',
+            color: '#777',
+        },
     };
 
     return (
@@ -97,7 +113,10 @@ const Leaderboard = () => {
                         <tr key={model.id} style={index % 2 === 0 ? styles.evenRow : styles.oddRow}>
                             <td style={styles.td}>{model.name}</td>
                             <td style={styles.td}>{model.votes}</td>
-                            <td style={styles.td}>{model.rating}</td>
+                            <td style={styles.td}>
+                                {model.rating}
+                                {model.interval ? <span style={styles.interval}> ({model.interval})</span> : null}
+                            </td>
                         </tr>
                     ))}
                 </tbody>
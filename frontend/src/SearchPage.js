@@ -1,8 +1,9 @@
-import React, { useState } from 'react';
+import React, { useState, useEffect } from 'react';
 import { useNavigate } from 'react-router-dom';
 import { AppBar, Toolbar, IconButton, Button, TextField, Box, Menu, MenuItem, Typography, List, ListItem, ListItemText } from '@mui/material';
 import AccountCircle from '@mui/icons-material/AccountCircle';
 import LoginDialog from './LoginDialog';
+import { makeApiRequestAndCheckStatus } from './utils/api';
 
 const topQuestions = [
     { id: 1, title: 'Write a function to calculate the factorial of a number' },
@@ -15,6 +16,37 @@ const SearchPage = () => {
   const navigate = useNavigate();
   const [anchorEl, setAnchorEl] = useState(null);
   const [loginDialogOpen, setLoginDialogOpen] = useState(false);
+  const [query, setQuery] = useState('');
+  const [results, setResults] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
+
+  // search as the user types, once they pause
+  useEffect(() => {
+    if (!query.trim()) {
+      setResults([]);
+      setNextCursor(null);
+      return undefined;
+    }
+    const timeout = setTimeout(async () => {
+      const page = await makeApiRequestAndCheckStatus(`/api/questions/search?q=${encodeURIComponent(query)}`, 'GET');
+      if (page) {
+        setResults(page.questions);
+        setNextCursor(page.next_cursor);
+      }
+    }, 250);
+    return () => clearTimeout(timeout);
+  }, [query]);
+
+  const handleLoadMore = async () => {
+    const page = await makeApiRequestAndCheckStatus(
+      `/api/questions/search?q=${encodeURIComponent(query)}&cursor=${encodeURIComponent(nextCursor)}`,
+      'GET'
+    );
+    if (page) {
+      setResults((previous) => [...previous, ...page.questions]);
+      setNextCursor(page.next_cursor);
+    }
+  };
 
   const handleProfileMenuOpen = (event) => {
     setAnchorEl(event.currentTarget);
@@ -47,6 +79,8 @@ const SearchPage = () => {
             variant="outlined"
             placeholder="Search..."
             size="small"
+            value={query}
+            onChange={(event) => setQuery(event.target.value)}
             sx={{ backgroundColor: 'white', borderRadius: 1, mr: 2, flexGrow: 1 }}
           />
           <Button variant="contained" color="primary" onClick={handleAskQuestion}>
@@ -77,7 +111,14 @@ const SearchPage = () => {
       <LoginDialog open={loginDialogOpen} onClose={handleLoginClose} />
       <Box sx={{ p: 2 }}>
         <Typography variant="h4" gutterBottom>Search Results</Typography>
-        {/* Add search results content here */}
+        <List>
+          {results.map((question) => (
+            <ListItem button key={question.id} onClick={() => navigate(`/question/${question.id}`)}>
+              <ListItemText primary={question.excerpt} secondary={question.task} />
+            </ListItem>
+          ))}
+        </List>
+        {nextCursor && <Button onClick={handleLoadMore}>Load more</Button>}
         <Typography variant="h5" gutterBottom>Top Questions</Typography>
         <List>
           {topQuestions.map((question) => (
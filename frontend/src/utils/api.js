@@ -16,4 +16,50 @@ export const makeApiRequestAndCheckStatus = async (endpoint, method, body) => {
   } catch (error) {
     console.error(`Error during ${method} request to ${endpoint}:`, error);
   }
-};
\ No newline at end of file
+};
+
+// POST a JSON body and call onEvent(event, data) for every server-sent event in the response.
+export const streamServerSentEvents = async (endpoint, body, onEvent) => {
+  const response = await fetch(resolveUrl(endpoint), {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+      'Accept': 'text/event-stream',
+    },
+    body: JSON.stringify(body),
+  });
+  if (!response.ok) {
+    throw new Error(`Failed to POST at ${endpoint}: ${response.status}`);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) {
+      break;
+    }
+    buffer += decoder.decode(value, { stream: true });
+
+    // Events are separated by a blank line
+    let separatorIndex;
+    while ((separatorIndex = buffer.indexOf('\n\n')) !== -1) {
+      const rawEvent = buffer.slice(0, separatorIndex);
+      buffer = buffer.slice(separatorIndex + 2);
+
+      let event = 'message';
+      const dataLines = [];
+      rawEvent.split('\n').forEach((line) => {
+        if (line.startsWith('event:')) {
+          event = line.slice('event:'.length).trim();
+        } else if (line.startsWith('data:')) {
+          dataLines.push(line.slice('data:'.length).trim());
+        }
+      });
+      if (dataLines.length > 0) {
+        onEvent(event, JSON.parse(dataLines.join('\n')));
+      }
+    }
+  }
+};